@@ -0,0 +1,196 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List
+
+import numpy as np
+
+from receiptchat.data_transformations.ReceiptFingerprint import (
+    hamming_distances,
+    perceptual_hash,
+    simhash,
+)
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class DuplicateIndex:
+    """Fingerprints of parsed receipts, used to spot copies before they are parsed again.
+
+    Every receipt written to the database is indexed by its Drive md5Checksum, a
+    perceptual hash of its rendered image (vision mode) and a SimHash of its OCR text.
+    A new file is a duplicate of an indexed receipt when its checksum is identical,
+    its text SimHash is within simhash_distance bits, or, when the two have no text
+    to compare, its image hash is within phash_distance bits. Duplicates are
+    linked to the receipt they copy instead of being parsed, so they are neither
+    billed nor counted twice in spend.
+    """
+
+    INDEX_PATH = os.path.join(
+        os.path.dirname(__file__), "datasets", "duplicate_index.db"
+    )
+
+    def __init__(
+        self,
+        index_path: str = None,
+        phash_distance: int = 3,
+        simhash_distance: int = 8,
+        min_text_length: int = 50,
+    ):
+
+        self.index_path = index_path or self.INDEX_PATH
+        self.phash_distance = phash_distance
+        self.simhash_distance = simhash_distance
+        # short OCR text, e.g. from an unreadable photo, matches too easily
+        self.min_text_length = min_text_length
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+
+        self.n_linked = 0
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                "receipt_id TEXT PRIMARY KEY, md5 TEXT, phash INTEGER, simhash INTEGER, "
+                "created_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_fingerprints_md5 ON fingerprints (md5)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS duplicates ("
+                "receipt_id TEXT PRIMARY KEY, duplicate_of TEXT NOT NULL, "
+                "reason TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+        self._load()
+
+    @staticmethod
+    def _to_signed(value: int) -> int:
+
+        # sqlite integers are signed 64 bit
+        return value - 2**64 if value is not None and value >= 2**63 else value
+
+    @staticmethod
+    def _to_unsigned(value: int) -> int:
+
+        return value + 2**64 if value is not None and value < 0 else value
+
+    def _load(self) -> None:
+
+        rows = self.connection.execute(
+            "SELECT receipt_id, phash, simhash FROM fingerprints"
+        ).fetchall()
+        self.ids = [row[0] for row in rows]
+        self.phashes = np.array(
+            [self._to_unsigned(row[1]) or 0 for row in rows], dtype=np.uint64
+        )
+        self.has_phash = np.array([row[1] is not None for row in rows], dtype=bool)
+        self.simhashes = np.array(
+            [self._to_unsigned(row[2]) or 0 for row in rows], dtype=np.uint64
+        )
+        self.has_simhash = np.array([row[2] is not None for row in rows], dtype=bool)
+
+    def add(self, fingerprints: List[dict]) -> None:
+        """Index parsed receipts, given dicts of receipt_id, md5, phash and simhash"""
+
+        if not fingerprints:
+            return
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fingerprints "
+                "(receipt_id, md5, phash, simhash, created_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        x["receipt_id"],
+                        x.get("md5"),
+                        self._to_signed(x.get("phash")),
+                        self._to_signed(x.get("simhash")),
+                        time.time(),
+                    )
+                    for x in fingerprints
+                ],
+            )
+            self._load()
+
+    def link(self, receipt_id: str, duplicate_of: str, reason: str) -> None:
+
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO duplicates "
+                "(receipt_id, duplicate_of, reason, created_at) VALUES (?, ?, ?, ?)",
+                (receipt_id, duplicate_of, reason, time.time()),
+            )
+            self.n_linked += 1
+
+    def linked_ids(self) -> set:
+
+        with self._lock:
+            rows = self.connection.execute("SELECT receipt_id FROM duplicates")
+            return set(row[0] for row in rows.fetchall())
+
+    def duplicates(self) -> dict:
+        """Map of each duplicate receipt id to the id of the receipt it copies"""
+
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT receipt_id, duplicate_of FROM duplicates"
+            ).fetchall()
+        return dict(rows)
+
+    def fingerprint(self, receipt_id: str, md5: str, prepared_data: dict) -> dict:
+        """Fingerprint a receipt from the data prepared for the LLM"""
+
+        text = prepared_data.get("extracted_text") or ""
+        image = prepared_data.get("image")
+        return {
+            "receipt_id": receipt_id,
+            "md5": md5,
+            "phash": perceptual_hash(image) if image is not None else None,
+            "simhash": (
+                simhash(text) if len(text.strip()) >= self.min_text_length else None
+            ),
+        }
+
+    def stats(self) -> dict:
+
+        return {"indexed": len(self.ids), "linked": self.n_linked}
+
+    def find_by_md5(self, md5: str):
+
+        if not md5:
+            return None
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT receipt_id FROM fingerprints WHERE md5 = ? LIMIT 1", (md5,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def find_near_duplicate(self, fingerprint: dict):
+        """Return (receipt_id, reason) of the closest indexed match, or None"""
+
+        with self._lock:
+            ids = self.ids
+            phashes, has_phash = self.phashes, self.has_phash
+            simhashes, has_simhash = self.simhashes, self.has_simhash
+        if not ids:
+            return None
+
+        candidates = np.array([x != fingerprint["receipt_id"] for x in ids], dtype=bool)
+        if fingerprint["simhash"] is not None:
+            distances = hamming_distances(simhashes, fingerprint["simhash"])
+            matches = candidates & has_simhash & (distances <= self.simhash_distance)
+            if matches.any():
+                best = np.flatnonzero(matches)[np.argmin(distances[matches])]
+                return ids[best], "simhash"
+        if fingerprint["phash"] is not None:
+            distances = hamming_distances(phashes, fingerprint["phash"])
+            matches = candidates & has_phash & (distances <= self.phash_distance)
+            # image hashes only decide between receipts without comparable text
+            if fingerprint["simhash"] is not None:
+                matches &= ~has_simhash
+            if matches.any():
+                best = np.flatnonzero(matches)[np.argmin(distances[matches])]
+                return ids[best], "phash"
+        return None
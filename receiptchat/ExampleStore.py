@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import threading
+from typing import List
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class ExampleStore:
+    """Append-only store of the vision extractions used as few-shot examples.
+
+    Each example is appended to a JSON Lines file as one line, so adding examples
+    never rewrites the ones already stored, and a run that stops part way keeps what
+    it added. An example appended again for the same file replaces the earlier one
+    when loaded. Examples in the example_extractions.json list written by earlier
+    versions are read before the appended ones.
+    """
+
+    STORE_PATH = os.path.join(
+        os.path.dirname(__file__), "datasets", "example_extractions.jsonl"
+    )
+    LEGACY_PATH = os.path.join(
+        os.path.dirname(__file__), "datasets", "example_extractions.json"
+    )
+
+    def __init__(self, store_path: str = None, legacy_path: str = None):
+
+        self.store_path = store_path or self.STORE_PATH
+        self.legacy_path = legacy_path or self.LEGACY_PATH
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+
+        return os.path.exists(self.store_path) or os.path.exists(self.legacy_path)
+
+    def _read_appended(self) -> List[dict]:
+
+        if not os.path.exists(self.store_path):
+            return []
+        examples = []
+        with open(self.store_path) as f:
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    examples.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # a run stopped part way through writing its last line
+                    logging.warning(
+                        "Skipping unreadable example on line {} of {}".format(
+                            i + 1, self.store_path
+                        )
+                    )
+        return examples
+
+    def load(self) -> List[dict]:
+        """The stored examples, in the order they were first added"""
+
+        examples = []
+        if os.path.exists(self.legacy_path):
+            with open(self.legacy_path) as f:
+                examples = json.load(f)
+        examples += self._read_appended()
+
+        by_file_id = {}
+        for example in examples:
+            by_file_id[example["file_details"]["file_id"]] = example
+        return list(by_file_id.values())
+
+    def file_ids(self) -> set:
+
+        return {x["file_details"]["file_id"] for x in self.load()}
+
+    def _ends_with_newline(self) -> bool:
+
+        with open(self.store_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def append(self, examples: List[dict]) -> None:
+
+        if not examples:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+            with open(self.store_path, "a") as f:
+                if f.tell() and not self._ends_with_newline():
+                    # finish a line left torn by a run that stopped part way
+                    f.write("\n")
+                for example in examples:
+                    f.write(json.dumps(example) + "\n")
@@ -1,82 +1,788 @@
-import logging
+from __future__ import annotations
 
-import pandas as pd
+import logging
+import os
+from functools import cached_property
+from typing import TYPE_CHECKING, List
 
 from receiptchat.gdrive.GoogleDriveService import GoogleDriveService
 from receiptchat.gdrive.GoogleDriveLoader import GoogleDriveLoader
-from receiptchat.openai.TextReceiptExtractor import TextReceiptExtractor
-from receiptchat.openai.VisionReceiptExtractor import VisionReceiptExtractor
+from receiptchat.gdrive.DownloadCache import DownloadCache
+from receiptchat.gdrive.GoogleDriveChangeFeed import GoogleDriveChangeFeed
 from receiptchat.data_transformations.ReceiptDatabaseHandler import (
     ReceiptDataBaseHandler,
 )
-from typing import List
+from receiptchat.data_transformations.ReceiptSQLiteDatabaseHandler import (
+    ReceiptSQLiteDataBaseHandler,
+)
+from receiptchat.ReceiptParsePipeline import ReceiptParsePipeline
+from receiptchat.RunJournal import RunJournal
+from receiptchat.RunMetrics import RunMetrics
+
+# langchain, openai, pandas and the OCR and imaging libraries are slow to import and
+# not needed when there is nothing new to parse, so everything that uses them is
+# imported and built on first use
+if TYPE_CHECKING:
+    import pandas as pd
+    from receiptchat.data_transformations.OCREngine import OCREngine
+    from receiptchat.data_transformations.ReceiptImagePreprocessor import (
+        ReceiptImagePreprocessor,
+    )
+    from receiptchat.openai.BatchClient import OpenAIBatchClient
 
 
 class ReceiptParseDriver:
 
-    def __init__(self, secrets: dict, load_database_on_init: bool = True):
+    # every download thread builds its own Drive service, and the loader bounds the
+    # bytes in flight. Convert threads hand OCR to the OCREngine process pool, so use
+    # one per core
+    DEFAULT_STAGE_CONCURRENCY = {
+        "download": 8,
+        "convert": os.cpu_count() or 2,
+        "llm": 4,
+    }
+    DATABASE_BACKENDS = {
+        "csv": ReceiptDataBaseHandler,
+        "sqlite": ReceiptSQLiteDataBaseHandler,
+    }
+    MODELS = ("text", "vision", "cascade")
+
+    def __init__(
+        self,
+        secrets: dict,
+        load_database_on_init: bool = True,
+        stage_concurrency: dict = None,
+        queue_size: int = 16,
+        use_download_cache: bool = True,
+        use_response_cache: bool = True,
+        use_artifact_store: bool = True,
+        compact_text: bool = True,
+        measure_compaction: bool = True,
+        database_backend: str = "csv",
+        max_attempts: int = 3,
+        journal_path: str = None,
+        ocr_engine: OCREngine = None,
+        image_preprocessor: ReceiptImagePreprocessor = None,
+        n_examples: int = None,
+        metrics_dir: str = None,
+        gdrive_service=None,
+        gdrive_service_factory=None,
+        llms: dict = None,
+        batch_client: OpenAIBatchClient = None,
+        rate_limits: dict = None,
+        detect_duplicates: bool = True,
+        track_spend: bool = True,
+    ):
 
-        self.gdrive_service = GoogleDriveService().build()
-        self.gdrive_loader = GoogleDriveLoader(self.gdrive_service)
-        self.database_handler = ReceiptDataBaseHandler(
-            load_database_on_init=load_database_on_init
+        # shared by every component so that one run is reported in one place
+        self.metrics = RunMetrics()
+        self.metrics_dir = metrics_dir
+        # a Drive service and chat models can be passed in, e.g. local stand-ins. Without
+        # a factory, a Drive service passed in is shared by the download threads
+        if gdrive_service is None:
+            drive_service = GoogleDriveService()
+            gdrive_service = drive_service.build()
+            gdrive_service_factory = gdrive_service_factory or drive_service.build
+        self.gdrive_service = gdrive_service
+        self.llms = llms or {}
+        self.download_cache = DownloadCache() if use_download_cache else None
+        self.gdrive_loader = GoogleDriveLoader(
+            self.gdrive_service,
+            cache=self.download_cache,
+            metrics=self.metrics,
+            service_factory=gdrive_service_factory,
         )
-        self.vision_extractor = VisionReceiptExtractor(
-            self.gdrive_loader, api_key=secrets["OPENAI_API_KEY"]
+        self.change_feed = GoogleDriveChangeFeed(self.gdrive_loader)
+        if database_backend not in self.DATABASE_BACKENDS:
+            raise ValueError(
+                "database_backend must be one of {}".format(
+                    list(self.DATABASE_BACKENDS)
+                )
+            )
+        self.database_handler = self.DATABASE_BACKENDS[database_backend](
+            load_database_on_init=load_database_on_init, metrics=self.metrics
         )
-        self.text_extractor = TextReceiptExtractor(
-            self.gdrive_loader, api_key=secrets["OPENAI_API_KEY"]
+        self.use_response_cache = use_response_cache
+        self.use_artifact_store = use_artifact_store
+        self.compact_text = compact_text
+        self.measure_compaction = measure_compaction
+        self._ocr_engine = ocr_engine
+        self.image_preprocessor = image_preprocessor
+        self.n_examples = n_examples
+        # {model: {"rpm": ..., "tpm": ...}}, e.g. RequestScheduler.TIER_1_LIMITS. Without
+        # them requests are not throttled, and rate limit errors are backed off
+        self.rate_limits = rate_limits
+        self.detect_duplicates = detect_duplicates
+        self.track_spend = track_spend
+        self.stage_concurrency = dict(self.DEFAULT_STAGE_CONCURRENCY)
+        if stage_concurrency:
+            self.stage_concurrency.update(stage_concurrency)
+        self.queue_size = queue_size
+        self.run_journal = RunJournal(journal_path, max_attempts=max_attempts)
+        # fingerprints of this run's receipts, by id, until they are written
+        self.pending_fingerprints = {}
+        # duplicates found this run, by id, until the run writes to the database, so
+        # that a run that does not write leaves no trace of them
+        self.pending_links = {}
+        # only needed for update_database(batch=True), so made on first use if not given
+        self.batch_client = batch_client
+        self.openai_api_key = secrets["OPENAI_API_KEY"]
+
+    def is_built(self, name: str) -> bool:
+        """Whether the lazily built attribute name has been built yet"""
+
+        return name in self.__dict__
+
+    @cached_property
+    def response_cache(self):
+
+        if not self.use_response_cache:
+            return None
+        from receiptchat.openai.ResponseCache import ResponseCache
+
+        return ResponseCache()
+
+    @cached_property
+    def artifact_store(self):
+
+        if not self.use_artifact_store:
+            return None
+        from receiptchat.data_transformations.ArtifactStore import ArtifactStore
+
+        return ArtifactStore()
+
+    @cached_property
+    def text_compactor(self):
+
+        if not self.compact_text:
+            return None
+        from receiptchat.data_transformations.TextCompactor import TextCompactor
+
+        return TextCompactor(measure_tokens=self.measure_compaction)
+
+    @cached_property
+    def ocr_engine(self) -> OCREngine:
+
+        # the process pool is only started once the first image is OCR'd
+        if self._ocr_engine is not None:
+            return self._ocr_engine
+        from receiptchat.data_transformations.OCREngine import OCREngine
+
+        return OCREngine()
+
+    @cached_property
+    def scheduler(self):
+
+        from receiptchat.openai.RequestScheduler import RequestScheduler
+
+        # one scheduler for both extractors, so they share the limits of each model
+        return RequestScheduler(limits=self.rate_limits, metrics=self.metrics)
+
+    @cached_property
+    def duplicate_index(self):
+
+        if not self.detect_duplicates:
+            return None
+        from receiptchat.DuplicateIndex import DuplicateIndex
+
+        return DuplicateIndex()
+
+    @cached_property
+    def spend_aggregates(self):
+
+        if not self.track_spend:
+            return None
+        from receiptchat.SpendAggregates import SpendAggregates
+
+        return SpendAggregates()
+
+    @cached_property
+    def vision_extractor(self):
+
+        from receiptchat.openai.VisionReceiptExtractor import VisionReceiptExtractor
+
+        return VisionReceiptExtractor(
+            self.gdrive_loader,
+            api_key=self.openai_api_key,
+            response_cache=self.response_cache,
+            ocr_engine=self.ocr_engine,
+            preprocessor=self.image_preprocessor,
+            metrics=self.metrics,
+            llm=self.llms.get("vision"),
+            scheduler=self.scheduler,
+            artifact_store=self.artifact_store,
         )
 
-    def find_new_files(self):
+    @cached_property
+    def text_extractor(self):
+
+        from receiptchat.openai.TextReceiptExtractor import TextReceiptExtractor
 
-        files = self.gdrive_loader.search_for_files()
-        new_files = self.database_handler.find_new_ids(files)
-        return new_files
+        return TextReceiptExtractor(
+            self.gdrive_loader,
+            api_key=self.openai_api_key,
+            response_cache=self.response_cache,
+            ocr_engine=self.ocr_engine,
+            n_examples=self.n_examples,
+            metrics=self.metrics,
+            llm=self.llms.get("text"),
+            scheduler=self.scheduler,
+            artifact_store=self.artifact_store,
+            text_compactor=self.text_compactor,
+        )
 
-    def text_parse_new_files(self, files: List) -> List:
+    @cached_property
+    def cascade_extractor(self):
 
-        collected_data = []
+        from receiptchat.openai.CascadeReceiptExtractor import CascadeReceiptExtractor
+
+        return CascadeReceiptExtractor(
+            self.text_extractor, self.vision_extractor, metrics=self.metrics
+        )
+
+    def skip_duplicates(self, files: List) -> List:
+        """
+        Drop files already linked as duplicates, and link and drop byte for byte copies
+        of parsed receipts, which can be spotted from their Drive checksum alone
+        """
+
+        if not files or self.duplicate_index is None:
+            return files
+
+        linked_ids = self.duplicate_index.linked_ids()
+        remaining_files = []
         for file in files:
-            result, cb = self.text_extractor.parse(file)
-            collected_data.append(result)
+            if file["id"] in linked_ids:
+                continue
+            duplicate_of = self.duplicate_index.find_by_md5(file.get("md5Checksum"))
+            if duplicate_of is not None and duplicate_of != file["id"]:
+                self.add_pending_link(file["id"], duplicate_of, "md5")
+                continue
+            remaining_files.append(file)
+        return remaining_files
 
-        return collected_data
+    def add_pending_link(self, receipt_id: str, duplicate_of: str, reason: str) -> None:
 
-    def vision_parse_new_files(self, files: List) -> List:
+        logging.info(
+            "{} is a duplicate of {} ({}), not parsing it".format(
+                receipt_id, duplicate_of, reason
+            )
+        )
+        self.pending_links[receipt_id] = (duplicate_of, reason)
+
+    def link_duplicates(self) -> None:
+        """Persist the duplicates found so far, which later runs then skip"""
+
+        if self.duplicate_index is None:
+            return
+        for receipt_id in list(self.pending_links):
+            self.duplicate_index.link(receipt_id, *self.pending_links.pop(receipt_id))
+
+    def index_parsed(self, collected_data: List) -> None:
+
+        if self.duplicate_index is None:
+            return
+        self.link_duplicates()
+        self.duplicate_index.add(
+            [
+                self.pending_fingerprints.pop(x["file_details"]["file_id"])
+                for x in collected_data
+                if x["file_details"]["file_id"] in self.pending_fingerprints
+            ]
+        )
+
+    def aggregate_spend(self, new_pdf: pd.DataFrame) -> None:
+        """Add newly written receipts to the spend totals"""
+
+        if self.spend_aggregates is None:
+            return
+        if self.spend_aggregates.is_empty():
+            # first use with an existing database, count everything written before
+            self.spend_aggregates.add(self.database_handler.load_database())
+        self.spend_aggregates.add(new_pdf)
+
+    def find_new_files(self, incremental: bool = False):
+
+        if not incremental:
+            with self.metrics.time_stage("discovery"):
+                files = self.gdrive_loader.search_for_files()
+                new_files = self.skip_duplicates(
+                    self.database_handler.find_new_ids(files)
+                )
+            return new_files
+
+        with self.metrics.time_stage("discovery"):
+            changed_files = self.change_feed.find_changed_files()
+        if changed_files is None:
+            return None
+
+        # modified receipts are already in the database but need to be parsed again
+        modified_files = [f for f in changed_files if f["modified"]]
+        new_files = self.skip_duplicates(
+            self.database_handler.find_new_ids(
+                [f for f in changed_files if not f["modified"]]
+            )
+        )
+        return new_files + modified_files
+
+    def download_file(self, extractor, file: dict) -> dict:
+
+        file_data = extractor.download_file_from_gdrive(file)
+        file_data["md5"] = file.get("md5Checksum")
+        return file_data
+
+    def prepare_file(self, extractor, file_data: dict) -> tuple:
+        """
+        Convert a downloaded file for the extractor and look for an already parsed copy.
+        Returns (file_data, image_data, duplicate_of)
+        """
+
+        image_data = extractor.prepare_data_for_llm(file_data)
+        if self.duplicate_index is None:
+            return file_data, image_data, None
+
+        with self.metrics.time_stage("dedup", file_data["id"]):
+            fingerprint = self.duplicate_index.fingerprint(
+                file_data["id"], file_data.get("md5"), image_data
+            )
+            match = self.duplicate_index.find_near_duplicate(fingerprint)
+        if match is not None:
+            self.add_pending_link(file_data["id"], *match)
+            return file_data, image_data, match[0]
+
+        # indexed once the parsed receipt is written to the database
+        self.pending_fingerprints[file_data["id"]] = fingerprint
+        return file_data, image_data, None
+
+    def finish_file(self, extractor, prepared: tuple, batch: bool = False):
+        """
+        Parse a prepared file, or with batch render its Batch API request. Returns None
+        for duplicates, which are not sent to the model
+        """
+
+        file_data, image_data, duplicate_of = prepared
+        if duplicate_of is not None:
+            return None
+        if batch:
+            return extractor.render_batch_request_prepared(file_data, image_data)
+        result, cb = extractor.parse_prepared(file_data, image_data)
+        return result
+
+    def process_file(self, extractor, file: dict, batch: bool = False):
+
+        file_data = self.download_file(extractor, file)
+        return self.finish_file(
+            extractor, self.prepare_file(extractor, file_data), batch
+        )
+
+    def build_pipeline(self, extractor, batch: bool = False) -> ReceiptParsePipeline:
+
+        def download(file):
+            return self.download_file(extractor, file)
+
+        def convert(file_data):
+            return self.prepare_file(extractor, file_data)
+
+        def finish(prepared):
+            return self.finish_file(extractor, prepared, batch)
+
+        return ReceiptParsePipeline(
+            [
+                ("download", download, self.stage_concurrency["download"]),
+                ("convert", convert, self.stage_concurrency["convert"]),
+                (
+                    ("render", finish, 1)
+                    if batch
+                    else ("llm", finish, self.stage_concurrency["llm"])
+                ),
+            ],
+            queue_size=self.queue_size,
+        )
+
+    @classmethod
+    def check_model(cls, model: str) -> None:
+
+        if model not in cls.MODELS:
+            raise ValueError("model must be one of {}".format(list(cls.MODELS)))
+
+    def get_extractor(self, model: str):
+
+        self.check_model(model)
+        if model == "text":
+            return self.text_extractor
+        if model == "cascade":
+            return self.cascade_extractor
+        return self.vision_extractor
+
+    def parse_new_files(self, files: List, extractor, pipelined: bool = False) -> List:
+        """Parse files, leaving out duplicates of receipts that were already parsed"""
+
+        if pipelined:
+            results = self.build_pipeline(extractor).run(files)
+        else:
+            results = [self.process_file(extractor, file) for file in files]
+
+        return [result for result in results if result is not None]
+
+    def iter_parsed_files(
+        self, files: List, extractor, pipelined: bool = False, batch: bool = False
+    ):
+        """
+        Yield (file, result, error) for each file as it finishes. Unlike parse_new_files,
+        a file that fails does not stop the others. With batch, the result is the
+        (file_details, request) to submit rather than the parsed receipt. The result
+        and error are both None for duplicates
+        """
+
+        if pipelined:
+            pipeline = self.build_pipeline(extractor, batch=batch)
+            for index, output in pipeline.iter_results(files, return_exceptions=True):
+                if isinstance(output, Exception):
+                    yield files[index], None, output
+                else:
+                    yield files[index], output, None
+            return
 
-        collected_data = []
         for file in files:
-            result, cb = self.vision_extractor.parse(file)
-            collected_data.append(result)
+            try:
+                result = self.process_file(extractor, file, batch)
+            except Exception as e:
+                yield file, None, e
+                continue
+            yield file, result, None
+
+    def text_parse_new_files(self, files: List, pipelined: bool = False) -> List:
+
+        return self.parse_new_files(files, self.text_extractor, pipelined=pipelined)
+
+    def vision_parse_new_files(self, files: List, pipelined: bool = False) -> List:
+
+        return self.parse_new_files(files, self.vision_extractor, pipelined=pipelined)
+
+    def get_batch_client(self):
+
+        if self.batch_client is None:
+            from receiptchat.openai.BatchClient import OpenAIBatchClient
 
+            self.batch_client = OpenAIBatchClient(api_key=self.openai_api_key)
+        return self.batch_client
+
+    def parse_batch_results(self, extractor, rendered: dict, results: dict) -> tuple:
+        """
+        Parse the batch result of each rendered (file, (file_details, request)), by file
+        id. Files without a usable result are recorded in the run journal. Returns the
+        parsed results and the number of files that failed
+        """
+
+        collected_data = []
+        n_failed = 0
+        for file_id, (file, (file_details, request)) in rendered.items():
+            try:
+                parsed_result, cb = extractor.parse_batch_result(
+                    file_details, request, results.get(file_id)
+                )
+            except Exception as e:
+                self.run_journal.record_failure(file, e)
+                n_failed += 1
+                continue
+            collected_data.append(parsed_result)
+        return collected_data, n_failed
+
+    def batch_parse_new_files(
+        self, files: List, extractor, model: str, pipelined: bool = False
+    ) -> List:
+        """
+        Parse files through the Batch API. Every file is downloaded and converted and its
+        request rendered, then all requests are submitted together and the results are
+        mapped back to the files by id. Files that fail at any point are recorded in the
+        run journal and retried by the next run. The requests and the batches they are
+        submitted in are recorded too, so that a run stopped while they are in flight
+        is collected by resume_batches instead of being submitted again
+        """
+
+        rendered = {}
+        n_failed = 0
+        for file, output, error in self.iter_parsed_files(
+            files, extractor, pipelined, batch=True
+        ):
+            if error is not None:
+                # recorded before the batch is submitted, which may fail or expire
+                self.run_journal.record_failure(file, error)
+                n_failed += 1
+            elif output is not None:
+                rendered[file["id"]] = (file, output)
+
+        run_id = self.metrics.run_id
+        self.run_journal.record_batch_requests(
+            run_id,
+            model,
+            {
+                file_id: {
+                    "file": file,
+                    "file_details": file_details,
+                    "cache_key": request["cache_key"],
+                }
+                for file_id, (file, (file_details, request)) in rendered.items()
+                if "body" in request
+            },
+        )
+        requests = (
+            (file_id, request["body"])
+            for file_id, (file, (file_details, request)) in rendered.items()
+            if "body" in request
+        )
+        with self.metrics.time_stage("batch"):
+            results = self.get_batch_client().run(
+                requests,
+                name=run_id,
+                on_submit=lambda batch_id, input_file_id: self.run_journal.record_batch(
+                    run_id, batch_id, input_file_id
+                ),
+            )
+        collected_data, n_parse_failed = self.parse_batch_results(
+            extractor, rendered, results
+        )
+        self.metrics.set_gauge("failed_files", n_failed + n_parse_failed)
         return collected_data
 
+    def resume_batches(self, extractor, model: str) -> tuple:
+        """
+        Collect the batches of model submitted by earlier runs whose results were not
+        written. Returns the parsed results and the ids of the runs they came from
+        """
+
+        collected_data = []
+        run_ids = []
+        n_failed = 0
+        for run in self.run_journal.pending_batch_runs(model):
+            run_ids.append(run["run_id"])
+            logging.info(
+                "Resuming {} batches of run {}".format(
+                    len(run["batch_ids"]), run["run_id"]
+                )
+            )
+            with self.metrics.time_stage("batch"):
+                results = self.get_batch_client().collect(
+                    run["batch_ids"], raise_on_failure=False
+                )
+            rendered = {
+                file_id: (
+                    entry["file"],
+                    (entry["file_details"], {"cache_key": entry["cache_key"]}),
+                )
+                for file_id, entry in run["requests"].items()
+            }
+            parsed, n_run_failed = self.parse_batch_results(
+                extractor, rendered, results
+            )
+            collected_data += parsed
+            n_failed += n_run_failed
+        if run_ids:
+            self.metrics.set_gauge("resumed_batch_runs", len(run_ids))
+            self.metrics.set_gauge("resumed_files", len(collected_data))
+            self.metrics.set_gauge("resumed_failed_files", n_failed)
+        return collected_data, run_ids
+
+    def commit_batch(self, collected_data: List) -> pd.DataFrame:
+
+        new_pdf = self.json_to_pd(collected_data)
+        updated_pdf = self.database_handler.commit_to_database(new_pdf)
+        self.run_journal.record_successes(
+            [x["file_details"]["file_id"] for x in collected_data]
+        )
+        self.index_parsed(collected_data)
+        self.aggregate_spend(new_pdf)
+        logging.info("Committed {} parsed receipts".format(len(collected_data)))
+        return updated_pdf
+
+    def checkpointed_parse_new_files(
+        self, files: List, extractor, batch_size: int, pipelined: bool = False
+    ) -> pd.DataFrame:
+
+        updated_pdf = None
+        batch = []
+        n_failed = 0
+        for file, result, error in self.iter_parsed_files(files, extractor, pipelined):
+            if error is not None:
+                self.run_journal.record_failure(file, error)
+                n_failed += 1
+                continue
+            if result is None:
+                continue
+
+            batch.append(result)
+            if len(batch) >= batch_size:
+                updated_pdf = self.commit_batch(batch)
+                batch = []
+
+        if batch:
+            updated_pdf = self.commit_batch(batch)
+        # duplicates found after the last commit
+        self.link_duplicates()
+
+        self.metrics.set_gauge("failed_files", n_failed)
+        if n_failed:
+            logging.warning(
+                "{} files failed and were recorded in the run journal".format(n_failed)
+            )
+        return updated_pdf
+
+    def add_retryable_files(self, files: List) -> List:
+
+        exhausted_ids = self.run_journal.exhausted_ids()
+        if exhausted_ids:
+            logging.warning(
+                "Skipping {} files that reached the maximum number of attempts".format(
+                    len(exhausted_ids)
+                )
+            )
+
+        file_ids = set(file["id"] for file in files)
+        retryable_files = [
+            file
+            for file in self.run_journal.retryable_files()
+            if file["id"] not in file_ids
+        ]
+        return [
+            file for file in files + retryable_files if file["id"] not in exhausted_ids
+        ]
+
     def json_to_pd(self, collected_data: List) -> pd.DataFrame:
 
-        new_pd = self.database_handler.convert_json_to_pandas(collected_data)
+        with self.metrics.time_stage("to_pandas"):
+            new_pd = self.database_handler.convert_json_to_pandas(collected_data)
         return new_pd
 
-    def update_database(self, model="text", write_to_db=False):
+    def report_run(self, model: str) -> dict:
+
+        if self.download_cache is not None:
+            for name, value in self.download_cache.stats().items():
+                self.metrics.set_gauge("download_cache_" + name, value)
+        for name, value in self.gdrive_loader.stats().items():
+            self.metrics.set_gauge("download_" + name, value)
+        if self.response_cache is not None:
+            for name, value in self.response_cache.stats().items():
+                self.metrics.set_gauge("llm_response_cache_" + name, value)
+        # only report on what this run built
+        if self.is_built("artifact_store") and self.artifact_store is not None:
+            for name, value in self.artifact_store.stats().items():
+                self.metrics.set_gauge("artifact_store_" + name, value)
+        if self.is_built("text_compactor") and self.text_compactor is not None:
+            for name, value in self.text_compactor.stats().items():
+                self.metrics.set_gauge("text_compaction_" + name, value)
+        if self.is_built("scheduler"):
+            for name, value in self.scheduler.stats().items():
+                self.metrics.set_gauge("llm_scheduler_" + name, value)
+        if self.is_built("duplicate_index") and self.duplicate_index is not None:
+            for name, value in self.duplicate_index.stats().items():
+                self.metrics.set_gauge("duplicates_" + name, value)
+        if self.is_built("ocr_engine"):
+            for name, value in self.ocr_engine.stats().items():
+                self.metrics.set_gauge("ocr_" + name, value)
+        if self.is_built("cascade_extractor"):
+            for name, value in self.cascade_extractor.stats().items():
+                self.metrics.set_gauge("cascade_" + name, value)
+        if model in ("text", "cascade") and self.is_built("text_extractor"):
+            example_selector = self.text_extractor.extractor.example_selector
+            if example_selector is not None:
+                for name, value in example_selector.stats().items():
+                    self.metrics.set_gauge("example_selection_" + name, value)
 
-        files_to_parse = self.find_new_files()
+        summary = self.metrics.summary()
+        logging.info(
+            "Run {} metrics: {}".format(
+                summary["run_id"],
+                {k: v for k, v in summary.items() if k != "per_file"},
+            )
+        )
+        if self.metrics_dir is not None:
+            self.metrics.write(self.metrics_dir)
+        return summary
 
-        if not files_to_parse:
+    def update_database(
+        self,
+        model="text",
+        write_to_db=False,
+        pipelined=False,
+        incremental=False,
+        checkpoint_batch_size=None,
+        batch=False,
+    ):
+
+        self.check_model(model)
+        if checkpoint_batch_size is not None and not write_to_db:
+            raise ValueError("checkpoint_batch_size requires write_to_db=True")
+        if checkpoint_batch_size is not None and batch:
+            raise ValueError("checkpoint_batch_size cannot be used with batch=True")
+        if model == "cascade" and batch:
+            # escalation depends on the text result, which a batch only returns later
+            raise ValueError("The cascade model cannot be used with batch=True")
+
+        self.metrics.start_run()
+        self.pending_fingerprints = {}
+        self.pending_links = {}
+
+        files_to_parse = self.find_new_files(incremental=incremental)
+        if (checkpoint_batch_size is not None or batch) and files_to_parse is not None:
+            files_to_parse = self.add_retryable_files(files_to_parse)
+
+        resumed_data, resumed_run_ids = [], []
+        if batch:
+            resumed_data, resumed_run_ids = self.resume_batches(
+                self.get_extractor(model), model
+            )
+            resumed_ids = {x["file_details"]["file_id"] for x in resumed_data}
+            if files_to_parse:
+                files_to_parse = [
+                    x for x in files_to_parse if x["id"] not in resumed_ids
+                ]
+
+        if not files_to_parse and not resumed_data:
             logging.info(
                 "No new files to parse! Database already contains all the files in the google drive"
             )
+            if write_to_db:
+                # copies of parsed receipts spotted by their checksum
+                self.link_duplicates()
+                # runs whose batches all failed, which left nothing to write
+                self.run_journal.clear_batch_runs(resumed_run_ids)
+            if incremental and files_to_parse is not None:
+                self.change_feed.commit()
             return
 
-        if model == "text":
-            parsed_data = self.text_parse_new_files(files_to_parse)
-        elif model == "vision":
-            parsed_data = self.vision_parse_new_files(files_to_parse)
+        extractor = self.get_extractor(model)
+        if checkpoint_batch_size is not None:
+            updated_pdf = self.checkpointed_parse_new_files(
+                files_to_parse, extractor, checkpoint_batch_size, pipelined
+            )
         else:
-            raise ValueError("model must be text or vision")
+            if batch:
+                parsed_data = resumed_data
+                if files_to_parse:
+                    parsed_data += self.batch_parse_new_files(
+                        files_to_parse, extractor, model, pipelined
+                    )
+            else:
+                parsed_data = self.parse_new_files(files_to_parse, extractor, pipelined)
+            new_pdf = self.json_to_pd(parsed_data)
+            updated_pdf = self.database_handler.update_database(new_pdf)
+            if write_to_db:
+                self.database_handler.write_to_database(updated_pdf)
+                self.index_parsed(parsed_data)
+                self.aggregate_spend(new_pdf)
+                if batch:
+                    # clear any earlier failures of files that parsed this time
+                    self.run_journal.record_successes(
+                        [x["file_details"]["file_id"] for x in parsed_data]
+                    )
+                    # the results are written, so later runs need not collect them
+                    # again. A run that does not write leaves them to the next one
+                    self.run_journal.clear_batch_runs(
+                        resumed_run_ids + [self.metrics.run_id]
+                    )
 
-        new_pdf = self.json_to_pd(parsed_data)
-        updated_pdf = self.database_handler.update_database(new_pdf)
+        self.report_run(model)
 
-        if write_to_db:
-            self.database_handler.write_to_database(updated_pdf)
+        if write_to_db and incremental:
+            self.change_feed.commit()
         return updated_pdf
@@ -1,8 +1,11 @@
 from receiptchat.gdrive.GoogleDriveService import GoogleDriveService
 from receiptchat.gdrive.GoogleDriveLoader import GoogleDriveLoader
-from receiptchat.openai.VisionReceiptExtractor import VisionRecieptExtractor
-import os
-import json
+from receiptchat.gdrive.DownloadCache import DownloadCache
+from receiptchat.openai.VisionReceiptExtractor import VisionReceiptExtractor
+from receiptchat.openai.ExampleCurator import ExampleCurator
+from receiptchat.ExampleStore import ExampleStore
+from receiptchat.data_transformations.ArtifactStore import ArtifactStore
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List
 import logging
 
@@ -11,36 +14,41 @@ logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
 class ReceiptParseExamplesGenerator:
 
-    EXAMPLES_PATH = os.path.join(
-        os.path.dirname(__file__), "datasets", "example_extractions.json"
-    )
-
-    def __init__(self, secrets: dict):
-
-        if not os.path.isdir(os.path.dirname(self.EXAMPLES_PATH)):
-            logging.info(
-                "Making database path {}".format(os.path.dirname(self.EXAMPLES_PATH))
-            )
-            os.mkdir(os.path.dirname(self.EXAMPLES_PATH))
-
-        self.gdrive_service = GoogleDriveService().build()
-        self.gdrive_loader = GoogleDriveLoader(self.gdrive_service)
-        self.vision_extractor = VisionRecieptExtractor(
-            self.gdrive_loader, api_key=secrets["OPENAI_API_KEY"]
+    def __init__(
+        self,
+        secrets: dict,
+        use_download_cache: bool = True,
+        use_artifact_store: bool = True,
+        example_store: ExampleStore = None,
+        curator: ExampleCurator = None,
+        concurrency: int = 4,
+    ):
+
+        drive_service = GoogleDriveService()
+        self.gdrive_service = drive_service.build()
+        self.download_cache = DownloadCache() if use_download_cache else None
+        self.gdrive_loader = GoogleDriveLoader(
+            self.gdrive_service,
+            cache=self.download_cache,
+            service_factory=drive_service.build,
         )
+        # the OCR text and pages made here are reused by the driver's extractors
+        self.artifact_store = ArtifactStore() if use_artifact_store else None
+        self.vision_extractor = VisionReceiptExtractor(
+            self.gdrive_loader,
+            api_key=secrets["OPENAI_API_KEY"],
+            artifact_store=self.artifact_store,
+        )
+        self.example_store = example_store or ExampleStore()
+        self.curator = curator or ExampleCurator()
+        # files are downloaded, OCR'd and vision parsed this many at a time
+        self.concurrency = concurrency
 
         # load the examples
-        if os.path.exists(self.EXAMPLES_PATH):
-            with open(self.EXAMPLES_PATH) as f:
-                loaded_examples = json.load(f)
-
-            self.loaded_examples = loaded_examples
-            self.loaded_example_ids = set(
-                [x["file_details"]["file_id"] for x in self.loaded_examples]
-            )
-        else:
-            self.loaded_examples = []
-            self.loaded_example_ids = set([])
+        self.loaded_examples = self.example_store.load()
+        self.loaded_example_ids = set(
+            [x["file_details"]["file_id"] for x in self.loaded_examples]
+        )
 
     def find_new_files(self):
 
@@ -48,32 +56,104 @@ class ReceiptParseExamplesGenerator:
         new_files = [x for x in files if x["id"] not in self.loaded_example_ids]
         return new_files
 
+    def read_file(self, file: dict) -> dict:
+        """Download a file and OCR it, without rendering it for the vision model"""
+
+        file_data = self.vision_extractor.download_file_from_gdrive(file)
+        converter = self.vision_extractor.input_parsers[file_data["extension"]]
+        file_data["extracted_text"] = self.vision_extractor.extract_text(
+            converter, file_data["bytes"]
+        )
+        return file_data
+
+    @staticmethod
+    def file_name(file: dict) -> str:
+
+        # Drive file details have a name, read files a filename and extension
+        return file.get("name") or file["filename"] + file["extension"]
+
+    def _run_concurrently(self, function, files: List, description: str) -> List:
+
+        # a file that fails is logged and left out, the others carry on
+        results = {}
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            futures = {pool.submit(function, x): i for i, x in enumerate(files)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as error:
+                    logging.error(
+                        "Could not {} {}: {}".format(
+                            description, self.file_name(files[i]), error
+                        )
+                    )
+        return [results[i] for i in sorted(results)]
+
+    def read_files(self, files: List) -> List:
+
+        return self._run_concurrently(self.read_file, files, "read")
+
+    def vision_parse_file(self, file_data: dict) -> dict:
+
+        logging.info("Vision parse file {}".format(self.file_name(file_data)))
+        image_data = self.vision_extractor.prepare_data_for_llm(
+            file_data, extract_raw_text=False
+        )
+        image_data["extracted_text"] = file_data["extracted_text"]
+        result, cb = self.vision_extractor.parse_prepared(file_data, image_data)
+        # stored as soon as it is parsed, so a failed run keeps what it paid for
+        self.example_store.append([result])
+        return result
+
     def vision_parse_new_files(self, files: List) -> List:
+        """Vision parse files read by read_files, appending each to the example store"""
 
-        collected_data = []
         if not files:
             logging.info("No additional files available to add to examples!")
-            return collected_data
+            return []
 
-        for file in files:
-            logging.info("Vision parse file {}".format(file))
-            result, cb = self.vision_extractor.parse(file)
-            collected_data.append(result)
+        return self._run_concurrently(self.vision_parse_file, files, "vision parse")
 
-        return collected_data
+    def curate(self, files: List, n_update: int) -> List:
+        """The read files that add most to the examples, at most n_update of them"""
 
-    def update_examples(self, n_update: int = 10) -> None:
-
-        # choose just the first n new receipts as examples
-        files_to_parse = self.find_new_files()[:n_update]
+        selected = self.curator.select(
+            [x["extracted_text"] for x in files],
+            [x["file_details"]["extracted_text"] for x in self.loaded_examples],
+            n_update,
+        )
+        logging.info("Example curation: {}".format(self.curator.stats()))
+        return [files[i] for i in selected]
+
+    def update_examples(
+        self, n_update: int = 10, curate: bool = True, max_candidates: int = 200
+    ) -> None:
+        """
+        Vision parse up to n_update new files and add them to the examples. With
+        curate, up to max_candidates new files are read and the most diverse of them
+        are chosen, otherwise the first n_update new files are
+        """
+
+        new_files = self.find_new_files()
+        if curate:
+            files_to_parse = self.curate(
+                self.read_files(new_files[:max_candidates]), n_update
+            )
+        else:
+            files_to_parse = self.read_files(new_files[:n_update])
         logging.info(
-            "Selected the following files as examples: {}".format(files_to_parse)
+            "Selected the following files as examples: {}".format(
+                [self.file_name(x) for x in files_to_parse]
+            )
         )
 
         parsed_data = self.vision_parse_new_files(files_to_parse)
-        updated_examples = self.loaded_examples + parsed_data
-
-        logging.info("Updated examples: {}".format(updated_examples))
+        self.loaded_examples = self.example_store.load()
+        self.loaded_example_ids |= {x["file_details"]["file_id"] for x in parsed_data}
 
-        with open(self.EXAMPLES_PATH, "w") as final:
-            json.dump(updated_examples, final)
+        logging.info(
+            "Added {} examples, {} in total".format(
+                len(parsed_data), len(self.loaded_examples)
+            )
+        )
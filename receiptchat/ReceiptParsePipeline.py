@@ -0,0 +1,127 @@
+import logging
+import queue
+import threading
+from typing import Callable, List, Tuple
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class ReceiptParsePipeline:
+    """Run a list of stages over many items, overlapping the stages across items.
+
+    Each stage is a (name, function, n_workers) tuple. Every stage gets its own pool of
+    worker threads and stages are connected by bounded queues, so a slow stage applies
+    back pressure instead of letting work pile up in memory. Results are returned in
+    the order of the input items, so the output is identical to running the stages
+    one item at a time.
+    """
+
+    _SENTINEL = object()
+
+    def __init__(self, stages: List[Tuple[str, Callable, int]], queue_size: int = 16):
+
+        if not stages:
+            raise ValueError("At least one stage is required")
+        for name, _, n_workers in stages:
+            if n_workers < 1:
+                raise ValueError("Stage {} must have at least one worker".format(name))
+
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items: List) -> List:
+
+        results = dict(self.iter_results(items))
+        return [results[index] for index in sorted(results)]
+
+    def iter_results(self, items: List, return_exceptions: bool = False):
+        """
+        Yield (index, output) pairs in the order the items finish. With
+        return_exceptions, an item that fails yields its exception as the output and the
+        remaining items carry on, otherwise the first failure stops the run and is
+        raised once the stages have drained.
+        """
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        out_queue = queue.Queue()
+        errors = []
+        stop = threading.Event()
+        lock = threading.Lock()
+        remaining_workers = [n_workers for _, _, n_workers in self.stages]
+
+        def worker(stage_index: int):
+            name, function, _ = self.stages[stage_index]
+            in_queue = queues[stage_index]
+            is_last = stage_index == len(self.stages) - 1
+
+            while True:
+                entry = in_queue.get()
+                if entry is self._SENTINEL:
+                    break
+                index, value = entry
+                # after a failure keep draining the queue so upstream stages never block
+                if stop.is_set():
+                    continue
+                try:
+                    output = function(value)
+                except Exception as e:
+                    logging.error(
+                        "Stage {} failed on item {}: {}".format(name, index, e)
+                    )
+                    if return_exceptions:
+                        out_queue.put((index, e))
+                    else:
+                        with lock:
+                            errors.append(e)
+                        stop.set()
+                    continue
+
+                if is_last:
+                    out_queue.put((index, output))
+                else:
+                    queues[stage_index + 1].put((index, output))
+
+            # the last worker of a stage to finish shuts down the next stage
+            with lock:
+                remaining_workers[stage_index] -= 1
+                stage_done = remaining_workers[stage_index] == 0
+            if stage_done:
+                if is_last:
+                    out_queue.put(self._SENTINEL)
+                else:
+                    for _ in range(self.stages[stage_index + 1][2]):
+                        queues[stage_index + 1].put(self._SENTINEL)
+
+        def feed():
+            for index, item in enumerate(items):
+                if stop.is_set():
+                    break
+                queues[0].put((index, item))
+            for _ in range(self.stages[0][2]):
+                queues[0].put(self._SENTINEL)
+
+        threads = [threading.Thread(target=feed, name="feed", daemon=True)]
+        for stage_index, (name, _, n_workers) in enumerate(self.stages):
+            for n in range(n_workers):
+                threads.append(
+                    threading.Thread(
+                        target=worker,
+                        args=(stage_index,),
+                        name="{}-{}".format(name, n),
+                        daemon=True,
+                    )
+                )
+        for thread in threads:
+            thread.start()
+
+        while True:
+            entry = out_queue.get()
+            if entry is self._SENTINEL:
+                break
+            yield entry
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class RunJournal:
+    """Dead-letter record of files that failed to parse.
+
+    Parsed receipts are committed to the database in batches as a run progresses, so
+    a restarted run naturally skips them. Files that raised are recorded here with
+    their error and attempt count, and are retried by the next run until they either
+    succeed or reach max_attempts.
+
+    Batch API runs also record the batches they submit, with what is needed to parse
+    each file's result, until the results are written. A run stopped while a batch
+    is in flight is collected by the next batch run instead of being paid for again.
+    """
+
+    JOURNAL_PATH = os.path.join(os.path.dirname(__file__), "datasets", "run_journal.db")
+
+    def __init__(self, journal_path: str = None, max_attempts: int = 3):
+
+        self.journal_path = journal_path or self.JOURNAL_PATH
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+
+        # opened on first use, most runs never touch the journal
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+            connection = sqlite3.connect(self.journal_path, check_same_thread=False)
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS dead_letter ("
+                    "file_id TEXT PRIMARY KEY, file_details TEXT NOT NULL, "
+                    "error TEXT, attempts INTEGER NOT NULL, last_attempt REAL NOT NULL)"
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS batch_requests ("
+                    "run_id TEXT NOT NULL, model TEXT NOT NULL, file_id TEXT NOT NULL, "
+                    "request TEXT NOT NULL, PRIMARY KEY (run_id, file_id))"
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS batches ("
+                    "batch_id TEXT PRIMARY KEY, run_id TEXT NOT NULL, "
+                    "input_file_id TEXT NOT NULL, submitted_at REAL NOT NULL)"
+                )
+            self._connection = connection
+        return self._connection
+
+    def record_failure(self, file_details: dict, error: Exception) -> int:
+
+        message = "{}: {}".format(type(error).__name__, error)
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO dead_letter "
+                "(file_id, file_details, error, attempts, last_attempt) "
+                "VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (file_id) DO UPDATE SET "
+                "file_details = excluded.file_details, error = excluded.error, "
+                "attempts = attempts + 1, last_attempt = excluded.last_attempt",
+                (file_details["id"], json.dumps(file_details), message, time.time()),
+            )
+            attempts = self.connection.execute(
+                "SELECT attempts FROM dead_letter WHERE file_id = ?",
+                (file_details["id"],),
+            ).fetchone()[0]
+
+        logging.warning(
+            "Failed to parse {} (attempt {}): {}".format(
+                file_details.get("name"), attempts, message
+            )
+        )
+        return attempts
+
+    def record_successes(self, file_ids: List) -> None:
+
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM dead_letter WHERE file_id = ?",
+                [(file_id,) for file_id in file_ids],
+            )
+
+    def failures(self) -> List:
+
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT file_id, file_details, error, attempts, last_attempt "
+                "FROM dead_letter ORDER BY last_attempt"
+            ).fetchall()
+
+        return [
+            {
+                "file_id": file_id,
+                "file_details": json.loads(file_details),
+                "error": error,
+                "attempts": attempts,
+                "last_attempt": last_attempt,
+            }
+            for file_id, file_details, error, attempts, last_attempt in rows
+        ]
+
+    def retryable_files(self) -> List:
+
+        return [
+            failure["file_details"]
+            for failure in self.failures()
+            if failure["attempts"] < self.max_attempts
+        ]
+
+    def exhausted_ids(self) -> set:
+
+        return set(
+            failure["file_id"]
+            for failure in self.failures()
+            if failure["attempts"] >= self.max_attempts
+        )
+
+    def record_batch_requests(self, run_id: str, model: str, requests: dict) -> None:
+        """
+        Record the requests of a batch run before it is submitted, as a dict from file
+        id to a JSON serializable dict of what its result is parsed with
+        """
+
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO batch_requests (run_id, model, file_id, request) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (run_id, model, file_id, json.dumps(request))
+                    for file_id, request in requests.items()
+                ],
+            )
+
+    def record_batch(self, run_id: str, batch_id: str, input_file_id: str) -> None:
+
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO batches "
+                "(batch_id, run_id, input_file_id, submitted_at) VALUES (?, ?, ?, ?)",
+                (batch_id, run_id, input_file_id, time.time()),
+            )
+
+    def pending_batch_runs(self, model: str) -> List:
+        """The batch runs of model whose results were not written, oldest first"""
+
+        with self._lock:
+            batch_rows = self.connection.execute(
+                "SELECT run_id, batch_id FROM batches ORDER BY submitted_at"
+            ).fetchall()
+            request_rows = self.connection.execute(
+                "SELECT run_id, file_id, request FROM batch_requests WHERE model = ?",
+                (model,),
+            ).fetchall()
+
+        runs = {}
+        for run_id, file_id, request in request_rows:
+            run = runs.setdefault(
+                run_id, {"run_id": run_id, "batch_ids": [], "requests": {}}
+            )
+            run["requests"][file_id] = json.loads(request)
+        for run_id, batch_id in batch_rows:
+            if run_id in runs:
+                runs[run_id]["batch_ids"].append(batch_id)
+        return sorted(runs.values(), key=lambda x: x["run_id"])
+
+    def clear_batch_runs(self, run_ids: List) -> None:
+
+        with self._lock, self.connection:
+            for table in ["batch_requests", "batches"]:
+                self.connection.executemany(
+                    "DELETE FROM {} WHERE run_id = ?".format(table),
+                    [(run_id,) for run_id in run_ids],
+                )
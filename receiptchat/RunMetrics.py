@@ -0,0 +1,209 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class RunMetrics:
+    """Per-file stage timings and LLM usage for one ingestion run.
+
+    A single instance is shared by the Drive loader, the extractors and the database
+    handler, all of which may record from several pipeline threads. Stage timings are
+    kept per file (or under the run itself for stages like database writes), LLM
+    usage comes from the openai callback returned with every parse, and any other
+    run-level numbers can be recorded as gauges. Exports as JSON or Prometheus text.
+    """
+
+    RUN_KEY = "__run__"
+    PROMETHEUS_PREFIX = "receiptchat"
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.start_run()
+
+    def start_run(self, run_id: str = None) -> None:
+
+        with self._lock:
+            self.run_id = (
+                run_id or time.strftime("%Y%m%dT%H%M%S-") + uuid.uuid4().hex[:6]
+            )
+            self.started_at = time.time()
+            self.files = defaultdict(self._empty_file_record)
+            self.gauges = {}
+
+    @staticmethod
+    def _empty_file_record() -> dict:
+
+        return {
+            "stages": defaultdict(float),
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cost": 0.0,
+            "llm_calls": 0,
+            "retries": 0,
+            "estimated_image_tokens": 0,
+            "original_image_tokens": 0,
+        }
+
+    def record_stage(self, stage: str, seconds: float, file_id: str = None) -> None:
+
+        with self._lock:
+            self.files[file_id or self.RUN_KEY]["stages"][stage] += seconds
+
+    @contextmanager
+    def time_stage(self, stage: str, file_id: str = None):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start, file_id)
+
+    def record_llm_usage(self, cb, file_id: str = None) -> None:
+
+        with self._lock:
+            record = self.files[file_id or self.RUN_KEY]
+            record["prompt_tokens"] += cb.prompt_tokens
+            record["completion_tokens"] += cb.completion_tokens
+            record["cost"] += cb.total_cost
+            record["llm_calls"] += cb.successful_requests
+
+    def record_image_tokens(
+        self, estimated_tokens: int, original_tokens: int, file_id: str = None
+    ) -> None:
+        """Estimated tokens of the images sent, and of the images before preprocessing"""
+
+        with self._lock:
+            record = self.files[file_id or self.RUN_KEY]
+            record["estimated_image_tokens"] += estimated_tokens
+            record["original_image_tokens"] += original_tokens
+
+    def record_retry(self, file_id: str = None) -> None:
+
+        with self._lock:
+            self.files[file_id or self.RUN_KEY]["retries"] += 1
+
+    def set_gauge(self, name: str, value: float) -> None:
+
+        with self._lock:
+            self.gauges[name] = value
+
+    def summary(self) -> dict:
+
+        with self._lock:
+            files = {
+                file_id: dict(record, stages=dict(record["stages"]))
+                for file_id, record in self.files.items()
+            }
+            gauges = dict(self.gauges)
+
+        stages = defaultdict(list)
+        for record in files.values():
+            for stage, seconds in record["stages"].items():
+                stages[stage].append(seconds)
+
+        def percentile(values, q):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(q * len(values)))]
+
+        return {
+            "run_id": self.run_id,
+            "wall_seconds": time.time() - self.started_at,
+            "files": len([x for x in files if x != self.RUN_KEY]),
+            "stages": {
+                stage: {
+                    "count": len(values),
+                    "total_seconds": sum(values),
+                    "mean_seconds": sum(values) / len(values),
+                    "p50_seconds": percentile(values, 0.5),
+                    "p95_seconds": percentile(values, 0.95),
+                    "max_seconds": max(values),
+                }
+                for stage, values in stages.items()
+            },
+            "prompt_tokens": sum(x["prompt_tokens"] for x in files.values()),
+            "completion_tokens": sum(x["completion_tokens"] for x in files.values()),
+            "cost": sum(x["cost"] for x in files.values()),
+            "llm_calls": sum(x["llm_calls"] for x in files.values()),
+            "retries": sum(x["retries"] for x in files.values()),
+            "estimated_image_tokens": sum(
+                x["estimated_image_tokens"] for x in files.values()
+            ),
+            "original_image_tokens": sum(
+                x["original_image_tokens"] for x in files.values()
+            ),
+            "gauges": gauges,
+            "per_file": files,
+        }
+
+    def to_json(self) -> str:
+
+        return json.dumps(self.summary(), indent=2, default=str)
+
+    @classmethod
+    def _metric_name(cls, name: str) -> str:
+
+        return "{}_{}".format(
+            cls.PROMETHEUS_PREFIX, re.sub(r"[^a-zA-Z0-9_]", "_", name)
+        )
+
+    def to_prometheus(self) -> str:
+
+        summary = self.summary()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            name = self._metric_name(name)
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(k, v) for k, v in labels.items())
+                lines.append(
+                    "{}{} {}".format(
+                        name, "{" + label_text + "}" if label_text else "", value
+                    )
+                )
+
+        run = {"run_id": summary["run_id"]}
+        metric("files_total", "counter", "Files processed", [(run, summary["files"])])
+        for key in ["total_seconds", "count", "p95_seconds"]:
+            metric(
+                "stage_{}".format(key),
+                "gauge",
+                "Per stage {} across files".format(key.replace("_", " ")),
+                [
+                    (dict(run, stage=stage), values[key])
+                    for stage, values in summary["stages"].items()
+                ],
+            )
+        for key, help_text in [
+            ("prompt_tokens", "Prompt tokens sent to the LLM"),
+            ("completion_tokens", "Completion tokens returned by the LLM"),
+            ("cost", "LLM cost in USD"),
+            ("llm_calls", "Successful LLM requests"),
+            ("retries", "Retried requests"),
+            ("estimated_image_tokens", "Estimated tokens of the images sent"),
+            (
+                "original_image_tokens",
+                "Estimated tokens of the images before preprocessing",
+            ),
+        ]:
+            metric(key + "_total", "counter", help_text, [(run, summary[key])])
+        for name, value in summary["gauges"].items():
+            metric(name, "gauge", name.replace("_", " "), [(run, value)])
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory: str) -> None:
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.run_id)
+        with open(path + ".json", "w") as f:
+            f.write(self.to_json())
+        with open(path + ".prom", "w") as f:
+            f.write(self.to_prometheus())
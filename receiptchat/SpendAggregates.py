@@ -0,0 +1,220 @@
+import logging
+import os
+import sqlite3
+import threading
+from typing import List
+
+import pandas as pd
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class SpendAggregates:
+    """Running spend and tax totals, kept up to date as receipts are written.
+
+    Each receipt contributes its spend and tax to four totals: overall, its vendor,
+    its month and its vendor in that month. The totals live in one table keyed by
+    (vendor, month), where ALL stands for every vendor or month, so each question is
+    answered by a single primary key lookup rather than by grouping the database.
+
+    The contribution of every receipt is kept too, so a receipt that is parsed again
+    has its old contribution subtracted before the new one is added. Totals are
+    therefore updated in place from just the receipts being written.
+    """
+
+    AGGREGATES_PATH = os.path.join(
+        os.path.dirname(__file__), "datasets", "spend_aggregates.db"
+    )
+    ALL = ""
+    UNKNOWN = "unknown"
+    SUMMARY_ITEMS = ["tax_rate", "total", "subtotal"]
+
+    def __init__(self, aggregates_path: str = None):
+
+        self.aggregates_path = aggregates_path or self.AGGREGATES_PATH
+        os.makedirs(os.path.dirname(self.aggregates_path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.aggregates_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS receipt_spend ("
+                "receipt_id TEXT PRIMARY KEY, vendor TEXT NOT NULL, month TEXT NOT NULL, "
+                "spend REAL NOT NULL, tax REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS spend_totals ("
+                "vendor TEXT NOT NULL, month TEXT NOT NULL, spend REAL NOT NULL, "
+                "tax REAL NOT NULL, receipts INTEGER NOT NULL, "
+                "PRIMARY KEY (vendor, month))"
+            )
+
+    @classmethod
+    def receipt_spend(cls, database: pd.DataFrame) -> pd.DataFrame:
+        """
+        Spend, tax, vendor and month of each receipt in a line item table. Spend is the
+        total after tax, falling back to the subtotal and then to the sum of the items
+        when the receipt gave no total. Tax is the difference between the two totals
+        """
+
+        # totals are stored as items, with the subtotal named "total" and vice versa
+        is_summary = database["item_name"].isin(cls.SUMMARY_ITEMS)
+        receipts = database.drop_duplicates("receipt_id").set_index("receipt_id")
+        summary = (
+            database[is_summary]
+            .drop_duplicates(["receipt_id", "item_name"], keep="last")
+            .pivot(index="receipt_id", columns="item_name", values="item_cost")
+            .reindex(index=receipts.index, columns=cls.SUMMARY_ITEMS)
+        )
+        items_total = (
+            database[~is_summary]
+            .groupby("receipt_id")["item_cost"]
+            .sum()
+            .reindex(receipts.index)
+        )
+        before_tax, after_tax = summary["total"], summary["subtotal"]
+
+        vendor = receipts["vendor"].replace("nan", None).fillna(cls.UNKNOWN)
+        month = pd.to_datetime(receipts["date"], errors="coerce", utc=True)
+        return pd.DataFrame(
+            {
+                "vendor": vendor.astype(str),
+                "month": month.dt.strftime("%Y-%m").fillna(cls.UNKNOWN),
+                "spend": after_tax.fillna(before_tax).fillna(items_total).fillna(0.0),
+                "tax": (after_tax - before_tax).clip(lower=0).fillna(0.0),
+            },
+            index=receipts.index,
+        )
+
+    def _contributions(self, rows: List[tuple], sign: int) -> List[tuple]:
+
+        contributions = []
+        for vendor, month, spend, tax in rows:
+            for key in [
+                (self.ALL, self.ALL),
+                (vendor, self.ALL),
+                (self.ALL, month),
+                (vendor, month),
+            ]:
+                contributions.append(key + (sign * spend, sign * tax, sign))
+        return contributions
+
+    def add(self, collected_df: pd.DataFrame) -> None:
+        """Add the receipts in a line item table, replacing any already counted"""
+
+        if collected_df is None or collected_df.empty:
+            return
+        spend = self.receipt_spend(collected_df)
+        new_rows = list(
+            spend[["vendor", "month", "spend", "tax"]].itertuples(
+                index=False, name=None
+            )
+        )
+        receipt_ids = spend.index.tolist()
+
+        with self._lock, self.connection:
+            old_rows = []
+            for receipt_id in receipt_ids:
+                row = self.connection.execute(
+                    "SELECT vendor, month, spend, tax FROM receipt_spend "
+                    "WHERE receipt_id = ?",
+                    (receipt_id,),
+                ).fetchone()
+                if row is not None:
+                    old_rows.append(row)
+
+            self.connection.executemany(
+                "INSERT INTO spend_totals (vendor, month, spend, tax, receipts) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (vendor, month) DO UPDATE SET "
+                "spend = spend + excluded.spend, tax = tax + excluded.tax, "
+                "receipts = receipts + excluded.receipts",
+                self._contributions(old_rows, -1) + self._contributions(new_rows, 1),
+            )
+            self.connection.execute("DELETE FROM spend_totals WHERE receipts <= 0")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO receipt_spend "
+                "(receipt_id, vendor, month, spend, tax) VALUES (?, ?, ?, ?, ?)",
+                [(x,) + row for x, row in zip(receipt_ids, new_rows)],
+            )
+
+        logging.info(
+            "Updated spend totals with {} receipts ({} replaced)".format(
+                len(receipt_ids), len(old_rows)
+            )
+        )
+
+    def is_empty(self) -> bool:
+
+        with self._lock:
+            row = self.connection.execute("SELECT 1 FROM receipt_spend LIMIT 1")
+            return row.fetchone() is None
+
+    @staticmethod
+    def month_key(month) -> str:
+        """YYYY-MM key of a month given as a string, date or datetime"""
+
+        if isinstance(month, str):
+            return month
+        return month.strftime("%Y-%m")
+
+    def totals(self, vendor: str = None, month=None) -> dict:
+        """
+        Spend, tax and number of receipts overall, for a vendor, for a month or for a
+        vendor in a month
+        """
+
+        key = (
+            self.ALL if vendor is None else vendor,
+            self.ALL if month is None else self.month_key(month),
+        )
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT spend, tax, receipts FROM spend_totals "
+                "WHERE vendor = ? AND month = ?",
+                key,
+            ).fetchone()
+        spend, tax, receipts = row or (0.0, 0.0, 0)
+        return {"spend": spend, "tax": tax, "receipts": receipts}
+
+    def vendor_spend(self, vendor: str, month=None) -> float:
+
+        return self.totals(vendor=vendor, month=month)["spend"]
+
+    def monthly_spend(self, month) -> float:
+
+        return self.totals(month=month)["spend"]
+
+    def tax_paid(self, vendor: str = None, month=None) -> float:
+
+        return self.totals(vendor=vendor, month=month)["tax"]
+
+    def top_vendors(self, n: int = 10, month=None) -> List[dict]:
+        """The n vendors with the most spend, overall or in a month"""
+
+        month = self.ALL if month is None else self.month_key(month)
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT vendor, spend, tax, receipts FROM spend_totals "
+                "WHERE month = ? AND vendor != ? ORDER BY spend DESC LIMIT ?",
+                (month, self.ALL, n),
+            ).fetchall()
+        return [
+            {"vendor": vendor, "spend": spend, "tax": tax, "receipts": receipts}
+            for vendor, spend, tax, receipts in rows
+        ]
+
+    def monthly_totals(self, vendor: str = None) -> List[dict]:
+        """Totals of each month in order, overall or for a vendor"""
+
+        vendor = self.ALL if vendor is None else vendor
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT month, spend, tax, receipts FROM spend_totals "
+                "WHERE vendor = ? AND month != ? ORDER BY month",
+                (vendor, self.ALL),
+            ).fetchall()
+        return [
+            {"month": month, "spend": spend, "tax": tax, "receipts": receipts}
+            for month, spend, tax, receipts in rows
+        ]
@@ -0,0 +1,174 @@
+import argparse
+import copy
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+import pandas as pd
+
+from receiptchat.data_transformations.ReceiptDatabaseHandler import (
+    ReceiptDataBaseHandler,
+)
+
+VENDORS = ["Trader Joe's", "  Safeway ", "N/A", "Whole Foods Market", "CVS/pharmacy"]
+# receipts are printed with the time, so most of their dates are distinct
+DATE_FORMATS = ["%m/%d/%y %H:%M", "%Y-%m-%d %H:%M:%S", "%b %d %Y %I:%M %p", "%m/%d/%Y"]
+COSTS = ["3.99", "$12.50", "1,234.00", "-2.00", "N/A", "", "4.5.6", " 0.99 ", "7"]
+
+
+def make_results(n_items: int, items_per_receipt: int = 20, seed: int = 0) -> List:
+    """Extraction results, as the extractors return them, totalling about n_items"""
+
+    rng = random.Random(seed)
+    results = []
+    for i in range(max(1, n_items // (items_per_receipt + 3))):
+        results.append(
+            {
+                "vendor_name": rng.choice(VENDORS),
+                "vendor_address": "{} Main St".format(rng.randint(1, 500)),
+                "datetime": (
+                    (
+                        datetime(2024, 1, 1) + timedelta(minutes=rng.randint(0, 10**6))
+                    ).strftime(rng.choice(DATE_FORMATS))
+                    if rng.random() < 0.95
+                    else rng.choice(["N/A", "not a date"])
+                ),
+                "items_purchased": [
+                    {
+                        "item_name": "item {}".format(rng.randint(0, 5000)),
+                        "item_cost": (
+                            rng.choice(COSTS)
+                            if rng.random() < 0.2
+                            else "{:.2f}".format(rng.uniform(0, 100))
+                        ),
+                    }
+                    for _ in range(items_per_receipt)
+                ],
+                "subtotal": "{:.2f}".format(rng.uniform(0, 500)),
+                "tax_rate": rng.choice(["8.25%", "N/A", "0.0725"]),
+                "total_after_tax": "${:.2f}".format(rng.uniform(0, 500)),
+                "file_details": {
+                    "file_name": "receipt-{}".format(i),
+                    "file_type": rng.choice([".pdf", ".jpeg"]),
+                    "file_id": "file-{:08d}".format(i),
+                },
+            }
+        )
+    return results
+
+
+def reference_convert_json_to_pandas(loaded_json: List) -> pd.DataFrame:
+    """The original row by row conversion, kept to check that the output is unchanged"""
+
+    coerce_string = ReceiptDataBaseHandler.coerce_string
+    coerce_value = ReceiptDataBaseHandler.coerce_value
+    collected_df = {
+        "vendor": [],
+        "date": [],
+        "address": [],
+        "item_name": [],
+        "item_cost": [],
+        "receipt_id": [],
+        "receipt_name": [],
+        "receipt_type": [],
+    }
+    for v in loaded_json:
+
+        items = v["items_purchased"]
+        items += [
+            {"item_name": "tax_rate", "item_cost": v["tax_rate"]},
+            {"item_name": "total", "item_cost": v["subtotal"]},
+            {"item_name": "subtotal", "item_cost": v["total_after_tax"]},
+        ]
+        for item in items:
+            collected_df["vendor"].append(coerce_string(v["vendor_name"]))
+            collected_df["date"].append(coerce_string(v["datetime"]))
+            collected_df["address"].append(coerce_string(v["vendor_address"]))
+            collected_df["receipt_id"].append(v["file_details"]["file_id"])
+            collected_df["receipt_name"].append(
+                coerce_string(v["file_details"]["file_name"])
+            )
+            collected_df["receipt_type"].append(
+                coerce_string(v["file_details"]["file_type"])
+            )
+            collected_df["item_name"].append(coerce_string(item["item_name"]))
+            collected_df["item_cost"].append(coerce_value(item["item_cost"]))
+
+    collected_df = pd.DataFrame(collected_df)
+    collected_df = collected_df.astype(str)
+    collected_df["item_cost"] = collected_df["item_cost"].astype(float)
+    collected_df["date"] = pd.to_datetime(
+        collected_df["date"], format="mixed", errors="coerce"
+    )
+    return collected_df
+
+
+def run_benchmark(n_items: int, reference: bool = True) -> dict:
+
+    handler = ReceiptDataBaseHandler(load_database_on_init=False)
+    results = make_results(n_items)
+
+    start = time.perf_counter()
+    converted = handler.convert_json_to_pandas(results)
+    result = {
+        "line_items": len(converted),
+        "receipts": len(results),
+        "seconds": time.perf_counter() - start,
+    }
+
+    if reference:
+        # the reference extends items_purchased, so give it its own copy
+        results = copy.deepcopy(results)
+        start = time.perf_counter()
+        expected = reference_convert_json_to_pandas(results)
+        result["reference_seconds"] = time.perf_counter() - start
+        result["speedup"] = result["reference_seconds"] / result["seconds"]
+        pd.testing.assert_frame_equal(converted, expected)
+        result["identical"] = True
+    return result
+
+
+def format_result(result: dict) -> str:
+
+    text = "{line_items} line items from {receipts} receipts in {seconds:.3f}s".format(
+        **result
+    )
+    if "reference_seconds" in result:
+        text += (
+            ", row by row {reference_seconds:.3f}s ({speedup:.1f}x), identical".format(
+                **result
+            )
+        )
+    return text
+
+
+def main(args: List[str] = None) -> List[dict]:
+
+    parser = argparse.ArgumentParser(
+        description="Time converting extraction results to the line item table"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument(
+        "--no-reference",
+        action="store_true",
+        help="skip timing and checking against the row by row conversion",
+    )
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    parsed = parser.parse_args(args)
+
+    results = []
+    for n_items in parsed.sizes:
+        result = run_benchmark(n_items, reference=not parsed.no_reference)
+        print(format_result(result))
+        results.append(result)
+
+    if parsed.output:
+        with open(parsed.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import json
+import time
+import uuid
+from typing import Any, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_openai import ChatOpenAI
+
+DEFAULT_RESPONSE = {
+    "vendor_name": "Benchmark Grocery",
+    "vendor_address": "1 Test Street, Springfield",
+    "datetime": "01/02/24 10:30",
+    "items_purchased": [
+        {"item_name": "Milk", "item_cost": "3.49"},
+        {"item_name": "Bread", "item_cost": "2.99"},
+        {"item_name": "Eggs", "item_cost": "4.25"},
+    ],
+    "subtotal": "10.73",
+    "tax_rate": "0.0",
+    "total_after_tax": "10.73",
+}
+
+
+class FakeChatModel(ChatOpenAI):
+    """ChatOpenAI that never calls the API.
+
+    Sleeps for a configurable latency and answers with a canned receipt, either as a
+    function call (for the text chain's structured output) or as JSON content (for
+    the vision chain). Token usage is reported from the message sizes so that
+    get_openai_callback counts tokens and cost as it would for real calls.
+    """
+
+    latency: float = 0.0
+    response: dict = DEFAULT_RESPONSE
+    completion_tokens: int = 150
+
+    def __init__(self, **kwargs):
+
+        kwargs.setdefault("api_key", "fake-key")
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def _text_length(content) -> int:
+
+        if isinstance(content, str):
+            return len(content)
+        # multimodal content, image parts are not counted
+        return sum(
+            len(part.get("text", "")) for part in content if isinstance(part, dict)
+        )
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        arguments = json.dumps(self.response)
+        tools = kwargs.get("tools")
+        if tools:
+            message = AIMessage(
+                content="",
+                additional_kwargs={
+                    "tool_calls": [
+                        {
+                            "id": "call_{}".format(uuid.uuid4().hex),
+                            "type": "function",
+                            "function": {
+                                "name": tools[0]["function"]["name"],
+                                "arguments": arguments,
+                            },
+                        }
+                    ]
+                },
+            )
+        else:
+            message = AIMessage(content=arguments)
+
+        prompt_tokens = sum(self._text_length(m.content) for m in messages) // 4
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={
+                "token_usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": self.completion_tokens,
+                    "total_tokens": prompt_tokens + self.completion_tokens,
+                },
+                "model_name": self.model_name,
+            },
+        )
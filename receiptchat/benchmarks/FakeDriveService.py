@@ -0,0 +1,162 @@
+import hashlib
+import os
+import time
+from typing import List
+
+
+class FakeResponse(dict):
+    """Minimal stand-in for httplib2.Response, a dict of headers with a status"""
+
+    def __init__(self, status: int, headers: dict):
+
+        super().__init__(headers)
+        self.status = status
+
+
+class FakeHttp:
+    """Serves byte ranges of local files in the way MediaIoBaseDownload requests them"""
+
+    def __init__(self, blobs: dict, latency: float = 0.0):
+
+        self.blobs = blobs
+        self.latency = latency
+
+    def request(self, uri, method="GET", headers=None, **kwargs):
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        data = self.blobs[uri]
+        start, end = 0, len(data) - 1
+        range_header = (headers or {}).get("range")
+        if range_header:
+            start, end = [int(x) for x in range_header.split("=")[1].split("-")]
+            end = min(end, len(data) - 1)
+
+        content = data[start : end + 1]
+        return (
+            FakeResponse(
+                206,
+                {
+                    "status": "206",
+                    "content-range": "bytes {}-{}/{}".format(start, end, len(data)),
+                },
+            ),
+            content,
+        )
+
+
+class FakeRequest:
+
+    def __init__(self, uri: str, http: FakeHttp = None, result=None):
+
+        self.uri = uri
+        self.http = http
+        self.headers = {}
+        self.result = result
+
+    def execute(self, *args, **kwargs):
+
+        return self.result
+
+
+class FakeFiles:
+
+    def __init__(self, service):
+
+        self.service = service
+
+    def list(self, pageToken=None, pageSize=100, **kwargs) -> FakeRequest:
+
+        start = int(pageToken or 0)
+        page = self.service.file_list[start : start + pageSize]
+        result = {"files": page}
+        if start + pageSize < len(self.service.file_list):
+            result["nextPageToken"] = str(start + pageSize)
+        return FakeRequest("list", result=result)
+
+    def get(self, fileId, **kwargs) -> FakeRequest:
+
+        return FakeRequest("get", result=self.service.files_by_id[fileId])
+
+    def get_media(self, fileId, **kwargs) -> FakeRequest:
+
+        return FakeRequest(fileId, http=self.service.http)
+
+
+class FakeChanges:
+
+    def __init__(self, service):
+
+        self.service = service
+
+    def getStartPageToken(self, **kwargs) -> FakeRequest:
+
+        return FakeRequest("changes", result={"startPageToken": "0"})
+
+    def list(self, pageToken=None, **kwargs) -> FakeRequest:
+
+        # the served directory never changes
+        return FakeRequest(
+            "changes", result={"changes": [], "newStartPageToken": pageToken}
+        )
+
+
+class FakeDriveService:
+    """Local stand-in for the googleapiclient Drive v3 service.
+
+    Serves a list of (name, bytes) receipts through the same files().list,
+    files().get, files().get_media and changes() calls that GoogleDriveLoader makes,
+    so the loader and MediaIoBaseDownload run unmodified. A directory of sample
+    receipts can be replicated to any number of files with distinct ids.
+    """
+
+    def __init__(self, receipts: List[tuple], latency: float = 0.0):
+
+        self.file_list = []
+        blobs = {}
+        for i, (name, data) in enumerate(receipts):
+            file_id = "fake-{:06d}".format(i)
+            blobs[file_id] = data
+            self.file_list.append(
+                {
+                    "id": file_id,
+                    "name": name,
+                    "mimeType": (
+                        "application/pdf" if name.endswith(".pdf") else "image/jpeg"
+                    ),
+                    "size": str(len(data)),
+                    "md5Checksum": hashlib.md5(data).hexdigest(),
+                    "modifiedTime": "2024-01-01T00:00:00.000Z",
+                }
+            )
+
+        self.files_by_id = {x["id"]: x for x in self.file_list}
+        self.http = FakeHttp(blobs, latency=latency)
+
+    @classmethod
+    def from_directory(cls, directory: str, n_files: int = None, latency: float = 0.0):
+
+        samples = []
+        for name in sorted(os.listdir(directory)):
+            if os.path.splitext(name)[1] in (".pdf", ".jpeg"):
+                with open(os.path.join(directory, name), "rb") as f:
+                    samples.append((name, f.read()))
+        if not samples:
+            raise ValueError("No .pdf or .jpeg receipts found in {}".format(directory))
+
+        n_files = n_files or len(samples)
+        receipts = []
+        for i in range(n_files):
+            name, data = samples[i % len(samples)]
+            stem, extension = os.path.splitext(name)
+            receipts.append(("{}-{}{}".format(stem, i, extension), data))
+        return cls(receipts, latency=latency)
+
+    def files(self) -> FakeFiles:
+
+        return FakeFiles(self)
+
+    def changes(self) -> FakeChanges:
+
+        return FakeChanges(self)
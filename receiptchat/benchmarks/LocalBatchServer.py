@@ -0,0 +1,258 @@
+import email.parser
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from receiptchat.benchmarks.FakeChatModel import DEFAULT_RESPONSE
+
+
+def canned_completion(body: dict, response: dict = None) -> dict:
+    """A chat completion answering body with a canned receipt, like FakeChatModel"""
+
+    arguments = json.dumps(response or DEFAULT_RESPONSE)
+    if body.get("tools"):
+        message = {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": "call_{}".format(uuid.uuid4().hex),
+                    "type": "function",
+                    "function": {
+                        "name": body["tools"][0]["function"]["name"],
+                        "arguments": arguments,
+                    },
+                }
+            ],
+        }
+    else:
+        message = {"role": "assistant", "content": arguments}
+
+    prompt_characters = 0
+    for m in body.get("messages", []):
+        content = m.get("content") or ""
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content)
+        prompt_characters += len(content)
+    usage = {"prompt_tokens": prompt_characters // 4, "completion_tokens": 150}
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+    return {
+        "id": "chatcmpl-{}".format(uuid.uuid4().hex),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", ""),
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": usage,
+    }
+
+
+class LocalBatchServer:
+    """Local stand-in for the OpenAI files and batches endpoints.
+
+    Implements just enough of /v1/files and /v1/batches for OpenAIBatchClient (or the
+    openai client itself) to upload a request file, create a batch, poll it and
+    download the output. Batches complete after processing_seconds, with every
+    request answered by responder (a canned receipt by default). Use as a context
+    manager and point the client's base_url at .base_url.
+    """
+
+    def __init__(
+        self,
+        responder=canned_completion,
+        processing_seconds: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+
+        self.responder = responder
+        self.processing_seconds = processing_seconds
+        self.files = {}
+        self.batches = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/v1".format(host, port)
+
+    def start(self) -> "LocalBatchServer":
+
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+
+        return self.start()
+
+    def __exit__(self, *args):
+
+        self.stop()
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+
+        file_object = {
+            "id": "file-{}".format(uuid.uuid4().hex),
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self._lock:
+            self.files[file_object["id"]] = (file_object, content)
+        return file_object
+
+    def create_batch(self, request: dict) -> dict:
+
+        batch = {
+            "id": "batch_{}".format(uuid.uuid4().hex),
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "errors": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+        timer = threading.Timer(
+            self.processing_seconds, self._process_batch, args=(batch["id"],)
+        )
+        timer.daemon = True
+        timer.start()
+        return batch
+
+    def _process_batch(self, batch_id: str) -> None:
+
+        batch = self.batches[batch_id]
+        _, content = self.files[batch["input_file_id"]]
+        outputs, errors = [], []
+        for line in content.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            try:
+                response = {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": self.responder(request["body"]),
+                }
+                outputs.append(
+                    {
+                        "id": "batch_req_{}".format(uuid.uuid4().hex),
+                        "custom_id": request["custom_id"],
+                        "response": response,
+                        "error": None,
+                    }
+                )
+            except Exception as e:
+                errors.append(
+                    {
+                        "id": "batch_req_{}".format(uuid.uuid4().hex),
+                        "custom_id": request["custom_id"],
+                        "response": None,
+                        "error": {"code": "server_error", "message": str(e)},
+                    }
+                )
+
+        def to_jsonl(lines):
+            return "".join(json.dumps(x) + "\n" for x in lines).encode("utf-8")
+
+        output_file = self.add_file(to_jsonl(outputs), "output.jsonl", "batch_output")
+        error_file = (
+            self.add_file(to_jsonl(errors), "errors.jsonl", "batch_output")
+            if errors
+            else None
+        )
+        with self._lock:
+            batch.update(
+                status="completed",
+                completed_at=int(time.time()),
+                output_file_id=output_file["id"],
+                error_file_id=error_file["id"] if error_file else None,
+                request_counts={
+                    "total": len(outputs) + len(errors),
+                    "completed": len(outputs),
+                    "failed": len(errors),
+                },
+            )
+
+    def _handler_class(self):
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def do_POST(self):
+                body = self._read_body()
+                if self.path == "/v1/files":
+                    # multipart/form-data with a purpose field and a file field
+                    message = email.parser.BytesParser().parsebytes(
+                        b"Content-Type: "
+                        + self.headers["Content-Type"].encode()
+                        + b"\r\n\r\n"
+                        + body
+                    )
+                    fields, filename, content = {}, "input.jsonl", b""
+                    for part in message.get_payload():
+                        name = part.get_param("name", header="content-disposition")
+                        if name == "file":
+                            filename = part.get_filename() or filename
+                            content = part.get_payload(decode=True)
+                        else:
+                            fields[name] = part.get_payload(decode=True).decode()
+                    self._send(
+                        200,
+                        server.add_file(content, filename, fields.get("purpose")),
+                    )
+                elif self.path == "/v1/batches":
+                    self._send(200, server.create_batch(json.loads(body)))
+                else:
+                    self._send(404, {"error": {"message": "Unknown path"}})
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+                    with server._lock:
+                        batch = dict(server.batches.get(parts[2]) or {})
+                    if batch:
+                        return self._send(200, batch)
+                elif parts[:2] == ["v1", "files"] and parts[3:] == ["content"]:
+                    if parts[2] in server.files:
+                        _, content = server.files[parts[2]]
+                        return self._send(200, content, "application/octet-stream")
+                self._send(404, {"error": {"message": "Not found"}})
+
+        return Handler
@@ -0,0 +1,110 @@
+import io
+import os
+from typing import List
+
+from PIL import Image, ImageDraw
+
+from receiptchat.benchmarks.FakeChatModel import DEFAULT_RESPONSE
+
+
+def receipt_lines(receipt: dict = None) -> List[str]:
+
+    receipt = receipt or DEFAULT_RESPONSE
+    lines = [receipt["vendor_name"], receipt["vendor_address"], receipt["datetime"], ""]
+    for item in receipt["items_purchased"]:
+        lines.append("{:<24}{:>8}".format(item["item_name"], item["item_cost"]))
+    lines += [
+        "",
+        "{:<24}{:>8}".format("SUBTOTAL", receipt["subtotal"]),
+        "{:<24}{:>8}".format("TAX", receipt["tax_rate"]),
+        "{:<24}{:>8}".format("TOTAL", receipt["total_after_tax"]),
+    ]
+    return lines
+
+
+def make_text_pdf(lines: List[str], lines_per_page: int = None) -> bytes:
+    """A PDF with an embedded text layer, written without any PDF library"""
+
+    def escape(text):
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    lines_per_page = lines_per_page or max(1, len(lines))
+    pages = [
+        lines[i : i + lines_per_page] for i in range(0, len(lines), lines_per_page)
+    ] or [[]]
+
+    # catalog, page tree and font, then a page and its content stream for each page
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join("{} 0 R".format(4 + 2 * i) for i in range(len(pages))),
+            len(pages),
+        ),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>",
+    ]
+    for i, page_lines in enumerate(pages):
+        content = "BT /F1 11 Tf 40 760 Td 14 TL\n"
+        content += "".join("({}) '\n".format(escape(line)) for line in page_lines)
+        content += "ET"
+        objects += [
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 300 800] "
+            "/Contents {} 0 R /Resources << /Font << /F1 3 0 R >> >> >>".format(
+                5 + 2 * i
+            ),
+            "<< /Length {} >>\nstream\n{}\nendstream".format(len(content), content),
+        ]
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += "{} 0 obj\n{}\nendobj\n".format(i, body).encode("latin-1")
+
+    xref_offset = len(pdf)
+    pdf += "xref\n0 {}\n0000000000 65535 f \n".format(len(objects) + 1).encode()
+    for offset in offsets:
+        pdf += "{:010d} 00000 n \n".format(offset).encode()
+    pdf += "trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n".format(
+        len(objects) + 1, xref_offset
+    ).encode()
+    return pdf
+
+
+def make_photo_jpeg(lines: List[str]) -> bytes:
+    """A photographed receipt: dark text on a white slip over a darker background"""
+
+    paper = Image.new("L", (360, 40 + 18 * len(lines)), 255)
+    draw = ImageDraw.Draw(paper)
+    for i, line in enumerate(lines):
+        draw.text((20, 20 + 18 * i), line, fill=0)
+
+    photo = Image.new("L", (paper.width + 120, paper.height + 120), 60)
+    photo.paste(paper, (60, 60))
+    buffer = io.BytesIO()
+    photo.convert("RGB").save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def write_sample_receipts(directory: str, n_pages: int = 1) -> str:
+    """
+    Write a digital PDF and a photographed receipt. With n_pages, the PDF is a long
+    receipt whose items run over that many pages
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    lines = receipt_lines()
+    pdf_lines, lines_per_page = lines, None
+    if n_pages > 1:
+        long_receipt = dict(DEFAULT_RESPONSE)
+        long_receipt["items_purchased"] = [
+            dict(item, item_name="{} {}".format(item["item_name"], i + 1))
+            for i in range(n_pages)
+            for item in DEFAULT_RESPONSE["items_purchased"]
+        ]
+        pdf_lines = receipt_lines(long_receipt)
+        lines_per_page = -(-len(pdf_lines) // n_pages)
+    with open(os.path.join(directory, "digital_receipt.pdf"), "wb") as f:
+        f.write(make_text_pdf(pdf_lines, lines_per_page=lines_per_page))
+    with open(os.path.join(directory, "photo_receipt.jpeg"), "wb") as f:
+        f.write(make_photo_jpeg(lines))
+    return directory
@@ -0,0 +1,200 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+from receiptchat.ReceiptParseDriver import ReceiptParseDriver
+from receiptchat.openai.BatchClient import OpenAIBatchClient
+from receiptchat.openai.RequestScheduler import RequestScheduler
+from receiptchat.benchmarks.FakeChatModel import FakeChatModel
+from receiptchat.benchmarks.FakeDriveService import FakeDriveService
+from receiptchat.benchmarks.LocalBatchServer import LocalBatchServer
+from receiptchat.benchmarks.SampleReceipts import write_sample_receipts
+
+
+def peak_rss_mb() -> float:
+
+    # ru_maxrss is kilobytes on linux and bytes on macOS
+    scale = 1024**2 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def build_driver(
+    samples_dir: str,
+    n_files: int,
+    drive_latency: float,
+    llm_latency: float,
+    **driver_kwargs,
+) -> ReceiptParseDriver:
+
+    # caches and duplicate detection are off so that every run downloads, converts
+    # and parses every file, even though the samples are replicated
+    # the fake files and batches are journaled apart from real runs, which would
+    # otherwise retry the fake files and try to collect the local server's batches
+    driver_kwargs.setdefault(
+        "journal_path",
+        os.path.join(tempfile.mkdtemp(prefix="receiptchat_journal_"), "run_journal.db"),
+    )
+    drive_service = FakeDriveService.from_directory(
+        samples_dir, n_files=n_files, latency=drive_latency
+    )
+    driver = ReceiptParseDriver(
+        {"OPENAI_API_KEY": "fake-key"},
+        load_database_on_init=False,
+        use_download_cache=False,
+        use_response_cache=False,
+        use_artifact_store=False,
+        detect_duplicates=False,
+        # the fake keeps no per-request state, so every download thread can share it
+        gdrive_service=drive_service,
+        gdrive_service_factory=lambda: drive_service,
+        llms={
+            "text": FakeChatModel(model="gpt-3.5-turbo", latency=llm_latency),
+            "vision": FakeChatModel(model="gpt-4-vision-preview", latency=llm_latency),
+        },
+        **driver_kwargs,
+    )
+    # start from an empty database so that every fake file counts as new
+    driver.database_handler.database = None
+    driver.database_handler.receipt_ids = set()
+    return driver
+
+
+def run_benchmark(
+    samples_dir: str,
+    n_files: int,
+    model: str = "text",
+    pipelined: bool = True,
+    drive_latency: float = 0.0,
+    llm_latency: float = 0.0,
+    trace_memory: bool = True,
+    batch: bool = False,
+    **driver_kwargs,
+) -> dict:
+
+    batch_server = None
+    if batch:
+        # batch requests go to a local stand-in for the Batch API
+        batch_server = LocalBatchServer(processing_seconds=llm_latency).start()
+        driver_kwargs["batch_client"] = OpenAIBatchClient(
+            api_key="fake-key",
+            base_url=batch_server.base_url,
+            poll_interval=0.1,
+            requests_dir=tempfile.mkdtemp(prefix="receiptchat_batch_"),
+        )
+    driver = build_driver(
+        samples_dir, n_files, drive_latency, llm_latency, **driver_kwargs
+    )
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        driver.update_database(
+            model=model, write_to_db=False, pipelined=pipelined, batch=batch
+        )
+    finally:
+        elapsed = time.perf_counter() - start
+        peak_traced = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        driver.ocr_engine.shutdown()
+        if batch_server is not None:
+            batch_server.stop()
+
+    summary = driver.metrics.summary()
+    return {
+        "model": model,
+        "pipelined": pipelined,
+        "batch": batch,
+        "n_files": n_files,
+        "seconds": elapsed,
+        "receipts_per_second": n_files / elapsed if elapsed else None,
+        "stages": summary["stages"],
+        "llm_calls": summary["llm_calls"],
+        "prompt_tokens": summary["prompt_tokens"],
+        "completion_tokens": summary["completion_tokens"],
+        "peak_traced_mb": (peak_traced / 1024**2 if peak_traced is not None else None),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def format_result(result: dict) -> str:
+
+    stage_text = ", ".join(
+        "{} {:.2f}s".format(stage, values["total_seconds"])
+        for stage, values in result["stages"].items()
+    )
+    return "{model:>6} n={n_files:<6} {receipts_per_second:8.2f} receipts/s  rss {peak_rss_mb:.0f}MB  [{stages}]".format(
+        **{**result, "stages": stage_text}
+    )
+
+
+def main(args: List[str] = None) -> List[dict]:
+
+    parser = argparse.ArgumentParser(
+        description="Offline end to end throughput benchmark with a fake Drive and fake LLM"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--modes", nargs="+", default=["text", "vision"])
+    parser.add_argument(
+        "--samples-dir",
+        default=None,
+        help="directory of .pdf/.jpeg receipts to replicate, synthetic samples are generated if not given",
+    )
+    parser.add_argument("--drive-latency", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--serial", action="store_true", help="disable the pipeline")
+    parser.add_argument(
+        "--batch", action="store_true", help="parse through a local Batch API server"
+    )
+    parser.add_argument(
+        "--pages", type=int, default=1, help="pages of the generated PDF receipt"
+    )
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="throttle the fake models to OpenAI's usage tier 1 rate limits",
+    )
+    parser.add_argument("--no-trace-memory", action="store_true")
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    parsed = parser.parse_args(args)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    samples_dir = parsed.samples_dir or write_sample_receipts(
+        tempfile.mkdtemp(prefix="receiptchat_samples_"), n_pages=parsed.pages
+    )
+
+    results = []
+    for model in parsed.modes:
+        for n_files in parsed.sizes:
+            result = run_benchmark(
+                samples_dir,
+                n_files,
+                model=model,
+                pipelined=not parsed.serial,
+                drive_latency=parsed.drive_latency,
+                llm_latency=parsed.llm_latency,
+                trace_memory=not parsed.no_trace_memory,
+                batch=parsed.batch,
+                rate_limits=(
+                    RequestScheduler.TIER_1_LIMITS if parsed.rate_limits else None
+                ),
+            )
+            print(format_result(result))
+            results.append(result)
+
+    if parsed.output:
+        with open(parsed.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import hashlib
+import io
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Callable, List
+
+from PIL import Image
+
+from receiptchat.data_transformations.constants import OCR_DPI
+from receiptchat.gdrive.DownloadCache import DownloadCache
+
+# bump when a change to the converters changes what they produce
+ARTIFACT_VERSION = 1
+
+
+class ArtifactStore:
+    """Persistent store of the text and page images derived from receipt files.
+
+    Artifacts are keyed by the sha256 of the file content, the converter that made
+    them and, for page images, the DPI they were rendered at. A receipt is OCR'd and
+    rendered once, by whichever extractor asks first, and later runs reuse the
+    result, even for the same file under another id. Page images are stored as JPEGs
+    at jpeg_quality, and are returned as they read back even when just made, so
+    every run sends the model the same pixels. The blobs are kept by a DownloadCache
+    in a directory of their own, capped at max_bytes. A thread that asks for an
+    artifact another thread is making waits for it instead of making it again.
+    """
+
+    STORE_PATH = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), "datasets", "artifacts"
+    )
+
+    def __init__(
+        self, store_dir: str = None, max_bytes: int = 2 * 1024**3, jpeg_quality=95
+    ):
+
+        self.cache = DownloadCache(
+            cache_dir=store_dir or self.STORE_PATH, max_bytes=max_bytes
+        )
+        self.jpeg_quality = jpeg_quality
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def content_hash(file_bytes: bytes) -> str:
+
+        return hashlib.sha256(file_bytes).hexdigest()
+
+    @staticmethod
+    def artifact_key(kind: str, converter, dpi: int) -> str:
+
+        return "{}:{}:{}:v{}".format(
+            kind, type(converter).__name__, dpi, ARTIFACT_VERSION
+        )
+
+    @contextmanager
+    def _key_lock(self, key: tuple):
+
+        with self._lock:
+            lock, users = self._key_locks.get(key, (threading.Lock(), 0))
+            self._key_locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._key_locks[key]
+                if users == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (lock, users - 1)
+
+    def _get_or_make(
+        self,
+        file_bytes: bytes,
+        artifact_key: str,
+        make: Callable,
+        encode: Callable,
+        decode: Callable,
+    ):
+
+        content_hash = self.content_hash(file_bytes)
+        with self._key_lock((content_hash, artifact_key)):
+            data = self.cache.get(content_hash, artifact_key)
+            if data is not None:
+                return decode(data)
+            data = encode(make())
+            self.cache.put(content_hash, artifact_key, data)
+            # return what later runs will read back, e.g. the same JPEG pixels, so the
+            # requests built from it, and their cache keys, match across runs
+            return decode(data)
+
+    def text(self, converter, file_bytes: bytes, ocr_engine=None, document=None) -> str:
+        """The text of a file, as converter.convert_bytes_to_text reads it"""
+
+        return self._get_or_make(
+            file_bytes,
+            self.artifact_key("text", converter, OCR_DPI),
+            lambda: converter.convert_bytes_to_text(
+                file_bytes, ocr_engine=ocr_engine, document=document
+            ),
+            str.encode,
+            bytes.decode,
+        )
+
+    def jpegs(
+        self, converter, file_bytes: bytes, dpi: int, document=None
+    ) -> List[Image.Image]:
+        """The pages of a file, as converter.convert_bytes_to_jpegs renders them"""
+
+        if not converter.RENDERS:
+            # decoding the file itself costs no more than reading it back
+            return converter.convert_bytes_to_jpegs(
+                file_bytes, dpi=dpi, document=document
+            )
+        return self._get_or_make(
+            file_bytes,
+            self.artifact_key("jpegs", converter, dpi),
+            lambda: converter.convert_bytes_to_jpegs(
+                file_bytes, dpi=dpi, document=document
+            ),
+            self.encode_pages,
+            self.decode_pages,
+        )
+
+    def encode_pages(self, pages: List[Image.Image]) -> bytes:
+
+        # the page count, the length of each page, then the pages
+        encoded = []
+        for page in pages:
+            buffer = io.BytesIO()
+            page.convert("RGB").save(buffer, format="JPEG", quality=self.jpeg_quality)
+            encoded.append(buffer.getvalue())
+        header = struct.pack(
+            ">I{}Q".format(len(encoded)), len(encoded), *map(len, encoded)
+        )
+        return header + b"".join(encoded)
+
+    @staticmethod
+    def decode_pages(data: bytes) -> List[Image.Image]:
+
+        (n_pages,) = struct.unpack_from(">I", data)
+        lengths = struct.unpack_from(">{}Q".format(n_pages), data, 4)
+        offset = 4 + 8 * n_pages
+        pages = []
+        for length in lengths:
+            page = Image.open(io.BytesIO(data[offset : offset + length]))
+            page.load()
+            pages.append(page)
+            offset += length
+        return pages
+
+    def stats(self) -> dict:
+
+        return self.cache.stats()
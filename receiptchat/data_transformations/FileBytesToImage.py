@@ -5,10 +5,20 @@ from PyPDF2 import PdfReader
 from PIL import Image
 import pytesseract
 import io
-from receiptchat.data_transformations.constants import DEFAULT_DPI
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from receiptchat.data_transformations.constants import (
+    DEFAULT_DPI,
+    OCR_DPI,
+    MIN_TEXT_LAYER_CHARACTERS,
+    MAX_PDF_PAGES,
+)
+from receiptchat.data_transformations.ReceiptPages import stitch_page_texts
 
 
 class FileBytesToImage(ABC):
+    # whether making the page images costs more than decoding the file
+    RENDERS = True
 
     @staticmethod
     @abstractmethod
@@ -17,29 +27,116 @@ class FileBytesToImage(ABC):
 
     @staticmethod
     @abstractmethod
-    def convert_bytes_to_text(file_bytes):
+    def convert_bytes_to_text(file_bytes, ocr_engine=None, document=None):
         raise NotImplementedError
 
+    @staticmethod
+    def read_document(file_bytes):
+        # parsed once by callers that both render and read a file, and passed to each
+        return None
+
+    @classmethod
+    def convert_bytes_to_jpegs(cls, file_bytes, dpi=DEFAULT_DPI, document=None):
+        return [cls.convert_bytes_to_jpeg(file_bytes, dpi=dpi)]
+
+    @staticmethod
+    def image_to_text(image, ocr_engine=None):
+        if ocr_engine is not None:
+            return ocr_engine.image_to_text(image)
+        return pytesseract.image_to_string(image=image, nice=1)
+
+    @staticmethod
+    def images_to_text(images, ocr_engine=None):
+        if len(images) == 1:
+            return [FileBytesToImage.image_to_text(images[0], ocr_engine=ocr_engine)]
+        if ocr_engine is not None:
+            return ocr_engine.images_to_text(images)
+        # each pytesseract call is a subprocess, so threads run them in parallel
+        with ThreadPoolExecutor(len(images)) as pool:
+            return list(pool.map(FileBytesToImage.image_to_text, images))
+
 
 class PDFBytesToImage(FileBytesToImage):
 
     @staticmethod
-    def convert_bytes_to_jpeg(file_bytes, dpi=DEFAULT_DPI, return_array=False):
-        jpeg_data = convert_from_bytes(file_bytes, fmt="jpeg", dpi=dpi)[0]
+    def read_document(file_bytes):
+        return PdfReader(stream=io.BytesIO(initial_bytes=file_bytes))
+
+    @staticmethod
+    def convert_bytes_to_jpeg(file_bytes, dpi=DEFAULT_DPI, return_array=False, page=0):
+        # only rasterize the page we keep
+        jpeg_data = convert_from_bytes(
+            file_bytes, fmt="jpeg", dpi=dpi, first_page=page + 1, last_page=page + 1
+        )[0]
         if return_array:
             jpeg_data = np.asarray(jpeg_data)
         return jpeg_data
 
     @staticmethod
-    def convert_bytes_to_text(file_bytes):
-        pdf_data = PdfReader(
-            stream=io.BytesIO(initial_bytes=file_bytes)  # Create steam object
-        )
-        page = pdf_data.pages[0]
-        return page.extract_text()
+    def convert_pages_to_jpeg(file_bytes, pages, dpi=DEFAULT_DPI):
+        if len(pages) == 1:
+            return [
+                PDFBytesToImage.convert_bytes_to_jpeg(file_bytes, dpi, page=pages[0])
+            ]
+        # every page is rendered by its own poppler process
+        with ThreadPoolExecutor(len(pages)) as pool:
+            return list(
+                pool.map(
+                    lambda page: PDFBytesToImage.convert_bytes_to_jpeg(
+                        file_bytes, dpi, page=page
+                    ),
+                    pages,
+                )
+            )
+
+    @staticmethod
+    def count_pages(file_bytes, document=None):
+        pdf_data = document
+        if pdf_data is None:
+            pdf_data = PDFBytesToImage.read_document(file_bytes)
+        n_pages = len(pdf_data.pages)
+        if n_pages > MAX_PDF_PAGES:
+            logging.warning(
+                "Only reading the first {} of {} pages".format(MAX_PDF_PAGES, n_pages)
+            )
+        return min(n_pages, MAX_PDF_PAGES)
+
+    @staticmethod
+    def convert_bytes_to_jpegs(file_bytes, dpi=DEFAULT_DPI, document=None):
+        pages = range(PDFBytesToImage.count_pages(file_bytes, document))
+        return PDFBytesToImage.convert_pages_to_jpeg(file_bytes, list(pages), dpi=dpi)
+
+    @staticmethod
+    def extract_text_layers(file_bytes, document=None):
+        pdf_data = document
+        if pdf_data is None:
+            pdf_data = PDFBytesToImage.read_document(file_bytes)
+        return [page.extract_text() for page in pdf_data.pages[:MAX_PDF_PAGES]]
+
+    @staticmethod
+    def has_usable_text(text):
+        return sum(c.isalnum() for c in text or "") >= MIN_TEXT_LAYER_CHARACTERS
+
+    @staticmethod
+    def convert_bytes_to_text(file_bytes, ocr_engine=None, document=None):
+        # digital PDFs carry their text, so poppler and tesseract are only needed for scans
+        texts = PDFBytesToImage.extract_text_layers(file_bytes, document)
+        scanned = [
+            i for i, x in enumerate(texts) if not PDFBytesToImage.has_usable_text(x)
+        ]
+        if scanned:
+            # scanned pages are rendered and OCR'd in parallel
+            images = PDFBytesToImage.convert_pages_to_jpeg(
+                file_bytes, scanned, dpi=OCR_DPI
+            )
+            ocr_texts = FileBytesToImage.images_to_text(images, ocr_engine=ocr_engine)
+            for i, text in zip(scanned, ocr_texts):
+                texts[i] = text
+        return stitch_page_texts(texts)
 
 
 class JpegBytesToImage(FileBytesToImage):
+    RENDERS = False
 
     @staticmethod
     def convert_bytes_to_jpeg(file_bytes, dpi=DEFAULT_DPI, return_array=False):
@@ -49,7 +146,9 @@ class JpegBytesToImage(FileBytesToImage):
         return jpeg_data
 
     @staticmethod
-    def convert_bytes_to_text(file_bytes):
+    def convert_bytes_to_text(file_bytes, ocr_engine=None, document=None):
+        if ocr_engine is not None:
+            return ocr_engine.image_bytes_to_text(file_bytes)
         jpeg_data = Image.open(io.BytesIO(file_bytes))
         text_data = pytesseract.image_to_string(image=jpeg_data, nice=1)
         return text_data
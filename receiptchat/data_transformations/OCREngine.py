@@ -0,0 +1,159 @@
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import pytesseract
+from PIL import Image
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+# per worker process state, set up once by _init_worker
+_worker_options = None
+_worker_api = None
+
+
+def _init_worker(lang: str, psm: int, variables: dict, use_tesserocr: bool) -> None:
+
+    global _worker_options, _worker_api
+    _worker_options = (lang, psm, variables)
+    if use_tesserocr and tesserocr is not None:
+        # load the tesseract models once per process instead of once per image
+        kwargs = {"lang": lang}
+        if psm is not None:
+            kwargs["psm"] = psm
+        _worker_api = tesserocr.PyTessBaseAPI(**kwargs)
+        for name, value in (variables or {}).items():
+            _worker_api.SetVariable(name, str(value))
+
+
+def _recognize(image_bytes: bytes) -> tuple:
+
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(image_bytes))
+    if _worker_api is not None:
+        _worker_api.SetImage(image)
+        text = _worker_api.GetUTF8Text()
+    else:
+        lang, psm, variables = _worker_options
+        text = pytesseract.image_to_string(
+            image=image,
+            lang=lang,
+            config=OCREngine.tesseract_config(psm, variables),
+            nice=1,
+        )
+    return text, time.perf_counter() - start
+
+
+class OCREngine:
+    """Tesseract OCR run in a pool of worker processes.
+
+    Each worker keeps a persistent tesserocr API when tesserocr is installed, so the
+    language models are loaded once per process. Without it the workers fall back to
+    pytesseract, which still spawns one tesseract subprocess per image but now runs
+    them on all cores. Per-image recognition times are recorded for reporting.
+    """
+
+    def __init__(
+        self,
+        lang: str = "eng",
+        psm: int = None,
+        variables: dict = None,
+        n_workers: int = None,
+        use_tesserocr: bool = True,
+    ):
+
+        self.lang = lang
+        self.psm = psm
+        self.variables = variables or {}
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.use_tesserocr = use_tesserocr
+        self.timings = []
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tesseract_config(psm: int = None, variables: dict = None) -> str:
+
+        config = []
+        if psm is not None:
+            config.append("--psm {}".format(psm))
+        for name, value in (variables or {}).items():
+            config.append("-c {}={}".format(name, value))
+        return " ".join(config)
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+
+        # started on first use so that creating an engine is free
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.n_workers,
+                    initializer=_init_worker,
+                    initargs=(self.lang, self.psm, self.variables, self.use_tesserocr),
+                )
+            return self._pool
+
+    def _record(self, elapsed: float) -> None:
+
+        with self._lock:
+            self.timings.append(elapsed)
+        logging.debug("OCR took {:.3f}s".format(elapsed))
+
+    def image_bytes_to_text(self, image_bytes: bytes) -> str:
+
+        text, elapsed = self.pool.submit(_recognize, image_bytes).result()
+        self._record(elapsed)
+        return text
+
+    def image_to_text(self, image: Image.Image) -> str:
+
+        # PNG is lossless, so the workers see exactly the rendered image
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return self.image_bytes_to_text(buffer.getvalue())
+
+    def images_to_text(self, images: List[Image.Image]) -> List[str]:
+
+        buffers = []
+        for image in images:
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            buffers.append(buffer.getvalue())
+        return self.images_bytes_to_text(buffers)
+
+    def images_bytes_to_text(self, images_bytes: List[bytes]) -> List[str]:
+
+        texts = []
+        for text, elapsed in self.pool.map(_recognize, images_bytes):
+            self._record(elapsed)
+            texts.append(text)
+        return texts
+
+    def stats(self) -> dict:
+
+        with self._lock:
+            timings = list(self.timings)
+
+        return {
+            "images": len(timings),
+            "total_seconds": sum(timings),
+            "mean_seconds": sum(timings) / len(timings) if timings else 0.0,
+            "max_seconds": max(timings) if timings else 0.0,
+        }
+
+    def shutdown(self) -> None:
+
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
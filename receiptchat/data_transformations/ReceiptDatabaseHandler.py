@@ -1,12 +1,22 @@
+from __future__ import annotations
+
+import csv
 import logging
 
-import pandas as pd
-from typing import List
+from typing import TYPE_CHECKING, List
 import numpy as np
 import os
+import re
+from receiptchat.RunMetrics import RunMetrics
+
+# pandas is slow to import and not needed to find new files, so it is imported on use
+if TYPE_CHECKING:
+    import pandas as pd
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
+NON_NUMERIC_CHARACTERS = re.compile(r"[^0-9.]")
+
 
 class ReceiptDataBaseHandler:
 
@@ -15,7 +25,17 @@ class ReceiptDataBaseHandler:
     )
     # DATABASE_PATH = "receipt_database.csv"
 
-    def __init__(self, load_database_on_init: bool = True) -> None:
+    # receipt level totals are stored as extra line items, under these names. The
+    # subtotal is stored as "total" and vice versa, as existing databases have them
+    SUMMARY_ITEMS = [
+        ("tax_rate", "tax_rate"),
+        ("total", "subtotal"),
+        ("subtotal", "total_after_tax"),
+    ]
+
+    def __init__(
+        self, load_database_on_init: bool = True, metrics: RunMetrics = None
+    ) -> None:
 
         if not os.path.isdir(os.path.dirname(self.DATABASE_PATH)):
             logging.info(
@@ -23,19 +43,48 @@ class ReceiptDataBaseHandler:
             )
             os.mkdir(os.path.dirname(self.DATABASE_PATH))
 
+        self.metrics = metrics or RunMetrics()
         self.load_database_on_init = load_database_on_init
+        self._database = None
+        self._database_loaded = not load_database_on_init
         if load_database_on_init:
             try:
-                self._load_database()
+                self._load_receipt_ids()
             except Exception as e:
                 logging.warning(e)
-                self.database = None
+                self._database_loaded = True
                 self.receipt_ids = None
 
+    def _load_receipt_ids(self) -> None:
+
+        # only the ids are needed to find new files, the table itself is read on first use
+        with open(self.DATABASE_PATH, newline="") as f:
+            self.receipt_ids = set(row["receipt_id"] for row in csv.DictReader(f))
+
     def _load_database(self) -> None:
 
-        self.database = pd.read_csv(self.DATABASE_PATH)
-        self.receipt_ids = set(self.database["receipt_id"].unique().tolist())
+        import pandas as pd
+
+        self._database = pd.read_csv(self.DATABASE_PATH)
+        self.receipt_ids = set(self._database["receipt_id"].unique().tolist())
+
+    @property
+    def database(self) -> pd.DataFrame:
+
+        if not self._database_loaded:
+            self._database_loaded = True
+            self._load_database()
+        return self._database
+
+    @database.setter
+    def database(self, database: pd.DataFrame) -> None:
+
+        self._database = database
+        self._database_loaded = True
+
+    def load_database(self) -> pd.DataFrame:
+
+        return self.database
 
     def find_new_ids(self, available_files: List) -> List:
 
@@ -51,59 +100,121 @@ class ReceiptDataBaseHandler:
         return new_files
 
     def convert_json_to_pandas(self, loaded_json: List) -> pd.DataFrame:
+        """
+        One row per line item, with the receipt totals appended as extra items. Receipt
+        fields are coerced once per receipt and repeated over its items, and costs and
+        dates are parsed once per distinct string, so large backfills stay fast
+        """
 
-        collected_df = {
-            "vendor": [],
-            "date": [],
-            "address": [],
-            "item_name": [],
-            "item_cost": [],
-            "receipt_id": [],
-            "receipt_name": [],
-            "receipt_type": [],
-        }
-        for v in loaded_json:
+        import pandas as pd
 
+        n_items = []
+        item_names = []
+        item_costs = []
+        for v in loaded_json:
             items = v["items_purchased"]
-            items += [
-                {"item_name": "tax_rate", "item_cost": v["tax_rate"]},
-                {"item_name": "total", "item_cost": v["subtotal"]},
-                {"item_name": "subtotal", "item_cost": v["total_after_tax"]},
-            ]
-            for item in items:
-                collected_df["vendor"].append(self.coerce_string(v["vendor_name"]))
-                collected_df["date"].append(self.coerce_string(v["datetime"]))
-                collected_df["address"].append(self.coerce_string(v["vendor_address"]))
-                collected_df["receipt_id"].append(v["file_details"]["file_id"])
-                collected_df["receipt_name"].append(
-                    self.coerce_string(v["file_details"]["file_name"])
-                )
-                collected_df["receipt_type"].append(
-                    self.coerce_string(v["file_details"]["file_type"])
-                )
-                collected_df["item_name"].append(self.coerce_string(item["item_name"]))
-                collected_df["item_cost"].append(self.coerce_value(item["item_cost"]))
-
-        collected_df = pd.DataFrame(collected_df)
-        collected_df = collected_df.astype(str)
-        collected_df["item_cost"] = collected_df["item_cost"].astype(float)
-        collected_df["date"] = pd.to_datetime(
-            collected_df["date"], format="mixed", errors="coerce"
+            n_items.append(len(items) + len(self.SUMMARY_ITEMS))
+            item_names += [item["item_name"] for item in items]
+            item_costs += [item["item_cost"] for item in items]
+            item_names += [name for name, _ in self.SUMMARY_ITEMS]
+            item_costs += [v[key] for _, key in self.SUMMARY_ITEMS]
+
+        def receipt_column(values):
+            return np.repeat(self.coerce_strings(values), n_items)
+
+        collected_df = pd.DataFrame(
+            {
+                "vendor": receipt_column([v["vendor_name"] for v in loaded_json]),
+                "date": receipt_column([v["datetime"] for v in loaded_json]),
+                "address": receipt_column([v["vendor_address"] for v in loaded_json]),
+                "item_name": self.coerce_strings(item_names),
+                "item_cost": self.coerce_values(item_costs),
+                "receipt_id": np.repeat(
+                    np.array(
+                        [str(v["file_details"]["file_id"]) for v in loaded_json],
+                        dtype=object,
+                    ),
+                    n_items,
+                ),
+                "receipt_name": receipt_column(
+                    [v["file_details"]["file_name"] for v in loaded_json]
+                ),
+                "receipt_type": receipt_column(
+                    [v["file_details"]["file_type"] for v in loaded_json]
+                ),
+            }
         )
+        collected_df["date"] = self.parse_dates(collected_df["date"])
         return collected_df
 
+    @staticmethod
+    def coerce_strings(values: List) -> np.ndarray:
+        """coerce_string over values, as the strings they are stored as"""
+
+        return np.array(
+            ["nan" if x == "N/A" else str(x).strip() for x in values], dtype=object
+        )
+
+    @classmethod
+    def coerce_values(cls, values: List) -> np.ndarray:
+        """coerce_value over values, converting each distinct value once"""
+
+        costs = {}
+        for x in values:
+            if x not in costs:
+                if isinstance(x, str) and x.isascii():
+                    # for ascii text this keeps exactly the characters coerce_value does
+                    costs[x] = cls._to_float(NON_NUMERIC_CHARACTERS.sub("", x))
+                else:
+                    costs[x] = cls.coerce_value(x)
+        return np.array([costs[x] for x in values], dtype=np.float64)
+
+    @staticmethod
+    def _to_float(value: str) -> float:
+
+        try:
+            return float(value)
+        except ValueError:
+            return np.nan
+
+    @staticmethod
+    def parse_dates(dates: pd.Series) -> pd.Series:
+        """pd.to_datetime over the dates, parsing each distinct string once"""
+
+        import pandas as pd
+
+        codes, uniques = pd.factorize(dates)
+        parsed = pd.to_datetime(uniques, format="mixed", errors="coerce")
+        return pd.Series(parsed.take(codes), index=dates.index, name=dates.name)
+
     def update_database(self, collected_df: pd.DataFrame) -> pd.DataFrame:
 
+        import pandas as pd
+
         if isinstance(self.database, pd.DataFrame):
-            return pd.concat([self.database, collected_df])
+            # replace the rows of receipts that were parsed again
+            existing = self.database[
+                ~self.database["receipt_id"].isin(collected_df["receipt_id"])
+            ]
+            return pd.concat([existing, collected_df])
         else:
             return collected_df
 
     def write_to_database(self, collected_df: pd.DataFrame) -> None:
 
-        collected_df.to_csv(self.DATABASE_PATH, index=False)
+        with self.metrics.time_stage("database_write"):
+            collected_df.to_csv(self.DATABASE_PATH, index=False)
         return None
 
+    def commit_to_database(self, collected_df: pd.DataFrame) -> pd.DataFrame:
+
+        updated_df = self.update_database(collected_df)
+        self.write_to_database(updated_df)
+        # keep the in-memory copy current so later commits in the same run append to it
+        self.database = updated_df
+        self.receipt_ids = set(updated_df["receipt_id"].unique().tolist())
+        return updated_df
+
     @staticmethod
     def coerce_value(value):
 
@@ -0,0 +1,65 @@
+import hashlib
+import re
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+FINGERPRINT_BITS = 64
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def bits_to_int(bits: np.ndarray) -> int:
+
+    return int.from_bytes(np.packbits(bits.astype(np.uint8)).tobytes(), "big")
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    """
+    64 bit DCT perceptual hash. The image is reduced to 32x32 grayscale and each bit
+    says whether one of the 8x8 lowest frequency coefficients is above their median,
+    so resizing, recompression and small edits change only a few bits
+    """
+
+    gray = np.asarray(
+        image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64
+    )
+    low = (_DCT_32 @ gray @ _DCT_32.T)[:8, :8].flatten()
+    # the DC term only measures overall brightness
+    return bits_to_int(low > np.median(low[1:]))
+
+
+def simhash(text: str, number_weight: int = 3) -> Optional[int]:
+    """
+    64 bit SimHash of the tokens in text, or None if there is no text. Texts sharing
+    most of their tokens differ in few bits, whatever their OCR noise. Receipts from
+    one vendor share most of their words, so tokens with digits (prices, totals,
+    dates and times) count number_weight times as much as words
+    """
+
+    tokens = re.findall(r"[a-z0-9]+(?:[.,:/][0-9]+)*", text.lower())
+    if not tokens:
+        return None
+    hashes = np.frombuffer(
+        b"".join(hashlib.blake2b(x.encode(), digest_size=8).digest() for x in tokens),
+        dtype=np.uint8,
+    ).reshape(-1, 8)
+    weights = np.array([number_weight if re.search(r"[0-9]", x) else 1 for x in tokens])
+    bits = np.unpackbits(hashes, axis=1).astype(np.int64)
+    return bits_to_int(((2 * bits - 1) * weights[:, None]).sum(axis=0) > 0)
+
+
+def hamming_distances(values: np.ndarray, value: int) -> np.ndarray:
+    """Bit differences between each of an array of uint64 fingerprints and value"""
+
+    xor = np.bitwise_xor(values, np.uint64(value))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
@@ -0,0 +1,190 @@
+import logging
+import math
+
+import numpy as np
+from PIL import Image
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class ReceiptImagePreprocessor:
+    """Prepare a receipt image for the vision model under a token budget.
+
+    The receipt is cropped from its background, deskewed and converted to grayscale,
+    then downscaled to the largest size whose image tiles still fit the budget. The
+    tile and token arithmetic follows OpenAI's high detail image pricing: the image is
+    fit inside 2048x2048, its short side is capped at 768, and it costs 85 tokens plus
+    170 per 512px tile.
+    """
+
+    TILE_SIZE = 512
+    BASE_TOKENS = 85
+    TOKENS_PER_TILE = 170
+    MAX_SIDE = 2048
+    MAX_SHORT_SIDE = 768
+    # analysis for cropping and deskewing runs on a copy no larger than this
+    ANALYSIS_SIZE = 800
+
+    def __init__(
+        self,
+        max_tiles: int = None,
+        max_tokens: int = None,
+        autocrop: bool = True,
+        deskew: bool = True,
+        grayscale: bool = True,
+        max_skew_angle: float = 10.0,
+        skew_angle_step: float = 0.5,
+    ):
+
+        if max_tokens is not None:
+            tiles_for_tokens = (max_tokens - self.BASE_TOKENS) // self.TOKENS_PER_TILE
+            max_tiles = (
+                tiles_for_tokens
+                if max_tiles is None
+                else min(max_tiles, tiles_for_tokens)
+            )
+        if max_tiles is not None and max_tiles < 1:
+            raise ValueError("The token budget must allow at least one image tile")
+
+        self.max_tiles = max_tiles
+        self.autocrop = autocrop
+        self.deskew = deskew
+        self.grayscale = grayscale
+        self.max_skew_angle = max_skew_angle
+        self.skew_angle_step = skew_angle_step
+
+    @classmethod
+    def billed_size(cls, width: int, height: int) -> tuple:
+        """Size the API rescales an image to before tiling it"""
+
+        scale = min(1.0, cls.MAX_SIDE / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, cls.MAX_SHORT_SIDE / min(width, height))
+        return width * scale, height * scale
+
+    @classmethod
+    def count_tiles(cls, width: int, height: int) -> int:
+
+        width, height = cls.billed_size(width, height)
+        return math.ceil(width / cls.TILE_SIZE) * math.ceil(height / cls.TILE_SIZE)
+
+    @classmethod
+    def estimate_tokens(cls, width: int, height: int) -> int:
+
+        return cls.BASE_TOKENS + cls.TOKENS_PER_TILE * cls.count_tiles(width, height)
+
+    @staticmethod
+    def otsu_threshold(gray: np.ndarray) -> float:
+
+        histogram = np.bincount(gray.ravel(), minlength=256).astype(float)
+        levels = np.arange(256)
+        weight_dark = np.cumsum(histogram)
+        weight_light = weight_dark[-1] - weight_dark
+        cumulative_mean = np.cumsum(histogram * levels)
+        mean_dark = cumulative_mean / np.maximum(weight_dark, 1)
+        mean_light = (cumulative_mean[-1] - cumulative_mean) / np.maximum(
+            weight_light, 1
+        )
+        between_variance = weight_dark * weight_light * (mean_dark - mean_light) ** 2
+        return float(np.argmax(between_variance))
+
+    def _analysis_copy(self, gray: Image.Image) -> tuple:
+
+        scale = min(1.0, self.ANALYSIS_SIZE / max(gray.size))
+        small = gray.resize(
+            (max(1, int(gray.width * scale)), max(1, int(gray.height * scale)))
+        )
+        return np.asarray(small), scale
+
+    def find_receipt_box(self, gray: Image.Image) -> tuple:
+        """Bounding box of the bright paper against a darker background"""
+
+        small, scale = self._analysis_copy(gray)
+        paper = small > self.otsu_threshold(small)
+        rows = np.flatnonzero(paper.mean(axis=1) > 0.2)
+        columns = np.flatnonzero(paper.mean(axis=0) > 0.2)
+        if rows.size == 0 or columns.size == 0:
+            return None
+
+        top, bottom = rows[0] / scale, (rows[-1] + 1) / scale
+        left, right = columns[0] / scale, (columns[-1] + 1) / scale
+        # a tiny box means the threshold picked out something other than the receipt
+        if (bottom - top) * (right - left) < 0.1 * gray.width * gray.height:
+            return None
+        return int(left), int(top), math.ceil(right), math.ceil(bottom)
+
+    def find_skew_angle(self, gray: Image.Image) -> float:
+        """Rotation that makes the text lines horizontal, by projection profile"""
+
+        small, _ = self._analysis_copy(gray)
+        ink = Image.fromarray(
+            ((small < self.otsu_threshold(small)) * 255).astype(np.uint8)
+        )
+
+        best_angle, best_score = 0.0, -1.0
+        for angle in np.arange(
+            -self.max_skew_angle,
+            self.max_skew_angle + self.skew_angle_step,
+            self.skew_angle_step,
+        ):
+            profile = np.asarray(ink.rotate(angle), dtype=float).sum(axis=1)
+            score = np.sum(np.diff(profile) ** 2)
+            if score > best_score:
+                best_angle, best_score = float(angle), score
+        return best_angle
+
+    def fit_to_budget(self, image: Image.Image) -> Image.Image:
+
+        if self.max_tiles is None or (
+            self.count_tiles(image.width, image.height) <= self.max_tiles
+        ):
+            return image
+
+        # tile count only grows with size, so bisect on the scale factor
+        low, high = 0.0, 1.0
+        for _ in range(20):
+            mid = (low + high) / 2
+            width = max(1, int(image.width * mid))
+            height = max(1, int(image.height * mid))
+            if self.count_tiles(width, height) <= self.max_tiles:
+                low = mid
+            else:
+                high = mid
+
+        size = (max(1, int(image.width * low)), max(1, int(image.height * low)))
+        return image.resize(size, Image.LANCZOS)
+
+    def process(self, image: Image.Image) -> tuple:
+
+        # what the image would have cost as given, to measure the savings against
+        original_image_tokens = self.estimate_tokens(image.width, image.height)
+        gray = image.convert("L")
+        if not self.grayscale and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        if self.autocrop:
+            box = self.find_receipt_box(gray)
+            if box is not None:
+                gray = gray.crop(box)
+                image = image.crop(box)
+
+        if self.deskew:
+            angle = self.find_skew_angle(gray)
+            if abs(angle) >= self.skew_angle_step:
+                gray = gray.rotate(angle, expand=True, fillcolor=255)
+                image = image.rotate(
+                    angle, expand=True, fillcolor=255 if image.mode == "L" else "white"
+                )
+
+        if self.grayscale:
+            image = gray
+
+        image = self.fit_to_budget(image)
+        info = {
+            "width": image.width,
+            "height": image.height,
+            "image_tiles": self.count_tiles(image.width, image.height),
+            "estimated_image_tokens": self.estimate_tokens(image.width, image.height),
+            "original_image_tokens": original_image_tokens,
+        }
+        return image, info
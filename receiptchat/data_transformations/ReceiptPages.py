@@ -0,0 +1,102 @@
+import re
+from typing import List
+
+# the fields printed at the top of a receipt and the totals printed at its end
+HEADER_FIELDS = ["vendor_name", "vendor_address", "datetime"]
+TOTAL_FIELDS = ["subtotal", "tax_rate", "total_after_tax"]
+MISSING_VALUES = {"", "n/a", "none", "null"}
+# pages rarely repeat more than a few lines or items of the page before them, and a
+# single repeated line is more likely the same thing bought twice
+MIN_OVERLAP = 2
+MAX_OVERLAP = 5
+
+
+def _longest_overlap(previous: List, following: List) -> int:
+    """Largest n such that the last n of previous are the first n of following"""
+
+    for n in range(
+        min(len(previous), len(following), MAX_OVERLAP), MIN_OVERLAP - 1, -1
+    ):
+        if previous[-n:] == following[:n]:
+            return n
+    return 0
+
+
+def _normalize_line(line: str) -> str:
+
+    return re.sub(r"\s+", " ", line).strip().lower()
+
+
+def stitch_page_texts(texts: List[str]) -> str:
+    """
+    Join the text of consecutive pages into one stream. Lines that a page repeats from
+    the end of the page before it, as scanners and printers sometimes do across a page
+    break, are dropped. A single page is returned unchanged
+    """
+
+    if len(texts) == 1:
+        return texts[0]
+
+    stitched = []
+    previous = []
+    for text in texts:
+        lines = (text or "").splitlines()
+        normalized = [_normalize_line(x) for x in lines if x.strip()]
+        n_repeated = _longest_overlap(previous, normalized)
+        if n_repeated:
+            # drop the repeated lines, skipping any blank lines around them
+            kept, dropped = [], 0
+            for line in lines:
+                if dropped < n_repeated and line.strip():
+                    dropped += 1
+                elif dropped >= n_repeated or line.strip():
+                    kept.append(line)
+            lines = kept
+        stitched += lines
+        previous = normalized
+    return "\n".join(stitched)
+
+
+def is_missing(value) -> bool:
+
+    return value is None or str(value).strip().lower() in MISSING_VALUES
+
+
+def _item_key(item: dict) -> tuple:
+
+    cost = re.sub(r"[^0-9.]", "", str(item.get("item_cost", "")))
+    return _normalize_line(str(item.get("item_name", ""))), cost
+
+
+def merge_page_receipts(receipts: List[dict]) -> dict:
+    """
+    Merge the receipts extracted from consecutive pages of one receipt. Header fields
+    come from the first page that has them and totals from the last, and the item
+    lists are concatenated, dropping items a page repeats from the end of the page
+    before it
+    """
+
+    if len(receipts) == 1:
+        return receipts[0]
+
+    merged = {}
+    for field in HEADER_FIELDS:
+        values = [x.get(field) for x in receipts if not is_missing(x.get(field))]
+        merged[field] = values[0] if values else "N/A"
+    for field in TOTAL_FIELDS:
+        values = [x.get(field) for x in receipts if not is_missing(x.get(field))]
+        merged[field] = values[-1] if values else "N/A"
+
+    items = []
+    for receipt in receipts:
+        page_items = [
+            x
+            for x in receipt.get("items_purchased") or []
+            if not (is_missing(x.get("item_name")) and is_missing(x.get("item_cost")))
+        ]
+        n_repeated = _longest_overlap(
+            [_item_key(x) for x in items], [_item_key(x) for x in page_items]
+        )
+        items += page_items[n_repeated:]
+    merged["items_purchased"] = items
+    return merged
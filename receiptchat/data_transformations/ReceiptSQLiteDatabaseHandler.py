@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+from typing import TYPE_CHECKING, List
+
+from receiptchat.data_transformations.ReceiptDatabaseHandler import (
+    ReceiptDataBaseHandler,
+)
+from receiptchat.RunMetrics import RunMetrics
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class ReceiptSQLiteDataBaseHandler(ReceiptDataBaseHandler):
+    """SQLite backed alternative to the CSV receipt database.
+
+    Receipts and their line items live in separate indexed tables. Writes are
+    upserts by receipt_id, applied in batched transactions, so an ingest only
+    touches the receipts it contains. update_database therefore returns just the
+    new rows instead of the whole database; use load_database to read everything.
+    """
+
+    DATABASE_PATH = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), "datasets", "receipt_database.db"
+    )
+    RECEIPT_COLUMNS = [
+        "receipt_id",
+        "receipt_name",
+        "receipt_type",
+        "vendor",
+        "address",
+        "date",
+    ]
+    # stay well below SQLite's limit on the number of bound parameters
+    MAX_QUERY_PARAMETERS = 500
+
+    def __init__(
+        self,
+        load_database_on_init: bool = True,
+        metrics: RunMetrics = None,
+        batch_size: int = 500,
+    ):
+
+        os.makedirs(os.path.dirname(self.DATABASE_PATH), exist_ok=True)
+
+        self.batch_size = batch_size
+        self.metrics = metrics or RunMetrics()
+        self.load_database_on_init = load_database_on_init
+        self.connection = sqlite3.connect(self.DATABASE_PATH, check_same_thread=False)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self._create_tables()
+
+        # the full table is only read on request, see load_database
+        self._database = None
+        self._database_loaded = True
+        self.receipt_ids = None
+
+    def _create_tables(self) -> None:
+
+        with self.connection:
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS receipts (
+                    receipt_id TEXT PRIMARY KEY,
+                    receipt_name TEXT,
+                    receipt_type TEXT,
+                    vendor TEXT,
+                    address TEXT,
+                    date TEXT
+                );
+                CREATE TABLE IF NOT EXISTS line_items (
+                    line_item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    receipt_id TEXT NOT NULL
+                        REFERENCES receipts (receipt_id) ON DELETE CASCADE,
+                    item_name TEXT,
+                    item_cost REAL
+                );
+                CREATE INDEX IF NOT EXISTS line_items_receipt_id ON line_items (receipt_id);
+                CREATE INDEX IF NOT EXISTS receipts_vendor ON receipts (vendor);
+                CREATE INDEX IF NOT EXISTS receipts_date ON receipts (date);
+                """
+            )
+
+    def load_database(self) -> pd.DataFrame:
+
+        import pandas as pd
+
+        database = pd.read_sql_query(
+            """
+            SELECT r.vendor, r.date, r.address, l.item_name, l.item_cost,
+                   r.receipt_id, r.receipt_name, r.receipt_type
+            FROM line_items l JOIN receipts r ON l.receipt_id = r.receipt_id
+            ORDER BY l.line_item_id
+            """,
+            self.connection,
+        )
+        database["date"] = pd.to_datetime(database["date"], errors="coerce")
+        return database
+
+    def find_new_ids(self, available_files: List) -> List:
+
+        available_ids = [file["id"] for file in available_files]
+        known_ids = set()
+        for start in range(0, len(available_ids), self.MAX_QUERY_PARAMETERS):
+            chunk = available_ids[start : start + self.MAX_QUERY_PARAMETERS]
+            rows = self.connection.execute(
+                "SELECT receipt_id FROM receipts WHERE receipt_id IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            ).fetchall()
+            known_ids.update(row[0] for row in rows)
+
+        return [file for file in available_files if file["id"] not in known_ids]
+
+    def update_database(self, collected_df: pd.DataFrame) -> pd.DataFrame:
+
+        return collected_df
+
+    def commit_to_database(self, collected_df: pd.DataFrame) -> pd.DataFrame:
+
+        self.write_to_database(collected_df)
+        return collected_df
+
+    @staticmethod
+    def _to_records(df: pd.DataFrame) -> List[tuple]:
+
+        import pandas as pd
+
+        df = df.astype(object).where(pd.notna(df), None)
+        return list(df.itertuples(index=False, name=None))
+
+    def write_to_database(self, collected_df: pd.DataFrame) -> None:
+
+        if collected_df.empty:
+            return None
+
+        with self.metrics.time_stage("database_write"):
+            self._upsert(collected_df)
+        return None
+
+    def _upsert(self, collected_df: pd.DataFrame) -> None:
+
+        import pandas as pd
+
+        collected_df = collected_df.copy()
+        collected_df["date"] = collected_df["date"].map(
+            lambda x: x.isoformat() if pd.notna(x) else None
+        )
+        receipt_ids = collected_df["receipt_id"].unique().tolist()
+
+        for start in range(0, len(receipt_ids), self.batch_size):
+            batch_ids = receipt_ids[start : start + self.batch_size]
+            batch = collected_df[collected_df["receipt_id"].isin(batch_ids)]
+            receipts = batch.drop_duplicates("receipt_id")[self.RECEIPT_COLUMNS]
+            line_items = batch[["receipt_id", "item_name", "item_cost"]]
+
+            with self.connection:
+                self.connection.executemany(
+                    """
+                    INSERT INTO receipts
+                        (receipt_id, receipt_name, receipt_type, vendor, address, date)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (receipt_id) DO UPDATE SET
+                        receipt_name = excluded.receipt_name,
+                        receipt_type = excluded.receipt_type,
+                        vendor = excluded.vendor,
+                        address = excluded.address,
+                        date = excluded.date
+                    """,
+                    self._to_records(receipts),
+                )
+                self.connection.executemany(
+                    "DELETE FROM line_items WHERE receipt_id = ?",
+                    [(receipt_id,) for receipt_id in batch_ids],
+                )
+                self.connection.executemany(
+                    "INSERT INTO line_items (receipt_id, item_name, item_cost) "
+                    "VALUES (?, ?, ?)",
+                    self._to_records(line_items),
+                )
+
+        logging.info("Upserted {} receipts".format(len(receipt_ids)))
@@ -0,0 +1,104 @@
+import re
+from typing import List, Optional
+
+from receiptchat.data_transformations.ReceiptPages import is_missing
+
+AMOUNT = re.compile(r"\d[\d,]*(?:\.\d+)?|\.\d+")
+
+
+def parse_amount(value) -> Optional[float]:
+    """
+    The amount in a cost string such as "$1,234.50", "-2.00" or "(2.00)", or None.
+    Unlike ReceiptDataBaseHandler.coerce_value, discounts keep their sign
+    """
+
+    if is_missing(value):
+        return None
+    text = str(value).strip()
+    match = AMOUNT.search(text)
+    if match is None:
+        return None
+    amount = float(match.group().replace(",", ""))
+    negative = (
+        "-" in text[: match.start()]
+        or text.endswith("-")
+        or (text.startswith("(") and text.endswith(")"))
+    )
+    return -amount if negative else amount
+
+
+class ReceiptValidator:
+    """Local arithmetic checks of an extracted receipt.
+
+    A receipt passes when it has items, its items add up to its subtotal, its subtotal
+    with tax comes to its total, and its date can be read. The tax can be given as a
+    rate ("8.25%" or 0.0825) or as an amount. A receipt without tax should total its
+    subtotal. Amounts may differ by relative_tolerance of the expected value, or by
+    absolute_tolerance for small amounts, to allow for rounding.
+    """
+
+    CHECKS = ["items", "items_sum", "tax_total", "date"]
+
+    def __init__(
+        self, relative_tolerance: float = 0.01, absolute_tolerance: float = 0.05
+    ):
+
+        self.relative_tolerance = relative_tolerance
+        self.absolute_tolerance = absolute_tolerance
+
+    def close(self, value: float, expected: float) -> bool:
+
+        return abs(value - expected) <= max(
+            self.absolute_tolerance, self.relative_tolerance * abs(expected)
+        )
+
+    def check_items_sum(self, receipt: dict) -> bool:
+
+        subtotal = parse_amount(receipt.get("subtotal"))
+        costs = [
+            parse_amount(item.get("item_cost"))
+            for item in receipt.get("items_purchased") or []
+        ]
+        if subtotal is None or any(x is None for x in costs):
+            return False
+        return self.close(sum(costs), subtotal)
+
+    def check_tax_total(self, receipt: dict) -> bool:
+
+        subtotal = parse_amount(receipt.get("subtotal"))
+        total = parse_amount(receipt.get("total_after_tax"))
+        if subtotal is None or total is None:
+            return False
+
+        tax = parse_amount(receipt.get("tax_rate"))
+        if tax is None:
+            return self.close(total, subtotal)
+        rate = tax / 100 if "%" in str(receipt["tax_rate"]) or tax >= 1 else tax
+        return self.close(total, subtotal * (1 + rate)) or self.close(
+            total, subtotal + tax
+        )
+
+    @staticmethod
+    def check_date(receipt: dict) -> bool:
+
+        import pandas as pd
+
+        # parsed as the database parses it
+        if is_missing(receipt.get("datetime")):
+            return False
+        return not pd.isna(
+            pd.to_datetime(str(receipt["datetime"]), format="mixed", errors="coerce")
+        )
+
+    def failed_checks(self, receipt: dict) -> List[str]:
+        """Names of the checks the receipt fails, empty if it passes"""
+
+        if not receipt.get("items_purchased"):
+            # the other checks mean nothing without items
+            return ["items"]
+        checks = {
+            "items_sum": self.check_items_sum,
+            "tax_total": self.check_tax_total,
+            "date": self.check_date,
+        }
+        return [name for name, check in checks.items() if not check(receipt)]
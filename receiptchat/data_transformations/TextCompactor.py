@@ -0,0 +1,156 @@
+import re
+import threading
+from collections import defaultdict
+from typing import List
+
+from receiptchat.openai.TokenCounter import TokenCounter
+
+# box drawing, block elements and other characters OCR makes of rules and logos
+NOISE_CHARACTERS = re.compile(r"[─-▟■-◿|¦_~`^*=<>«»•·]")
+SPACE_RUNS = re.compile(r"[ \t\xa0]+")
+# a run of the same punctuation, e.g. a row of dashes or dots between item and price
+REPEATED_PUNCTUATION = re.compile(r"([-.,:;'\"/\\])\1{2,}")
+# lines that are only a long string of digits, e.g. an OCR'd barcode
+BARCODE_LINE = re.compile(r"^[\d ]+$")
+# "$ 4.50" -> "$4.50"
+CURRENCY_SPACE = re.compile(r"([$€£])\s+(?=\d)")
+# "4 . 50", "4. 50", "4 .50" -> "4.50"
+SPACED_DECIMAL = re.compile(r"(\d)\s*\.\s+(\d{2})\b|(\d)\s+\.(\d{2})\b")
+# "4,50" -> "4.50", leaving thousands separators such as "1,234" alone
+DECIMAL_COMMA = re.compile(r"(\d),(\d{2})(?![\d,.])")
+
+FOOTER_PATTERNS = [
+    r"thank\s*you",
+    r"come again",
+    r"have a (nice|great|good) day",
+    r"survey",
+    r"feedback",
+    r"follow us",
+    r"like us",
+    r"www\.|https?:|\.com\b",
+    r"return policy|returns? (are|is|within|accepted)",
+    r"receipt required",
+    r"customer copy|merchant copy",
+]
+
+
+class TextCompactor:
+    """Deterministic clean-up of receipt text before it is sent to the text model.
+
+    Rules, boxes, barcodes and runs of punctuation are removed and whitespace is
+    collapsed. Lines left with fewer than min_alphanumeric letters or digits are
+    dropped, as are lines below the first header_lines that match one of
+    footer_patterns (thanks, surveys, web addresses, return policies). Prices are
+    normalized so that OCR variants such as "$ 4 . 50" and "4,50" read "$4.50" and
+    "4.50". With measure_tokens, the tokens of every text before and after
+    compaction are counted offline, by source, so the savings on inputs and on
+    examples can be reported. The token counter is only built for the first count,
+    and compaction never depends on it.
+    """
+
+    def __init__(
+        self,
+        min_alphanumeric: int = 2,
+        barcode_digits: int = 10,
+        header_lines: int = 3,
+        footer_patterns: List[str] = None,
+        normalize_prices: bool = True,
+        measure_tokens: bool = True,
+        token_counter: TokenCounter = None,
+    ):
+
+        self.min_alphanumeric = min_alphanumeric
+        self.barcode_digits = barcode_digits
+        # the vendor is printed at the top, and may well be a web address
+        self.header_lines = header_lines
+        patterns = FOOTER_PATTERNS if footer_patterns is None else footer_patterns
+        self.footer = (
+            re.compile("|".join(patterns), re.IGNORECASE) if patterns else None
+        )
+        self.normalize_prices = normalize_prices
+        self.measure_tokens = measure_tokens
+        self._token_counter = token_counter
+        self._lock = threading.Lock()
+        self.texts = defaultdict(int)
+        self.tokens_before = defaultdict(int)
+        self.tokens_after = defaultdict(int)
+
+    @property
+    def token_counter(self) -> TokenCounter:
+
+        with self._lock:
+            if self._token_counter is None:
+                self._token_counter = TokenCounter()
+            return self._token_counter
+
+    def is_low_information(self, line: str) -> bool:
+
+        if sum(c.isalnum() for c in line) < self.min_alphanumeric:
+            return True
+        return BARCODE_LINE.match(line) is not None and (
+            sum(c.isdigit() for c in line) >= self.barcode_digits
+        )
+
+    def is_footer(self, line: str) -> bool:
+
+        return self.footer is not None and self.footer.search(line) is not None
+
+    @staticmethod
+    def normalize_price_formats(line: str) -> str:
+
+        line = CURRENCY_SPACE.sub(r"\1", line)
+        line = SPACED_DECIMAL.sub(
+            lambda m: "{}.{}".format(
+                m.group(1) or m.group(3), m.group(2) or m.group(4)
+            ),
+            line,
+        )
+        return DECIMAL_COMMA.sub(r"\1.\2", line)
+
+    def compact_line(self, line: str) -> str:
+
+        line = NOISE_CHARACTERS.sub(" ", line)
+        line = REPEATED_PUNCTUATION.sub(" ", line)
+        line = SPACE_RUNS.sub(" ", line).strip()
+        if self.normalize_prices:
+            line = self.normalize_price_formats(line)
+        return line
+
+    def compact(self, text: str, source: str = "input") -> str:
+        """The compacted text, counting its tokens under source when measuring"""
+
+        kept = []
+        for line in (text or "").splitlines():
+            line = self.compact_line(line)
+            if self.is_low_information(line):
+                continue
+            if len(kept) >= self.header_lines and self.is_footer(line):
+                continue
+            kept.append(line)
+        compacted = "\n".join(kept)
+
+        if self.measure_tokens:
+            before = self.token_counter.count(text)
+            after = self.token_counter.count(compacted)
+        with self._lock:
+            self.texts[source] += 1
+            if self.measure_tokens:
+                self.tokens_before[source] += before
+                self.tokens_after[source] += after
+        return compacted
+
+    def stats(self) -> dict:
+
+        stats = {}
+        with self._lock:
+            for source in sorted(self.texts):
+                before, after = self.tokens_before[source], self.tokens_after[source]
+                stats[source + "_texts"] = self.texts[source]
+                if not self.measure_tokens:
+                    continue
+                stats[source + "_tokens_before"] = before
+                stats[source + "_tokens_after"] = after
+                stats[source + "_savings_fraction"] = (
+                    (before - after) / before if before else 0.0
+                )
+        return stats
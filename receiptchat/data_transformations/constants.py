@@ -1 +1,9 @@
 DEFAULT_DPI = 50
+# PDFs are rendered at this resolution when ReceiptImagePreprocessor picks the final size
+PREPROCESS_DPI = 150
+# resolution used when a PDF without a text layer has to be OCR'd
+OCR_DPI = 200
+# fewer alphanumeric characters than this means a PDF has no usable text layer
+MIN_TEXT_LAYER_CHARACTERS = 20
+# later pages of longer PDFs are ignored
+MAX_PDF_PAGES = 10
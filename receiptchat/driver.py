@@ -1,7 +1,6 @@
 from dotenv import load_dotenv
 import os
 from receiptchat.ReceiptParseDriver import ReceiptParseDriver
-from receiptchat.ReceiptParseExamplesGenerator import ReceiptParseExamplesGenerator
 
 
 def load_secrets(env_path=".env"):
@@ -23,6 +22,11 @@ def main():
 
 def main_generate_examples(n_examples=10):
 
+    # imported here so that main does not pay for the extractor imports
+    from receiptchat.ReceiptParseExamplesGenerator import (
+        ReceiptParseExamplesGenerator,
+    )
+
     secrets = load_secrets()
     parser = ReceiptParseExamplesGenerator(secrets)
     parser.update_examples(n_update=n_examples)
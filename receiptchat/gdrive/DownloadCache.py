@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class DownloadCache:
+    """Local blob cache for files downloaded from Google Drive.
+
+    Blobs are keyed by the Drive file id plus a version string (the md5Checksum, or
+    the modifiedTime for files without one), so a changed file is downloaded again.
+    The cache is capped at max_bytes and evicts the least recently used blobs, with
+    recency tracked through the blob file mtime. Files without a version are never
+    cached, since a change to them could not be told apart.
+    """
+
+    CACHE_PATH = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), "datasets", "download_cache"
+    )
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = 2 * 1024**3) -> None:
+
+        self.cache_dir = cache_dir or self.CACHE_PATH
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._current_bytes = sum(size for _, _, size in self._list_blobs())
+
+    @staticmethod
+    def make_key(file_id: str, version: str) -> str:
+
+        return hashlib.sha256("{}:{}".format(file_id, version).encode()).hexdigest()
+
+    def _blob_path(self, key: str) -> str:
+
+        return os.path.join(self.cache_dir, key)
+
+    def _list_blobs(self) -> list:
+
+        blobs = []
+        for entry in os.scandir(self.cache_dir):
+            # skip partially written temp files
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                blobs.append((entry.path, stat.st_mtime, stat.st_size))
+        return blobs
+
+    def get(self, file_id: str, version: str):
+
+        if version is None:
+            return None
+        path = self._blob_path(self.make_key(file_id, version))
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, file_id: str, version: str, data: bytes) -> None:
+
+        if version is None:
+            return
+        if len(data) > self.max_bytes:
+            logging.warning(
+                "File {} is larger than the download cache, not caching".format(file_id)
+            )
+            return
+
+        path = self._blob_path(self.make_key(file_id, version))
+        existing_size = os.path.getsize(path) if os.path.exists(path) else 0
+
+        # write to a temp file and rename so readers never see a partial blob
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._current_bytes += len(data) - existing_size
+            if self._current_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+
+        for path, _, size in sorted(self._list_blobs(), key=lambda x: x[1]):
+            if self._current_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._current_bytes -= size
+            self.evictions += 1
+
+    def hit_rate(self) -> float:
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate(),
+            "size_bytes": self._current_bytes,
+        }
@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+from typing import List
+from receiptchat.gdrive.GoogleDriveLoader import GoogleDriveLoader
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class GoogleDriveChangeFeed:
+    """Incremental file discovery built on the Drive changes feed.
+
+    The first run lists the whole drive and records a start page token. Later runs
+    only ask Drive for what changed since that token. The version of every file seen
+    is kept alongside the token, so files whose content changed are flagged as
+    modified and metadata-only changes (renames, sharing) are ignored.
+
+    The new token is only persisted when commit() is called, so a run that fails
+    before writing its results will see the same changes again next time.
+    """
+
+    STATE_PATH = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)),
+        "datasets",
+        "drive_changes_state.json",
+    )
+
+    def __init__(self, gdrive_loader: GoogleDriveLoader, state_path: str = None):
+
+        self.gdrive_loader = gdrive_loader
+        self.state_path = state_path or self.STATE_PATH
+        self.start_page_token, self.file_versions = self._load_state()
+        self._pending_token = None
+        self._pending_versions = {}
+
+    def _load_state(self) -> tuple:
+
+        if not os.path.exists(self.state_path):
+            return None, {}
+
+        with open(self.state_path) as f:
+            state = json.load(f)
+
+        return state.get("start_page_token"), state.get("file_versions", {})
+
+    def find_changed_files(self) -> List:
+
+        if self.start_page_token is None:
+            logging.info("No saved Drive page token, listing all files")
+            # take the token before listing so that nothing changing mid-listing is lost
+            self._pending_token = self.gdrive_loader.get_start_page_token()
+            files = self.gdrive_loader.search_for_files()
+        else:
+            files, self._pending_token = self.gdrive_loader.search_for_changes(
+                self.start_page_token
+            )
+
+        if files is None:
+            return None
+
+        # a file can appear several times in the feed, keep the latest entry
+        latest = {}
+        for file in files:
+            latest[file["id"]] = file
+
+        changed_files = []
+        self._pending_versions = {}
+        for file_id, file in latest.items():
+            version = self.gdrive_loader.file_version(file)
+            known_version = self.file_versions.get(file_id)
+            if known_version is not None and known_version == version:
+                continue
+            file["modified"] = known_version is not None
+            self._pending_versions[file_id] = version
+            changed_files.append(file)
+
+        logging.info(
+            "Found {} changed files, {} of them modified".format(
+                len(changed_files), sum(f["modified"] for f in changed_files)
+            )
+        )
+        return changed_files
+
+    def commit(self) -> None:
+
+        if self._pending_token is None:
+            return
+
+        self.file_versions.update(self._pending_versions)
+        self.start_page_token = self._pending_token
+        state = {
+            "start_page_token": self.start_page_token,
+            "file_versions": self.file_versions,
+        }
+
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
+
+        self._pending_token = None
+        self._pending_versions = {}
@@ -1,23 +1,88 @@
 import io
+import logging
+import threading
+from contextlib import contextmanager
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 import googleapiclient.discovery
-from typing import List
+from typing import Callable, List
+from receiptchat.gdrive.DownloadCache import DownloadCache
+from receiptchat.RunMetrics import RunMetrics
 
 
 class GoogleDriveLoader:
     VALID_EXTENSIONS = [".pdf", ".png", ".jpeg"]
+    FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+    FILE_FIELDS = "id, name, mimeType, size, md5Checksum, modifiedTime"
+    # largest page size accepted by the files and changes endpoints
+    PAGE_SIZE = 1000
+    # media is requested in ranges of this size, googleapiclient's default is 100MB
+    DEFAULT_CHUNK_SIZE = 8 * 1024**2
+    # downloads wait while the files being downloaded add up to more than this. Only
+    # downloads in progress count, not the bytes their callers go on to hold
+    DEFAULT_MAX_IN_FLIGHT_BYTES = 256 * 1024**2
 
-    def __init__(self, service: googleapiclient.discovery.Resource):
+    def __init__(
+        self,
+        service: googleapiclient.discovery.Resource,
+        cache: DownloadCache = None,
+        metrics: RunMetrics = None,
+        service_factory: Callable = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_in_flight_bytes: int = DEFAULT_MAX_IN_FLIGHT_BYTES,
+    ):
 
         self.service = service
+        self.cache = cache
+        self.metrics = metrics or RunMetrics()
+        # googleapiclient services are not thread safe, so every download thread builds
+        # its own. Without a factory, downloads share the service one at a time
+        self.service_factory = service_factory
+        self._local = threading.local()
+        self._service_lock = threading.Lock()
+        self.chunk_size = chunk_size
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self._in_flight = threading.Condition()
+        self.in_flight_bytes = 0
+        self.peak_in_flight_bytes = 0
+        self.n_clients = 0
+
+    @staticmethod
+    def file_version(file_details: dict):
+        """
+        Version string used to key cached downloads. Drive only reports an md5Checksum
+        for binary files, so fall back to the modification time
+        """
+
+        return file_details.get("md5Checksum") or file_details.get("modifiedTime")
+
+    @staticmethod
+    def file_details(file: dict) -> dict:
+
+        return {
+            "id": file.get("id"),
+            "name": file.get("name"),
+            "mimeType": file.get("mimeType"),
+            "size": int(file["size"]) if file.get("size") else None,
+            "md5Checksum": file.get("md5Checksum"),
+            "modifiedTime": file.get("modifiedTime"),
+        }
+
+    def is_receipt_file(self, file: dict) -> bool:
+        """
+        Client side version of the search_for_files query, used to filter the changes feed
+        """
+
+        if file.get("mimeType") == self.FOLDER_MIME_TYPE or file.get("trashed"):
+            return False
+        return any(ext in file.get("name", "") for ext in self.VALID_EXTENSIONS)
 
     def search_for_files(self) -> List:
         """
         See https://developers.google.com/drive/api/guides/search-files#python
         """
 
-        query = "mimeType != 'application/vnd.google-apps.folder' and ("
+        query = "mimeType != '{}' and (".format(self.FOLDER_MIME_TYPE)
         for i, ext in enumerate(self.VALID_EXTENSIONS):
             if i == 0:
                 query += "name contains '{}' ".format(ext)
@@ -37,24 +102,16 @@ class GoogleDriveLoader:
                     .list(
                         q=query,
                         spaces="drive",
-                        fields="nextPageToken, files(id, name)",
+                        fields="nextPageToken, files({})".format(self.FILE_FIELDS),
                         pageToken=page_token,
+                        pageSize=self.PAGE_SIZE,
                     )
                     .execute()
                 )
                 for file in response.get("files"):
                     # Process change
                     print(f'Found file: {file.get("name")}, {file.get("id")}')
-
-                    file_id = file.get("id")
-                    file_name = file.get("name")
-
-                    files.append(
-                        {
-                            "id": file_id,
-                            "name": file_name,
-                        }
-                    )
+                    files.append(self.file_details(file))
 
                 page_token = response.get("nextPageToken", None)
                 if page_token is None:
@@ -66,23 +123,170 @@ class GoogleDriveLoader:
 
         return files
 
-    def download_file(self, real_file_id: str) -> bytes:
+    def get_start_page_token(self) -> str:
+
+        # pylint: disable=maybe-no-member
+        response = self.service.changes().getStartPageToken().execute()
+        return response.get("startPageToken")
+
+    def search_for_changes(self, page_token: str) -> tuple:
+        """
+        Return the receipt files that changed since page_token, along with the token
+        to use for the next call.
+        See https://developers.google.com/drive/api/guides/manage-changes
+        """
+
+        files = []
+        new_start_page_token = None
+        try:
+            while page_token is not None:
+                # pylint: disable=maybe-no-member
+                response = (
+                    self.service.changes()
+                    .list(
+                        pageToken=page_token,
+                        spaces="drive",
+                        pageSize=self.PAGE_SIZE,
+                        fields="nextPageToken, newStartPageToken, "
+                        "changes(fileId, removed, file({}, trashed))".format(
+                            self.FILE_FIELDS
+                        ),
+                    )
+                    .execute()
+                )
+                for change in response.get("changes"):
+                    file = change.get("file")
+                    # removed files are left in the database
+                    if change.get("removed") or not file:
+                        continue
+                    if self.is_receipt_file(file):
+                        print(f'Changed file: {file.get("name")}, {file.get("id")}')
+                        files.append(self.file_details(file))
+
+                new_start_page_token = response.get(
+                    "newStartPageToken", new_start_page_token
+                )
+                page_token = response.get("nextPageToken", None)
+
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            return None, None
+
+        return files, new_start_page_token
+
+    def download_file(
+        self, real_file_id: str, version: str = None, size: int = None
+    ) -> bytes:
         """
-        Downloads a file
+        Downloads a file, serving it from the local cache if this version of it has
+        already been downloaded. size, as listed by Drive, is counted against the
+        in-flight limit, the chunk size is counted when it is not known
         """
 
+        with self.metrics.time_stage("download", real_file_id):
+            return self._cached_download_file(real_file_id, version, size)
+
+    @property
+    def thread_service(self) -> googleapiclient.discovery.Resource:
+        """The Drive service of the calling thread"""
+
+        if self.service_factory is None:
+            return self.service
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._local.service = self.service_factory()
+            with self._in_flight:
+                self.n_clients += 1
+        return service
+
+    @contextmanager
+    def in_flight(self, n_bytes: int):
+        """Wait until n_bytes more can be downloaded without passing the limit"""
+
+        # a file larger than the limit is downloaded once nothing else is in flight
+        n_bytes = min(n_bytes, self.max_in_flight_bytes)
+        with self._in_flight:
+            self._in_flight.wait_for(
+                lambda: self.in_flight_bytes + n_bytes <= self.max_in_flight_bytes
+            )
+            self.in_flight_bytes += n_bytes
+            self.peak_in_flight_bytes = max(
+                self.peak_in_flight_bytes, self.in_flight_bytes
+            )
+        try:
+            yield
+        finally:
+            with self._in_flight:
+                self.in_flight_bytes -= n_bytes
+                self._in_flight.notify_all()
+
+    def _cached_download_file(
+        self, real_file_id: str, version: str = None, size: int = None
+    ) -> bytes:
+
+        if self.cache is None:
+            return self._download_file(real_file_id, size)
+
+        if version is None:
+            version = self.file_version(self._file_metadata(real_file_id))
+        if version is None:
+            # a file Drive reports no checksum or modification time for could change
+            # unnoticed, so it is not cached
+            return self._download_file(real_file_id, size)
+
+        file_bytes = self.cache.get(real_file_id, version)
+        if file_bytes is None:
+            file_bytes = self._download_file(real_file_id, size)
+            self.cache.put(real_file_id, version, file_bytes)
+
+        return file_bytes
+
+    def _file_metadata(self, real_file_id: str) -> dict:
+
+        def get(service):
+            return (
+                service.files()
+                .get(fileId=real_file_id, fields="md5Checksum, modifiedTime")
+                .execute()
+            )
+
+        if self.service_factory is None:
+            with self._service_lock:
+                return get(self.service)
+        return get(self.thread_service)
+
+    def _download_file(self, real_file_id: str, size: int = None) -> bytes:
+
+        with self.in_flight(size or self.chunk_size):
+            if self.service_factory is None:
+                with self._service_lock:
+                    return self._download_media(self.service, real_file_id)
+            return self._download_media(self.thread_service, real_file_id)
+
+    def _download_media(
+        self, service: googleapiclient.discovery.Resource, real_file_id: str
+    ) -> bytes:
+
         try:
-            file_id = real_file_id
-            request = self.service.files().get_media(fileId=file_id)
+            request = service.files().get_media(fileId=real_file_id)
             file = io.BytesIO()
-            downloader = MediaIoBaseDownload(file, request)
+            downloader = MediaIoBaseDownload(file, request, chunksize=self.chunk_size)
             done = False
             while done is False:
                 status, done = downloader.next_chunk()
-                print(f"Download {int(status.progress() * 100)}.")
+                logging.debug(
+                    "Download {} {}%".format(real_file_id, int(status.progress() * 100))
+                )
+            return file.getvalue()
 
         except HttpError as error:
-            print(f"An error occurred: {error}")
-            file = None
+            logging.error("Download of {} failed: {}".format(real_file_id, error))
+            raise
+
+    def stats(self) -> dict:
 
-        return file.getvalue()
+        with self._in_flight:
+            return {
+                "clients": self.n_clients,
+                "peak_in_flight_bytes": self.peak_in_flight_bytes,
+            }
@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from langchain.callbacks.openai_info import OpenAICallbackHandler
+from langchain_community.adapters.openai import convert_message_to_dict
+from langchain_core.outputs import LLMResult
+from openai import OpenAI, OpenAIError
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+def usage_callback(response_body: dict = None, discount: float = 1.0):
+    """
+    An OpenAICallbackHandler holding the usage of one chat completion response, so that
+    batch results are counted the same way as get_openai_callback counts live calls
+    """
+
+    cb = OpenAICallbackHandler()
+    if response_body is not None and response_body.get("usage"):
+        cb.on_llm_end(
+            LLMResult(
+                generations=[],
+                llm_output={
+                    "token_usage": response_body["usage"],
+                    "model_name": response_body.get("model", ""),
+                },
+            )
+        )
+        cb.total_cost *= discount
+    return cb
+
+
+def combine_callbacks(callbacks: List[OpenAICallbackHandler]) -> OpenAICallbackHandler:
+    """One OpenAICallbackHandler holding the usage of several, e.g. one per page"""
+
+    cb = OpenAICallbackHandler()
+    for x in callbacks:
+        cb.prompt_tokens += x.prompt_tokens
+        cb.completion_tokens += x.completion_tokens
+        cb.total_tokens += x.total_tokens
+        cb.total_cost += x.total_cost
+        cb.successful_requests += x.successful_requests
+    return cb
+
+
+def chat_completion_body(llm, messages: List) -> dict:
+    """
+    The Chat Completions request body a ChatOpenAI model sends for messages, built from
+    its public settings so that batch requests match live calls
+    """
+
+    body = {
+        "model": llm.model_name,
+        "n": llm.n,
+        "temperature": llm.temperature,
+        **llm.model_kwargs,
+    }
+    if llm.max_tokens is not None:
+        body["max_tokens"] = llm.max_tokens
+    body["messages"] = [convert_message_to_dict(x) for x in messages]
+    return body
+
+
+class OpenAIBatchClient:
+    """Submit Chat Completions requests through the OpenAI Batch API.
+
+    Requests are written as JSONL files (split to stay under the Batch API limits on
+    requests and bytes per file), uploaded and submitted, then polled until every
+    batch has finished. Results come back keyed by custom_id. Batch requests are
+    billed at half the price of live calls and do not count against the live rate
+    limits, at the cost of a completion window of up to 24 hours.
+
+    base_url can point at any server implementing the files and batches endpoints,
+    such as receiptchat.benchmarks.LocalBatchServer.
+    """
+
+    ENDPOINT = "/v1/chat/completions"
+    COMPLETION_WINDOW = "24h"
+    BATCH_DISCOUNT = 0.5
+    FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+    UNSUCCESSFUL_STATUSES = ("failed", "expired", "cancelled")
+    MAX_REQUESTS_PER_FILE = 50000
+    MAX_BYTES_PER_FILE = 100 * 1024**2
+    REQUESTS_DIR = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), "datasets", "batch_requests"
+    )
+
+    def __init__(
+        self,
+        api_key: str = None,
+        base_url: str = None,
+        poll_interval: float = 60.0,
+        timeout: float = None,
+        requests_dir: str = None,
+        client: OpenAI = None,
+    ):
+
+        self.client = client or OpenAI(api_key=api_key, base_url=base_url)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.requests_dir = requests_dir or self.REQUESTS_DIR
+
+    @classmethod
+    def request_line(cls, custom_id: str, body: dict) -> str:
+
+        return json.dumps(
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": cls.ENDPOINT,
+                "body": body,
+            }
+        )
+
+    def write_requests(
+        self, requests: Iterable[Tuple[str, dict]], name: str
+    ) -> List[str]:
+        """Write (custom_id, body) pairs to as many JSONL files as the limits need"""
+
+        os.makedirs(self.requests_dir, exist_ok=True)
+        paths = []
+        f = None
+        n_requests = n_bytes = 0
+        try:
+            for custom_id, body in requests:
+                line = (self.request_line(custom_id, body) + "\n").encode("utf-8")
+                if (
+                    f is None
+                    or n_requests >= self.MAX_REQUESTS_PER_FILE
+                    or n_bytes + len(line) > self.MAX_BYTES_PER_FILE
+                ):
+                    if f is not None:
+                        f.close()
+                    paths.append(
+                        os.path.join(
+                            self.requests_dir, "{}-{}.jsonl".format(name, len(paths))
+                        )
+                    )
+                    f = open(paths[-1], "wb")
+                    n_requests = n_bytes = 0
+                f.write(line)
+                n_requests += 1
+                n_bytes += len(line)
+        finally:
+            if f is not None:
+                f.close()
+        return paths
+
+    def submit(self, path: str, on_submit: Callable = None) -> str:
+        """
+        Upload and submit one requests file. on_submit is called with the batch id and
+        input file id as soon as the batch exists, e.g. to record it for resuming
+        """
+
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=self.ENDPOINT,
+            completion_window=self.COMPLETION_WINDOW,
+        )
+        logging.info("Submitted batch {} from {}".format(batch.id, path))
+        if on_submit is not None:
+            on_submit(batch.id, input_file.id)
+        return batch.id
+
+    def wait(self, batch_id: str):
+
+        start = time.time()
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in self.FINISHED_STATUSES:
+                logging.info("Batch {} finished as {}".format(batch_id, batch.status))
+                return batch
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise TimeoutError(
+                    "Batch {} still {} after {}s".format(
+                        batch_id, batch.status, self.timeout
+                    )
+                )
+            time.sleep(self.poll_interval)
+
+    def read_results(self, file_id: str) -> Dict[str, dict]:
+
+        if not file_id:
+            return {}
+        content = self.client.files.content(file_id).text
+        results = {}
+        for line in content.splitlines():
+            if line.strip():
+                result = json.loads(line)
+                results[result["custom_id"]] = result
+        return results
+
+    def run(
+        self,
+        requests: Iterable[Tuple[str, dict]],
+        name: str,
+        on_submit: Callable = None,
+    ) -> Dict[str, dict]:
+        """
+        Submit every request and wait for all of them. Returns the result line for each
+        custom_id that came back, successful or not. Raises if a batch cannot be
+        retrieved or does not complete
+        """
+
+        batch_ids = [
+            self.submit(path, on_submit=on_submit)
+            for path in self.write_requests(requests, name)
+        ]
+        return self.collect(batch_ids)
+
+    def collect(
+        self, batch_ids: List[str], raise_on_failure: bool = True
+    ) -> Dict[str, dict]:
+        """
+        Wait for submitted batches and return their result lines. A batch that cannot be
+        retrieved, or that failed, expired or was cancelled, raises, or without
+        raise_on_failure is logged and returns no results
+        """
+
+        results = {}
+        for batch_id in batch_ids:
+            try:
+                batch = self.wait(batch_id)
+            except OpenAIError as error:
+                if raise_on_failure:
+                    raise
+                logging.error("Could not retrieve batch {}: {}".format(batch_id, error))
+                continue
+            if batch.status in self.UNSUCCESSFUL_STATUSES:
+                message = "Batch {} {}: {}".format(batch_id, batch.status, batch.errors)
+                if raise_on_failure:
+                    raise RuntimeError(message)
+                logging.error(message)
+                continue
+            results.update(self.read_results(batch.error_file_id))
+            results.update(self.read_results(batch.output_file_id))
+        return results
+
+    @staticmethod
+    def response_body(result: dict) -> dict:
+        """The chat completion body of a result line, raising if the request failed"""
+
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            raise RuntimeError(
+                "Batch request {} failed: {}".format(
+                    result.get("custom_id"),
+                    result.get("error") or response.get("body"),
+                )
+            )
+        return response["body"]
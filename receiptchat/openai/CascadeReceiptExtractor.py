@@ -0,0 +1,95 @@
+import logging
+import threading
+from collections import Counter
+
+from receiptchat.data_transformations.ReceiptValidator import ReceiptValidator
+from receiptchat.openai.BatchClient import combine_callbacks
+from receiptchat.openai.TextReceiptExtractor import TextReceiptExtractor
+from receiptchat.openai.VisionReceiptExtractor import VisionReceiptExtractor
+from receiptchat.RunMetrics import RunMetrics
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class CascadeReceiptExtractor:
+    """Parse receipts with the cheap text model, escalating to vision when needed.
+
+    Every receipt is first parsed from its OCR text. The result is checked locally by a
+    ReceiptValidator, and only receipts that fail a check are rendered and parsed again
+    by the vision model, whose result is kept. How many receipts were escalated, and
+    which checks they failed, is reported through stats.
+    """
+
+    def __init__(
+        self,
+        text_extractor: TextReceiptExtractor,
+        vision_extractor: VisionReceiptExtractor,
+        validator: ReceiptValidator = None,
+        metrics: RunMetrics = None,
+    ) -> None:
+
+        self.text_extractor = text_extractor
+        self.vision_extractor = vision_extractor
+        self.validator = validator or ReceiptValidator()
+        self.metrics = metrics or text_extractor.metrics
+        self._lock = threading.Lock()
+        self.n_receipts = 0
+        self.n_escalated = 0
+        self.failed_checks = Counter()
+
+    def download_file_from_gdrive(self, file_details: dict) -> dict:
+
+        return self.text_extractor.download_file_from_gdrive(file_details)
+
+    def prepare_data_for_llm(self, downloaded_data: dict) -> dict:
+
+        # images are only rendered for the receipts that are escalated
+        return self.text_extractor.prepare_data_for_llm(downloaded_data)
+
+    def parse(self, gdrive_file_details: dict) -> tuple:
+
+        file_data = self.download_file_from_gdrive(gdrive_file_details)
+        image_data = self.prepare_data_for_llm(file_data)
+        return self.parse_prepared(file_data, image_data)
+
+    def parse_prepared(self, file_data: dict, image_data: dict) -> tuple:
+
+        parsed_result, text_cb = self.text_extractor.parse_prepared(
+            file_data, image_data
+        )
+        failed_checks = self.validator.failed_checks(parsed_result)
+        with self._lock:
+            self.n_receipts += 1
+            if failed_checks:
+                self.n_escalated += 1
+                self.failed_checks.update(failed_checks)
+        if not failed_checks:
+            return parsed_result, text_cb
+
+        logging.info(
+            "Escalating {}{} to the vision model, failed {}".format(
+                file_data["filename"], file_data["extension"], ", ".join(failed_checks)
+            )
+        )
+        vision_data = self.vision_extractor.prepare_data_for_llm(
+            file_data, extract_raw_text=False
+        )
+        vision_data["extracted_text"] = image_data["extracted_text"]
+        parsed_result, vision_cb = self.vision_extractor.parse_prepared(
+            file_data, vision_data
+        )
+        return parsed_result, combine_callbacks([text_cb, vision_cb])
+
+    def stats(self) -> dict:
+
+        with self._lock:
+            stats = {
+                "receipts": self.n_receipts,
+                "escalated": self.n_escalated,
+                "escalation_rate": (
+                    self.n_escalated / self.n_receipts if self.n_receipts else 0.0
+                ),
+            }
+            for name in ReceiptValidator.CHECKS:
+                stats["failed_" + name] = self.failed_checks[name]
+        return stats
@@ -0,0 +1,114 @@
+import re
+from typing import List
+
+import numpy as np
+
+from receiptchat.openai.ExampleSelector import ExampleSelector
+
+
+class ExampleCurator:
+    """Choose a few diverse receipts to extract as few-shot examples.
+
+    Receipts are compared by the TF-IDF vectors of their OCR text that ExampleSelector
+    retrieves examples with. Receipts from the same vendor, read from the first line
+    of their text, or whose texts are at least cluster_similarity alike fall in one
+    cluster. Clusters that already hold a stored example are covered. Every other
+    cluster is represented by its most central receipt, and representatives are
+    picked farthest first: each pick is the one least like the stored examples and
+    the picks before it. At most one example is added per cluster, so a folder of
+    receipts from a handful of shops yields a handful of examples.
+    """
+
+    # the first line with this many letters is taken as the vendor
+    MIN_VENDOR_LETTERS = 3
+
+    def __init__(self, cluster_similarity: float = 0.8):
+
+        self.cluster_similarity = cluster_similarity
+        self.n_candidates = 0
+        self.n_clusters = 0
+        self.n_covered_clusters = 0
+        self.n_selected = 0
+
+    @classmethod
+    def vendor_key(cls, text: str) -> str:
+
+        # receipts print the vendor first
+        for line in (text or "").splitlines():
+            key = re.sub(r"[^a-z]+", " ", line.lower()).strip()
+            if sum(c.isalpha() for c in key) >= cls.MIN_VENDOR_LETTERS:
+                return key
+        return ""
+
+    def clusters(self, matrix: np.ndarray, vendors: List[str]) -> List[List[int]]:
+        """Connected groups of receipts that share a vendor or have similar text"""
+
+        parent = list(range(len(vendors)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        similar = np.triu(matrix @ matrix.T >= self.cluster_similarity, 1)
+        pairs = np.argwhere(similar).tolist()
+        first_by_vendor = {}
+        for i, vendor in enumerate(vendors):
+            if vendor:
+                pairs.append((first_by_vendor.setdefault(vendor, i), i))
+        for i, j in pairs:
+            parent[find(i)] = find(j)
+
+        clusters = {}
+        for i in range(len(vendors)):
+            clusters.setdefault(find(i), []).append(i)
+        return list(clusters.values())
+
+    def select(
+        self, candidate_texts: List[str], example_texts: List[str], n: int
+    ) -> List[int]:
+        """Indices of at most n candidates to extract, in the order they were picked"""
+
+        if not candidate_texts or n <= 0:
+            return []
+        texts = candidate_texts + example_texts
+        n_candidates = len(candidate_texts)
+        matrix = ExampleSelector(texts, [0] * len(texts)).matrix
+        clusters = self.clusters(matrix, [self.vendor_key(x) for x in texts])
+
+        representatives = []
+        n_covered = 0
+        # largest first, so that without stored examples the first pick is the most common
+        for cluster in sorted(clusters, key=len, reverse=True):
+            if max(cluster) >= n_candidates:
+                n_covered += 1
+                continue
+            similarity = matrix[cluster] @ matrix[cluster].T
+            representatives.append(cluster[int(np.argmax(similarity.sum(axis=1)))])
+
+        chosen = list(range(n_candidates, len(texts)))
+        selected = []
+        while representatives and len(selected) < n:
+            if chosen:
+                closest = (matrix[representatives] @ matrix[chosen].T).max(axis=1)
+                pick = representatives.pop(int(np.argmin(closest)))
+            else:
+                pick = representatives.pop(0)
+            selected.append(pick)
+            chosen.append(pick)
+
+        self.n_candidates += n_candidates
+        self.n_clusters += len(clusters)
+        self.n_covered_clusters += n_covered
+        self.n_selected += len(selected)
+        return selected
+
+    def stats(self) -> dict:
+
+        return {
+            "candidates": self.n_candidates,
+            "clusters": self.n_clusters,
+            "covered_clusters": self.n_covered_clusters,
+            "selected": self.n_selected,
+        }
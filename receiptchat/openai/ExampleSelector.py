@@ -0,0 +1,126 @@
+import logging
+import math
+import re
+import threading
+from collections import Counter
+from typing import List
+
+import numpy as np
+
+from receiptchat.openai.TokenCounter import TokenCounter
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class ExampleSelector:
+    """Pick the few-shot examples whose OCR text is most similar to the input receipt.
+
+    Builds a TF-IDF index over the example inputs once. Each call then costs one
+    sparse vectorization and a matrix-vector product. It also keeps a running count
+    of the example tokens sent against the tokens that sending every example would
+    have cost.
+    """
+
+    TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)?")
+
+    def __init__(
+        self,
+        example_texts: List[str],
+        example_tokens: List[int],
+        k: int = 3,
+    ):
+
+        self.k = k
+        self.example_tokens = example_tokens
+        self.baseline_tokens = sum(example_tokens)
+
+        documents = [self.tokenize(text) for text in example_texts]
+        document_frequency = Counter()
+        for document in documents:
+            document_frequency.update(set(document))
+
+        self.vocabulary = {term: i for i, term in enumerate(sorted(document_frequency))}
+        n_documents = len(documents)
+        self.idf = np.array(
+            [
+                math.log((1 + n_documents) / (1 + document_frequency[term])) + 1
+                for term in sorted(document_frequency)
+            ]
+        )
+        self.matrix = (
+            np.vstack([self.vectorize(document) for document in documents])
+            if documents
+            else np.zeros((0, len(self.vocabulary)))
+        )
+
+        self.calls = 0
+        self.sent_tokens = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+
+        return cls.TOKEN_PATTERN.findall((text or "").lower())
+
+    def vectorize(self, terms: List[str]) -> np.ndarray:
+
+        vector = np.zeros(len(self.vocabulary))
+        for term, count in Counter(terms).items():
+            index = self.vocabulary.get(term)
+            if index is not None:
+                vector[index] = count
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def select(self, text: str) -> List[int]:
+        """Indices of the k most similar examples, most similar first"""
+
+        if len(self.matrix) <= self.k:
+            selected = list(range(len(self.matrix)))
+        else:
+            scores = self.matrix @ self.vectorize(self.tokenize(text))
+            # stable sort so that ties keep the order of the examples file
+            selected = np.argsort(-scores, kind="stable")[: self.k].tolist()
+
+        with self._lock:
+            self.calls += 1
+            self.sent_tokens += sum(self.example_tokens[i] for i in selected)
+        return selected
+
+    def stats(self) -> dict:
+
+        baseline = self.baseline_tokens * self.calls
+        return {
+            "calls": self.calls,
+            "baseline_example_tokens": baseline,
+            "sent_example_tokens": self.sent_tokens,
+            "saved_example_tokens": baseline - self.sent_tokens,
+            "savings_fraction": (
+                (baseline - self.sent_tokens) / baseline if baseline else 0.0
+            ),
+        }
+
+    @classmethod
+    def from_examples(
+        cls,
+        raw_examples: List[dict],
+        example_messages: List[list],
+        k: int = 3,
+        token_counter: TokenCounter = None,
+    ):
+
+        token_counter = token_counter or TokenCounter()
+        example_tokens = [
+            sum(cls.message_tokens(message, token_counter) for message in messages)
+            for messages in example_messages
+        ]
+        return cls([x["input"] for x in raw_examples], example_tokens, k=k)
+
+    @staticmethod
+    def message_tokens(message, token_counter: TokenCounter) -> int:
+
+        tokens = token_counter.count(message.content)
+        for tool_call in message.additional_kwargs.get("tool_calls", []):
+            tokens += token_counter.count(tool_call["function"]["arguments"])
+        return tokens
@@ -0,0 +1,234 @@
+import logging
+import random
+import threading
+import time
+
+import openai
+
+from receiptchat.RunMetrics import RunMetrics
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class TokenBucket:
+    """Thread safe token bucket holding up to capacity, refilled continuously.
+
+    Acquiring more than is available blocks until enough has refilled. The level can
+    go negative through adjust, when a request turns out to use more than estimated,
+    which delays the requests that follow.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.paused_until = 0.0
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, limit: float) -> "TokenBucket":
+
+        return cls(limit, limit / 60.0)
+
+    def _refill(self, now: float) -> None:
+
+        self.level = min(
+            self.capacity, self.level + (now - self.updated_at) * self.refill_per_second
+        )
+        self.updated_at = now
+
+    def acquire(self, amount: float = 1) -> float:
+        """Block until amount is available and take it. Returns the seconds waited"""
+
+        # a single request larger than the whole bucket would never fit otherwise
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.level >= amount:
+                    self.level -= amount
+                    return waited
+                wait = max(
+                    self.paused_until - now,
+                    (amount - self.level) / self.refill_per_second,
+                )
+            time.sleep(wait)
+            waited += wait
+
+    def adjust(self, amount: float) -> None:
+        """Take (or give back, if negative) amount without waiting"""
+
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level - amount)
+
+    def pause(self, seconds: float) -> None:
+
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+    """Shared gate for every LLM request made by the extractors.
+
+    Each model can have requests per minute and tokens per minute limits, enforced
+    with a pair of token buckets shared across pipeline threads. A request takes one
+    request and its estimated tokens (prompt plus expected completion) before it is
+    sent, and the estimate is corrected with the real usage once it returns.
+
+    Rate limit errors, timeouts, connection errors and server errors are retried with
+    exponential backoff and full jitter, waiting at least as long as any Retry-After
+    header asks. A rate limit error also pauses that model's buckets so that the other
+    threads back off too. Without limits, no model is throttled client side and rate
+    limits are left to the API, whose 429 responses are retried after Retry-After.
+    Models without configured limits are only retried.
+    """
+
+    # OpenAI usage tier 1 limits at the time of writing, e.g. to pass as limits on an
+    # account at that tier. Accounts differ, so none are applied unless configured
+    TIER_1_LIMITS = {
+        "gpt-3.5-turbo": {"rpm": 3500, "tpm": 60000},
+        "gpt-4-vision-preview": {"rpm": 80, "tpm": 10000},
+    }
+    # expected completion size when the model has no max_tokens set
+    DEFAULT_COMPLETION_TOKENS = 500
+    RETRYABLE_ERRORS = (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+    def __init__(
+        self,
+        limits: dict = None,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        metrics: RunMetrics = None,
+    ):
+
+        self.limits = dict(limits or {})
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics or RunMetrics()
+        self.buckets = {}
+        self._lock = threading.Lock()
+        self.n_requests = 0
+        self.n_retries = 0
+        self.throttled_seconds = 0.0
+
+    def get_buckets(self, model: str) -> dict:
+
+        with self._lock:
+            if model not in self.buckets:
+                limits = self.limits.get(model, {})
+                self.buckets[model] = {
+                    name: TokenBucket.per_minute(limits[name])
+                    for name in ["rpm", "tpm"]
+                    if limits.get(name)
+                }
+            return self.buckets[model]
+
+    @classmethod
+    def completion_tokens(cls, llm) -> int:
+
+        return getattr(llm, "max_tokens", None) or cls.DEFAULT_COMPLETION_TOKENS
+
+    @staticmethod
+    def retry_after(error: Exception) -> float:
+        """Seconds the server asked us to wait, if it said"""
+
+        response = getattr(error, "response", None)
+        if response is None:
+            return 0.0
+        headers = response.headers
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return 0.0
+
+    def is_retryable(self, error: Exception) -> bool:
+
+        # an exhausted quota will not recover by waiting
+        if getattr(error, "code", None) == "insufficient_quota":
+            return False
+        return isinstance(error, self.RETRYABLE_ERRORS)
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        return max(delay, self.retry_after(error))
+
+    def call(
+        self,
+        fn,
+        model: str,
+        estimated_tokens: int = 0,
+        file_id: str = None,
+        cb=None,
+    ):
+        """
+        Run fn, a single LLM request, within the limits for model and retrying transient
+        errors. If the openai callback counting the request is given, its usage
+        corrects the estimate
+        """
+
+        buckets = self.get_buckets(model)
+        tokens_before = cb.total_tokens if cb is not None else 0
+        attempt = 0
+        while True:
+            waited = 0.0
+            if "rpm" in buckets:
+                waited += buckets["rpm"].acquire(1)
+            if "tpm" in buckets:
+                waited += buckets["tpm"].acquire(estimated_tokens)
+            with self._lock:
+                self.n_requests += 1
+                self.throttled_seconds += waited
+
+            try:
+                result = fn()
+            except Exception as e:
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                if isinstance(e, openai.RateLimitError):
+                    for bucket in buckets.values():
+                        bucket.pause(delay)
+                with self._lock:
+                    self.n_retries += 1
+                self.metrics.record_retry(file_id)
+                logging.warning(
+                    "{} request failed with {}, retrying in {:.1f}s".format(
+                        model, type(e).__name__, delay
+                    )
+                )
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if "tpm" in buckets and cb is not None:
+                # failed attempts add no usage, so this is the successful request
+                used_tokens = cb.total_tokens - tokens_before
+                if used_tokens:
+                    buckets["tpm"].adjust(used_tokens - estimated_tokens)
+            return result
+
+    def stats(self) -> dict:
+
+        with self._lock:
+            return {
+                "requests": self.n_requests,
+                "retries": self.n_retries,
+                "throttled_seconds": self.throttled_seconds,
+            }
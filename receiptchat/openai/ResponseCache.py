@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class ResponseCacheBackend(ABC):
+
+    @abstractmethod
+    def get(self, key: str):
+        """Return (value, created_at) for key, or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def evict(self, max_entries: int, expire_before: float) -> int:
+        """Drop entries created before expire_before, then the oldest beyond max_entries"""
+        raise NotImplementedError
+
+
+class SQLiteResponseCacheBackend(ResponseCacheBackend):
+
+    CACHE_PATH = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), "datasets", "llm_response_cache.db"
+    )
+
+    def __init__(self, path: str = None):
+
+        self.path = path or self.CACHE_PATH
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # extractors may be called from several pipeline threads
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)"
+            )
+
+    def get(self, key: str):
+
+        with self._lock:
+            return self.connection.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+    def set(self, key: str, value: str) -> None:
+
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+
+    def evict(self, max_entries: int, expire_before: float) -> int:
+
+        with self._lock, self.connection:
+            removed = self.connection.execute(
+                "DELETE FROM responses WHERE created_at < ?", (expire_before,)
+            ).rowcount
+            if max_entries is not None:
+                removed += self.connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                    "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,),
+                ).rowcount
+        return removed
+
+
+class ResponseCache:
+    """Persistent cache of structured LLM responses.
+
+    Keys are a hash of everything that determines the response: the model name,
+    temperature, prompts, few-shot examples and the receipt text or image bytes.
+    Calls with a temperature above zero are not deterministic, so they are never cached.
+    """
+
+    def __init__(
+        self,
+        backend: ResponseCacheBackend = None,
+        ttl_seconds: float = None,
+        max_entries: int = 50000,
+        evict_every: int = 100,
+    ):
+
+        self.backend = backend or SQLiteResponseCacheBackend()
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.evict()
+
+    @staticmethod
+    def is_cacheable(llm) -> bool:
+
+        return (getattr(llm, "temperature", 0) or 0) <= 0
+
+    @staticmethod
+    def make_key(**parts) -> str:
+
+        digest = hashlib.sha256()
+        for name in sorted(parts):
+            value = parts[name]
+            if not isinstance(value, bytes):
+                value = json.dumps(value, sort_keys=True, default=str).encode()
+            digest.update(name.encode())
+            digest.update(hashlib.sha256(value).digest())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+
+        entry = self.backend.get(key)
+        expired = (
+            entry is not None
+            and self.ttl_seconds is not None
+            and entry[1] < time.time() - self.ttl_seconds
+        )
+
+        with self._lock:
+            if entry is None or expired:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return json.loads(entry[0])
+
+    def put(self, key: str, value) -> None:
+
+        self.backend.set(key, json.dumps(value))
+        with self._lock:
+            self._writes += 1
+            should_evict = self._writes % self.evict_every == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self) -> None:
+
+        expire_before = time.time() - self.ttl_seconds if self.ttl_seconds else 0
+        removed = self.backend.evict(self.max_entries, expire_before)
+        if removed:
+            logging.info("Evicted {} cached LLM responses".format(removed))
+
+    def stats(self) -> dict:
+
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -1,3 +1,4 @@
+import json
 import uuid
 from typing import List, TypedDict
 
@@ -8,9 +9,15 @@ from langchain_core.messages import (
     ToolMessage,
 )
 from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.utils.function_calling import convert_to_openai_tool
 from receiptchat.openai.prompts import TextReceiptExtractionPrompt
 from receiptchat.openai.templates import ReceiptInformation, ReceiptItem
 from langchain.callbacks import get_openai_callback
+from receiptchat.openai.ResponseCache import ResponseCache
+from receiptchat.openai.ExampleSelector import ExampleSelector
+from receiptchat.openai.RequestScheduler import RequestScheduler
+from receiptchat.openai.TokenCounter import TokenCounter
+from receiptchat.openai.BatchClient import chat_completion_body
 
 
 class Example(TypedDict):
@@ -25,12 +32,29 @@ class Example(TypedDict):
 
 class TextReceiptExtractionChain:
 
-    def __init__(self, llm, examples):
+    def __init__(
+        self,
+        llm,
+        examples,
+        cache: ResponseCache = None,
+        n_examples: int = None,
+        scheduler: RequestScheduler = None,
+    ):
 
         self.llm = llm
         self.raw_examples = examples
+        self.cache = cache
+        self.scheduler = scheduler
+        self.token_counter = TokenCounter(llm.model_name) if scheduler else None
         self.prompt = TextReceiptExtractionPrompt()
+        self.example_messages = self.set_up_examples()
         self.chain, self.examples = self.set_up_chain()
+        # with n_examples, send only the most similar examples instead of all of them
+        self.example_selector = None
+        if n_examples is not None:
+            self.example_selector = ExampleSelector.from_examples(
+                self.raw_examples, self.example_messages, k=n_examples
+            )
 
     @staticmethod
     def tool_example_to_messages(example: Example) -> List[BaseMessage]:
@@ -103,10 +127,11 @@ class TextReceiptExtractionChain:
             for example in self.raw_examples
         ]
 
+        # one list of messages per example, so that examples can be selected per call
         messages = []
 
         for text, tool_call in examples:
-            messages.extend(
+            messages.append(
                 self.tool_example_to_messages(
                     {"input": text, "tool_calls": [tool_call]}
                 )
@@ -118,7 +143,9 @@ class TextReceiptExtractionChain:
 
         extraction_model = self.llm
         prompt = self.prompt.prompt
-        examples = self.set_up_examples()
+        examples = [
+            message for messages in self.example_messages for message in messages
+        ]
         runnable = prompt | extraction_model.with_structured_output(
             schema=ReceiptInformation,
             method="function_calling",
@@ -127,11 +154,105 @@ class TextReceiptExtractionChain:
 
         return runnable, examples
 
-    def run_and_count_tokens(self, input_dict: dict):
+    def select_examples(self, text: str) -> List[int]:
+
+        if self.example_selector is None:
+            return list(range(len(self.raw_examples)))
+        return self.example_selector.select(text)
+
+    def cache_key(self, input_dict: dict, selected: List[int]) -> str:
+
+        return self.cache.make_key(
+            model=self.llm.model_name,
+            temperature=self.llm.temperature,
+            system=self.prompt.system,
+            examples=[self.raw_examples[i] for i in selected],
+            input=input_dict["input"],
+        )
+
+    def prepare_input(self, input_dict: dict) -> tuple:
+        """Add the examples to send to the input and work out its cache key"""
+
+        selected = self.select_examples(input_dict["input"])
+        if self.example_selector is None:
+            input_dict["examples"] = self.examples
+        else:
+            input_dict["examples"] = [
+                message for i in selected for message in self.example_messages[i]
+            ]
+        cache_key = None
+        if self.cache is not None and self.cache.is_cacheable(self.llm):
+            cache_key = self.cache_key(input_dict, selected)
+
+        return input_dict, cache_key
+
+    def estimate_tokens(self, input_dict: dict) -> int:
+
+        messages = self.prompt.prompt.format_messages(**input_dict)
+        return sum(
+            ExampleSelector.message_tokens(message, self.token_counter)
+            for message in messages
+        ) + RequestScheduler.completion_tokens(self.llm)
+
+    def invoke(self, input_dict: dict, cb, file_id: str = None):
+
+        if self.scheduler is None:
+            return self.chain.invoke(input_dict)
+        return self.scheduler.call(
+            lambda: self.chain.invoke(input_dict),
+            self.llm.model_name,
+            estimated_tokens=self.estimate_tokens(input_dict),
+            file_id=file_id,
+            cb=cb,
+        )
+
+    def run_and_count_tokens(self, input_dict: dict, file_id: str = None):
+
+        input_dict, cache_key = self.prepare_input(input_dict)
 
-        # add examples
-        input_dict["examples"] = self.examples
         with get_openai_callback() as cb:
-            result = self.chain.invoke(input_dict)
+            cached = self.cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                result = ReceiptInformation.parse_obj(cached)
+            else:
+                result = self.invoke(input_dict, cb, file_id)
+                if cache_key:
+                    self.cache.put(cache_key, result.dict())
 
         return result, cb
+
+    def batch_request(self, input_dict: dict) -> dict:
+        """
+        Render the call the chain would make as a Chat Completions request body for
+        the Batch API. A cached result is returned instead of a body when there is one
+        """
+
+        input_dict, cache_key = self.prepare_input(input_dict)
+        cached = self.cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            return {
+                "cache_key": cache_key,
+                "cached": ReceiptInformation.parse_obj(cached),
+            }
+
+        messages = self.prompt.prompt.format_messages(**input_dict)
+        # the same forced function call that with_structured_output binds
+        tool = convert_to_openai_tool(ReceiptInformation)
+        body = dict(
+            chat_completion_body(self.llm, messages),
+            tools=[tool],
+            tool_choice={
+                "type": "function",
+                "function": {"name": tool["function"]["name"]},
+            },
+        )
+        return {"cache_key": cache_key, "body": body}
+
+    def parse_batch_response(self, response_body: dict, cache_key: str = None):
+
+        message = response_body["choices"][0]["message"]
+        arguments = message["tool_calls"][0]["function"]["arguments"]
+        result = ReceiptInformation.parse_obj(json.loads(arguments))
+        if cache_key:
+            self.cache.put(cache_key, result.dict())
+        return result
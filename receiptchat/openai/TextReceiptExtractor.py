@@ -1,11 +1,19 @@
 import os
-import json
+import threading
 from langchain_openai import ChatOpenAI
 from receiptchat.openai.TextReceiptExtractionChain import TextReceiptExtractionChain
+from receiptchat.openai.ResponseCache import ResponseCache
 from receiptchat.data_transformations.FileBytesToImage import (
     JpegBytesToImage,
     PDFBytesToImage,
 )
+from receiptchat.data_transformations.OCREngine import OCREngine
+from receiptchat.data_transformations.ArtifactStore import ArtifactStore
+from receiptchat.data_transformations.TextCompactor import TextCompactor
+from receiptchat.RunMetrics import RunMetrics
+from receiptchat.openai.RequestScheduler import RequestScheduler
+from receiptchat.openai.BatchClient import OpenAIBatchClient, usage_callback
+from receiptchat.ExampleStore import ExampleStore
 import logging
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
@@ -13,48 +21,80 @@ logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
 class TextReceiptExtractor:
 
-    EXAMPLES_PATH = os.path.join(
-        os.path.dirname(os.path.dirname(__file__)),
-        "datasets",
-        "example_extractions.json",
-    )
-
     def __init__(
         self,
         gdrive_service,
         api_key: str,
         temperature: int = 0,
         model: str = "gpt-3.5-turbo",
+        response_cache: ResponseCache = None,
+        ocr_engine: OCREngine = None,
+        n_examples: int = None,
+        metrics: RunMetrics = None,
+        llm=None,
+        scheduler: RequestScheduler = None,
+        example_store: ExampleStore = None,
+        artifact_store: ArtifactStore = None,
+        text_compactor: TextCompactor = None,
     ) -> None:
-        self.llm = ChatOpenAI(api_key=api_key, temperature=temperature, model=model)
-        self.examples = self._load_examples()
-        self.extractor = TextReceiptExtractionChain(self.llm, self.examples)
+        self.metrics = metrics or RunMetrics()
+        # retries are left to the scheduler, which every request goes through
+        self.llm = llm or ChatOpenAI(
+            api_key=api_key, temperature=temperature, model=model, max_retries=0
+        )
+        self.scheduler = scheduler or RequestScheduler(metrics=self.metrics)
+        self.response_cache = response_cache
+        self.n_examples = n_examples
+        self.example_store = example_store or ExampleStore()
+        # loading the examples and building their messages waits for the first call
+        self._extractor = None
+        self._extractor_lock = threading.Lock()
         self.input_parsers = {".jpeg": JpegBytesToImage(), ".pdf": PDFBytesToImage()}
         self.gdrive_service = gdrive_service
+        self.ocr_engine = ocr_engine
+        self.artifact_store = artifact_store
+        # the model is sent compacted text, examples included, the raw text is kept
+        self.text_compactor = text_compactor
+
+    @property
+    def extractor(self) -> TextReceiptExtractionChain:
+
+        with self._extractor_lock:
+            if self._extractor is None:
+                self.examples = self._load_examples()
+                self._extractor = TextReceiptExtractionChain(
+                    self.llm,
+                    self.examples,
+                    cache=self.response_cache,
+                    n_examples=self.n_examples,
+                    scheduler=self.scheduler,
+                )
+        return self._extractor
 
     def _load_examples(self):
 
-        if not os.path.exists(self.EXAMPLES_PATH):
+        if not self.example_store.exists():
             logging.warning(
                 "The examples file {} must exist in order to run TextReceiptExtractor".format(
-                    self.EXAMPLES_PATH
+                    self.example_store.store_path
                 )
             )
             return []
 
-        with open(self.EXAMPLES_PATH) as f:
-            loaded_examples = json.load(f)
-
         loaded_examples = [
-            {"input": x["file_details"]["extracted_text"], "output": x}
-            for x in loaded_examples
+            {"input": self.llm_input(x["file_details"], "example"), "output": x}
+            for x in self.example_store.load()
         ]
 
         return loaded_examples
 
     def download_file_from_gdrive(self, file_details: dict) -> dict:
         name, extension = os.path.splitext(file_details["name"])
-        downloaded_bytes = self.gdrive_service.download_file(file_details["id"])
+        downloaded_bytes = self.gdrive_service.download_file(
+            file_details["id"],
+            version=self.gdrive_service.file_version(file_details),
+            size=file_details.get("size"),
+        )
         return {
             "filename": name,
             "bytes": downloaded_bytes,
@@ -62,15 +102,36 @@ class TextReceiptExtractor:
             "id": file_details["id"],
         }
 
+    def extract_text(self, converter, file_bytes: bytes) -> str:
+
+        if self.artifact_store is not None:
+            return self.artifact_store.text(
+                converter, file_bytes, ocr_engine=self.ocr_engine
+            )
+        return converter.convert_bytes_to_text(file_bytes, ocr_engine=self.ocr_engine)
+
     def prepare_data_for_llm(self, downloaded_data: dict) -> dict:
         converter = self.input_parsers[downloaded_data["extension"]]
-        extracted_text = converter.convert_bytes_to_text(downloaded_data["bytes"])
+        with self.metrics.time_stage("ocr", downloaded_data["id"]):
+            extracted_text = self.extract_text(converter, downloaded_data["bytes"])
+
+        prepared_data = {"extracted_text": extracted_text}
+        if self.text_compactor is not None:
+            prepared_data["compacted_text"] = self.llm_input(prepared_data)
+        return prepared_data
 
-        return {"extracted_text": extracted_text}
+    def llm_input(self, data: dict, source: str = "input") -> str:
+        """The text the model is sent for prepared data or example file details"""
 
-    def call_llm(self, prepared_data: dict) -> tuple:
+        if "compacted_text" in data:
+            return data["compacted_text"]
+        if self.text_compactor is None:
+            return data["extracted_text"]
+        return self.text_compactor.compact(data["extracted_text"], source=source)
+
+    def call_llm(self, prepared_data: dict, file_id: str = None) -> tuple:
         res, cb = self.extractor.run_and_count_tokens(
-            {"input": prepared_data["extracted_text"]}
+            {"input": self.llm_input(prepared_data)}, file_id=file_id
         )
 
         return res, cb
@@ -78,13 +139,59 @@ class TextReceiptExtractor:
     def parse(self, gdrive_file_details: dict) -> tuple:
         file_data = self.download_file_from_gdrive(gdrive_file_details)
         image_data = self.prepare_data_for_llm(file_data)
-        parsed_result, cb = self.call_llm(image_data)
+        return self.parse_prepared(file_data, image_data)
+
+    def parse_prepared(self, file_data: dict, image_data: dict) -> tuple:
+        with self.metrics.time_stage("llm", file_data["id"]):
+            parsed_result, cb = self.call_llm(image_data, file_id=file_data["id"])
+        self.metrics.record_llm_usage(cb, file_data["id"])
         parsed_result = parsed_result.dict()
 
-        parsed_result["file_details"] = {
+        parsed_result["file_details"] = self.parsed_file_details(file_data, image_data)
+        return parsed_result, cb
+
+    @staticmethod
+    def parsed_file_details(file_data: dict, image_data: dict) -> dict:
+
+        return {
             "file_name": file_data["filename"],
             "file_type": file_data["extension"],
             "file_id": file_data["id"],
             "extracted_text": image_data["extracted_text"],
         }
+
+    def render_batch_request(self, gdrive_file_details: dict) -> tuple:
+
+        file_data = self.download_file_from_gdrive(gdrive_file_details)
+        image_data = self.prepare_data_for_llm(file_data)
+        return self.render_batch_request_prepared(file_data, image_data)
+
+    def render_batch_request_prepared(self, file_data: dict, image_data: dict) -> tuple:
+        """
+        Return (file_details, request) where request holds the Batch API body for the
+        file, or its cached result. Only these are kept while the batch runs
+        """
+
+        request = self.extractor.batch_request({"input": self.llm_input(image_data)})
+        return self.parsed_file_details(file_data, image_data), request
+
+    def parse_batch_result(
+        self, file_details: dict, request: dict, result: dict = None
+    ) -> tuple:
+
+        if "cached" in request:
+            parsed_result, cb = request["cached"], usage_callback()
+        else:
+            if result is None:
+                raise RuntimeError(
+                    "No batch result for {}".format(file_details["file_id"])
+                )
+            response_body = OpenAIBatchClient.response_body(result)
+            parsed_result = self.extractor.parse_batch_response(
+                response_body, request["cache_key"]
+            )
+            cb = usage_callback(response_body, OpenAIBatchClient.BATCH_DISCOUNT)
+        self.metrics.record_llm_usage(cb, file_details["file_id"])
+        parsed_result = parsed_result.dict()
+        parsed_result["file_details"] = file_details
         return parsed_result, cb
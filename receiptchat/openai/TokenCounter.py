@@ -0,0 +1,62 @@
+import logging
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class TokenCounter:
+    """Offline token counts for prompt text.
+
+    Uses the model's tiktoken encoding (tiktoken is installed with langchain-openai).
+    Without it, or when the encoding cannot be loaded, e.g. offline on first use,
+    falls back to the usual estimate of four characters per token.
+    """
+
+    FALLBACK_ENCODING = "cl100k_base"
+    CHARACTERS_PER_TOKEN = 4
+
+    # encodings by model, None where one could not be loaded, so each is tried once
+    _encodings = {}
+    _encodings_lock = threading.Lock()
+
+    def __init__(self, model: str = "gpt-3.5-turbo"):
+
+        self.model = model
+        self.encoding = None
+        if tiktoken is None:
+            logging.warning("tiktoken is not installed, token counts are estimates")
+            return
+
+        with self._encodings_lock:
+            if model not in self._encodings:
+                self._encodings[model] = self.load_encoding(model)
+            self.encoding = self._encodings[model]
+
+    @classmethod
+    def load_encoding(cls, model: str):
+
+        try:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                return tiktoken.get_encoding(cls.FALLBACK_ENCODING)
+        except Exception as error:
+            # tiktoken downloads an encoding on first use, which needs the network
+            logging.warning(
+                "Could not load the tiktoken encoding for {}, token counts are "
+                "estimates: {}".format(model, error)
+            )
+            return None
+
+    def count(self, text: str) -> int:
+
+        if not text:
+            return 0
+        if self.encoding is None:
+            return -(-len(text) // self.CHARACTERS_PER_TOKEN)
+        return len(self.encoding.encode(text, disallowed_special=()))
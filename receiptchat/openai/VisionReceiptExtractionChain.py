@@ -1,66 +1,213 @@
-from langchain.chains import TransformChain
 from langchain_core.messages import HumanMessage
-from langchain_core.runnables import chain
+from langchain_core.runnables import RunnableLambda, chain
 from langchain_core.output_parsers import JsonOutputParser
+from PIL import Image
+from typing import List
 import base64
+import hashlib
+import io
 from langchain.callbacks import get_openai_callback
 from receiptchat.openai.prompts import VisionReceiptExtractionPrompt
 from receiptchat.openai.templates import ReceiptInformation
+from receiptchat.openai.ResponseCache import ResponseCache
+from receiptchat.openai.RequestScheduler import RequestScheduler
+from receiptchat.openai.TokenCounter import TokenCounter
+from receiptchat.openai.BatchClient import chat_completion_body
+from receiptchat.data_transformations.ReceiptImagePreprocessor import (
+    ReceiptImagePreprocessor,
+)
 
 
 class VisionReceiptExtractionChain:
 
-    def __init__(self, llm):
+    def __init__(
+        self,
+        llm,
+        cache: ResponseCache = None,
+        jpeg_quality: int = 75,
+        grayscale: bool = False,
+        scheduler: RequestScheduler = None,
+    ):
         self.llm = llm
+        self.cache = cache
+        self.scheduler = scheduler
+        self.token_counter = TokenCounter(llm.model_name) if scheduler else None
+        self.jpeg_quality = jpeg_quality
+        self.grayscale = grayscale
+        self.prompt = VisionReceiptExtractionPrompt()
+        self.parser = JsonOutputParser(pydantic_object=ReceiptInformation)
         self.chain = self.set_up_chain()
 
-    @staticmethod
-    def load_image(path: dict) -> dict:
-        """Load image from file and encode it as base64."""
+    def encode_jpeg(self, image) -> bytes:
+        """Encode a PIL image, or the bytes of any image file, as JPEG in memory."""
 
-        def encode_image(path):
-            with open(path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode("utf-8")
+        if isinstance(image, (bytes, bytearray)):
+            image_bytes = bytes(image)
+            image = Image.open(io.BytesIO(image_bytes))
+            # already a JPEG and nothing to change, send it as it is
+            if image.format == "JPEG" and not self.grayscale:
+                return image_bytes
 
-        image_base64 = encode_image(path["image_path"])
-        return {"image": image_base64}
+        # keep images that were already converted to grayscale upstream
+        mode = "L" if self.grayscale or image.mode == "L" else "RGB"
+        if image.mode != mode:
+            image = image.convert(mode)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=self.jpeg_quality)
+        return buffer.getvalue()
+
+    def prepare_image(self, inputs: dict) -> bytes:
+        """
+        Return the JPEG bytes to send. Inputs may hold a PIL image under "image",
+        file bytes under "image_bytes" or, as before, a path under "image_path"
+        """
+
+        if "image" in inputs:
+            return self.encode_jpeg(inputs["image"])
+        if "image_bytes" in inputs:
+            return self.encode_jpeg(inputs["image_bytes"])
+
+        with open(inputs["image_path"], "rb") as image_file:
+            return self.encode_jpeg(image_file.read())
+
+    def prepare_images(self, inputs: dict) -> List[bytes]:
+        """
+        Return the JPEG bytes of every image to send, one per page. A list of pages can
+        be given as PIL images under "images", otherwise the input is a single image
+        """
+
+        if "jpeg_bytes" in inputs:
+            return inputs["jpeg_bytes"]
+        if "images" in inputs:
+            return [self.encode_jpeg(image) for image in inputs["images"]]
+        return [self.prepare_image(inputs)]
+
+    def load_image(self, inputs: dict) -> dict:
+        """Encode the input images as base64."""
+
+        return {
+            "image": [
+                base64.b64encode(x).decode("utf-8") for x in self.prepare_images(inputs)
+            ]
+        }
+
+    def build_messages(self, image_base64) -> list:
+
+        # the pages of a receipt are sent in order, after the instructions
+        if isinstance(image_base64, str):
+            image_base64 = [image_base64]
+        return [
+            HumanMessage(
+                content=[
+                    {"type": "text", "text": self.prompt.template},
+                    {"type": "text", "text": self.parser.get_format_instructions()},
+                ]
+                + [
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/jpeg;base64,{x}"},
+                    }
+                    for x in image_base64
+                ]
+            )
+        ]
 
     def set_up_chain(self):
         extraction_model = self.llm
-        prompt = VisionReceiptExtractionPrompt()
-        parser = JsonOutputParser(pydantic_object=ReceiptInformation)
+        build_messages = self.build_messages
 
-        load_image_chain = TransformChain(
-            input_variables=["image_path"],
-            output_variables=["image"],
-            transform=self.load_image,
-        )
+        load_image_chain = RunnableLambda(self.load_image)
 
         @chain
         def receipt_model_chain(inputs: dict) -> dict:
             """Invoke model with image and prompt."""
-            msg = extraction_model.invoke(
-                [
-                    HumanMessage(
-                        content=[
-                            {"type": "text", "text": prompt.template},
-                            {"type": "text", "text": parser.get_format_instructions()},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{inputs['image']}"
-                                },
-                            },
-                        ]
-                    )
-                ]
-            )
+            msg = extraction_model.invoke(build_messages(inputs["image"]))
             return msg.content
 
         return load_image_chain | receipt_model_chain | JsonOutputParser()
 
-    def run_and_count_tokens(self, input_dict: dict):
+    def cache_key(self, jpeg_bytes: List[bytes]) -> str:
+
+        # single images keep the keys they were cached under before pages were supported
+        if len(jpeg_bytes) == 1:
+            image = jpeg_bytes[0]
+        else:
+            image = b"".join(hashlib.sha256(x).digest() for x in jpeg_bytes)
+        return self.cache.make_key(
+            model=self.llm.model_name,
+            temperature=self.llm.temperature,
+            prompt=self.prompt.template,
+            format_instructions=self.parser.get_format_instructions(),
+            image=image,
+        )
+
+    def estimate_tokens(self, jpeg_bytes: List[bytes]) -> int:
+
+        image_tokens = 0
+        for image_bytes in jpeg_bytes:
+            width, height = Image.open(io.BytesIO(image_bytes)).size
+            image_tokens += ReceiptImagePreprocessor.estimate_tokens(width, height)
+        return (
+            self.token_counter.count(self.prompt.template)
+            + self.token_counter.count(self.parser.get_format_instructions())
+            + image_tokens
+            + RequestScheduler.completion_tokens(self.llm)
+        )
+
+    def invoke(self, input_dict: dict, cb, file_id: str = None):
+
+        if self.scheduler is None:
+            return self.chain.invoke(input_dict)
+        return self.scheduler.call(
+            lambda: self.chain.invoke(input_dict),
+            self.llm.model_name,
+            estimated_tokens=self.estimate_tokens(input_dict["jpeg_bytes"]),
+            file_id=file_id,
+            cb=cb,
+        )
+
+    def run_and_count_tokens(self, input_dict: dict, file_id: str = None):
+
+        # encode once, for both the cache key and the request
+        input_dict = {"jpeg_bytes": self.prepare_images(input_dict)}
+        cache_key = None
+        if self.cache is not None and self.cache.is_cacheable(self.llm):
+            cache_key = self.cache_key(input_dict["jpeg_bytes"])
+
         with get_openai_callback() as cb:
-            result = self.chain.invoke(input_dict)
+            cached = self.cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                result = cached
+            else:
+                result = self.invoke(input_dict, cb, file_id)
+                if cache_key:
+                    self.cache.put(cache_key, result)
 
         return result, cb
+
+    def batch_request(self, input_dict: dict) -> dict:
+        """
+        Render the call the chain would make as a Chat Completions request body for
+        the Batch API. A cached result is returned instead of a body when there is one
+        """
+
+        jpeg_bytes = self.prepare_images(input_dict)
+        cache_key = None
+        if self.cache is not None and self.cache.is_cacheable(self.llm):
+            cache_key = self.cache_key(jpeg_bytes)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return {"cache_key": cache_key, "cached": cached}
+
+        image_base64 = self.load_image({"jpeg_bytes": jpeg_bytes})["image"]
+        body = chat_completion_body(self.llm, self.build_messages(image_base64))
+        return {"cache_key": cache_key, "body": body}
+
+    def parse_batch_response(self, response_body: dict, cache_key: str = None):
+
+        content = response_body["choices"][0]["message"]["content"]
+        result = JsonOutputParser().parse(content)
+        if cache_key:
+            self.cache.put(cache_key, result)
+        return result
@@ -1,11 +1,29 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from langchain_openai import ChatOpenAI
 from receiptchat.openai.VisionReceiptExtractionChain import VisionReceiptExtractionChain
+from receiptchat.openai.ResponseCache import ResponseCache
 from receiptchat.data_transformations.FileBytesToImage import (
     JpegBytesToImage,
     PDFBytesToImage,
 )
-from tempfile import NamedTemporaryFile
+from receiptchat.data_transformations.OCREngine import OCREngine
+from receiptchat.data_transformations.ArtifactStore import ArtifactStore
+from receiptchat.data_transformations.ReceiptImagePreprocessor import (
+    ReceiptImagePreprocessor,
+)
+from receiptchat.data_transformations.constants import DEFAULT_DPI, PREPROCESS_DPI
+from receiptchat.RunMetrics import RunMetrics
+from receiptchat.openai.RequestScheduler import RequestScheduler
+from receiptchat.openai.BatchClient import (
+    OpenAIBatchClient,
+    combine_callbacks,
+    usage_callback,
+)
+from receiptchat.data_transformations.ReceiptPages import merge_page_receipts
+import logging
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
 
 class VisionReceiptExtractor:
@@ -16,17 +34,50 @@ class VisionReceiptExtractor:
         api_key: str,
         temperature: int = 0,
         model: str = "gpt-4-vision-preview",
+        response_cache: ResponseCache = None,
+        ocr_engine: OCREngine = None,
+        jpeg_quality: int = 75,
+        grayscale: bool = False,
+        preprocessor: ReceiptImagePreprocessor = None,
+        metrics: RunMetrics = None,
+        llm=None,
+        scheduler: RequestScheduler = None,
+        pages_per_request: int = 1,
+        artifact_store: ArtifactStore = None,
     ) -> None:
 
-        self.llm = ChatOpenAI(api_key=api_key, temperature=temperature, model=model)
-        self.extractor = VisionReceiptExtractionChain(self.llm)
+        self.metrics = metrics or RunMetrics()
+        # retries are left to the scheduler, which every request goes through
+        self.llm = llm or ChatOpenAI(
+            api_key=api_key, temperature=temperature, model=model, max_retries=0
+        )
+        self.scheduler = scheduler or RequestScheduler(metrics=self.metrics)
+        self.extractor = VisionReceiptExtractionChain(
+            self.llm,
+            cache=response_cache,
+            jpeg_quality=jpeg_quality,
+            grayscale=grayscale,
+            scheduler=self.scheduler,
+        )
         self.input_parsers = {".jpeg": JpegBytesToImage(), ".pdf": PDFBytesToImage()}
         self.gdrive_service = gdrive_service
+        self.ocr_engine = ocr_engine
+        # rendered pages and OCR text are reused from here when given
+        self.artifact_store = artifact_store
+        self.preprocessor = preprocessor
+        # the pages of a receipt are sent in groups of this size, the groups in parallel
+        self.pages_per_request = pages_per_request
+        # with a preprocessor, render PDFs finely and let it choose the final resolution
+        self.dpi = PREPROCESS_DPI if preprocessor is not None else DEFAULT_DPI
 
     def download_file_from_gdrive(self, file_details: dict) -> dict:
 
         name, extension = os.path.splitext(file_details["name"])
-        downloaded_bytes = self.gdrive_service.download_file(file_details["id"])
+        downloaded_bytes = self.gdrive_service.download_file(
+            file_details["id"],
+            version=self.gdrive_service.file_version(file_details),
+            size=file_details.get("size"),
+        )
         return {
             "filename": name,
             "bytes": downloaded_bytes,
@@ -34,40 +85,176 @@ class VisionReceiptExtractor:
             "id": file_details["id"],
         }
 
+    def render_pages(self, converter, file_bytes: bytes, document=None) -> list:
+
+        if self.artifact_store is not None:
+            return self.artifact_store.jpegs(
+                converter, file_bytes, dpi=self.dpi, document=document
+            )
+        return converter.convert_bytes_to_jpegs(
+            file_bytes, dpi=self.dpi, document=document
+        )
+
+    def extract_text(self, converter, file_bytes: bytes, document=None) -> str:
+
+        if self.artifact_store is not None:
+            return self.artifact_store.text(
+                converter, file_bytes, ocr_engine=self.ocr_engine, document=document
+            )
+        return converter.convert_bytes_to_text(
+            file_bytes, ocr_engine=self.ocr_engine, document=document
+        )
+
     def prepare_data_for_llm(
-        self, downloaded_data: dict, extract_raw_text: bool
+        self, downloaded_data: dict, extract_raw_text: bool = True
     ) -> dict:
 
+        file_id = downloaded_data["id"]
         converter = self.input_parsers[downloaded_data["extension"]]
-        loaded_data = converter.convert_bytes_to_jpeg(downloaded_data["bytes"], dpi=50)
+        file_bytes = downloaded_data["bytes"]
+        with self.metrics.time_stage("convert", file_id):
+            # parsed once for both the pages and the text
+            document = converter.read_document(file_bytes) if extract_raw_text else None
+            pages = self.render_pages(converter, file_bytes, document)
         if extract_raw_text:
-            extracted_text = converter.convert_bytes_to_text(downloaded_data["bytes"])
+            with self.metrics.time_stage("ocr", file_id):
+                extracted_text = self.extract_text(converter, file_bytes, document)
         else:
             extracted_text = ""
 
-        return {"image": loaded_data, "extracted_text": extracted_text}
+        if self.preprocessor is not None:
+            with self.metrics.time_stage("preprocess", file_id):
+                pages, image_info = self.preprocess_pages(pages)
+            self.metrics.record_image_tokens(
+                image_info["estimated_image_tokens"],
+                image_info["original_image_tokens"],
+                file_id,
+            )
+            logging.info(
+                "Prepared {}{} at {}x{}, estimated {} image tokens".format(
+                    downloaded_data["filename"],
+                    downloaded_data["extension"],
+                    image_info["width"],
+                    image_info["height"],
+                    image_info["estimated_image_tokens"],
+                )
+            )
+        else:
+            image_info = {}
+
+        # the first page stands for the receipt, e.g. when fingerprinting it
+        prepared_data = {"image": pages[0], "extracted_text": extracted_text}
+        if len(pages) > 1:
+            prepared_data["pages"] = pages
+        prepared_data.update(image_info)
+        return prepared_data
 
-    def call_llm(self, prepared_data: dict) -> tuple:
+    def preprocess_pages(self, pages: list) -> tuple:
+        """
+        Preprocess every page in parallel. The returned info describes the first page,
+        except for the tile and token estimates, which cover all of them
+        """
 
-        with NamedTemporaryFile(suffix=".jpeg") as temp_file:
-            prepared_data["image"].save(temp_file.name)
+        if len(pages) == 1:
+            image, image_info = self.preprocessor.process(pages[0])
+            return [image], image_info
+
+        with ThreadPoolExecutor(len(pages)) as pool:
+            processed = list(pool.map(self.preprocessor.process, pages))
+        image_info = dict(processed[0][1])
+        for name in ["image_tiles", "estimated_image_tokens", "original_image_tokens"]:
+            image_info[name] = sum(info[name] for _, info in processed)
+        image_info["pages"] = len(pages)
+        return [image for image, _ in processed], image_info
+
+    def call_llm(self, prepared_data: dict, file_id: str = None) -> tuple:
+
+        pages = prepared_data.get("pages")
+        if not pages:
             res, cb = self.extractor.run_and_count_tokens(
-                {"image_path": temp_file.name}
+                {"image": prepared_data["image"]}, file_id=file_id
             )
+            return res, cb
 
-
-        return res, cb
+        # a long receipt takes about as long as one page, and its page results are merged
+        groups = [
+            pages[i : i + self.pages_per_request]
+            for i in range(0, len(pages), self.pages_per_request)
+        ]
+        with ThreadPoolExecutor(len(groups)) as pool:
+            results = list(
+                pool.map(
+                    lambda group: self.extractor.run_and_count_tokens(
+                        {"images": group}, file_id=file_id
+                    ),
+                    groups,
+                )
+            )
+        return (
+            merge_page_receipts([res for res, _ in results]),
+            combine_callbacks([cb for _, cb in results]),
+        )
 
     def parse(self, gdrive_file_details: dict, extract_raw_text: bool = True) -> tuple:
 
         file_data = self.download_file_from_gdrive(gdrive_file_details)
         image_data = self.prepare_data_for_llm(file_data, extract_raw_text)
-        parsed_result, cb = self.call_llm(image_data)
+        return self.parse_prepared(file_data, image_data)
+
+    def parse_prepared(self, file_data: dict, image_data: dict) -> tuple:
+
+        with self.metrics.time_stage("llm", file_data["id"]):
+            parsed_result, cb = self.call_llm(image_data, file_id=file_data["id"])
+        self.metrics.record_llm_usage(cb, file_data["id"])
+
+        parsed_result["file_details"] = self.parsed_file_details(file_data, image_data)
+        return parsed_result, cb
 
-        parsed_result["file_details"] = {
+    @staticmethod
+    def parsed_file_details(file_data: dict, image_data: dict) -> dict:
+
+        return {
             "file_name": file_data["filename"],
             "file_type": file_data["extension"],
             "file_id": file_data["id"],
             "extracted_text": image_data["extracted_text"],
         }
+
+    def render_batch_request(self, gdrive_file_details: dict) -> tuple:
+
+        file_data = self.download_file_from_gdrive(gdrive_file_details)
+        image_data = self.prepare_data_for_llm(file_data)
+        return self.render_batch_request_prepared(file_data, image_data)
+
+    def render_batch_request_prepared(self, file_data: dict, image_data: dict) -> tuple:
+        """
+        Return (file_details, request) where request holds the Batch API body for the
+        file, or its cached result. Only these are kept while the batch runs
+        """
+
+        # batches are not waited on, so every page goes in a single request
+        if image_data.get("pages"):
+            request = self.extractor.batch_request({"images": image_data["pages"]})
+        else:
+            request = self.extractor.batch_request({"image": image_data["image"]})
+        return self.parsed_file_details(file_data, image_data), request
+
+    def parse_batch_result(
+        self, file_details: dict, request: dict, result: dict = None
+    ) -> tuple:
+
+        if "cached" in request:
+            parsed_result, cb = request["cached"], usage_callback()
+        else:
+            if result is None:
+                raise RuntimeError(
+                    "No batch result for {}".format(file_details["file_id"])
+                )
+            response_body = OpenAIBatchClient.response_body(result)
+            parsed_result = self.extractor.parse_batch_response(
+                response_body, request["cache_key"]
+            )
+            cb = usage_callback(response_body, OpenAIBatchClient.BATCH_DISCOUNT)
+        self.metrics.record_llm_usage(cb, file_details["file_id"])
+        parsed_result["file_details"] = file_details
         return parsed_result, cb
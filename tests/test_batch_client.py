@@ -0,0 +1,250 @@
+import json
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_openai import ChatOpenAI
+
+from receiptchat.openai.BatchClient import OpenAIBatchClient, chat_completion_body
+from receiptchat.RunJournal import RunJournal
+
+
+class CapturedRequest(Exception):
+    pass
+
+
+class CapturingCompletions:
+
+    def __init__(self):
+
+        self.kwargs = None
+
+    def create(self, **kwargs):
+
+        self.kwargs = kwargs
+        raise CapturedRequest()
+
+
+@pytest.mark.parametrize(
+    "llm_kwargs",
+    [
+        {"model": "gpt-3.5-turbo", "temperature": 0},
+        {"model": "gpt-4-vision-preview", "temperature": 0.2, "max_tokens": 300},
+        {"model": "gpt-3.5-turbo", "model_kwargs": {"seed": 7}},
+    ],
+)
+def test_chat_completion_body_matches_live_request(llm_kwargs):
+
+    llm = ChatOpenAI(api_key="test-key", max_retries=0, **llm_kwargs)
+    completions = CapturingCompletions()
+    llm.client = completions
+    messages = [
+        SystemMessage(content="Extract the receipt"),
+        AIMessage(content="Send the receipt"),
+        HumanMessage(
+            content=[
+                {"type": "text", "text": "Here it is"},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": "data:image/jpeg;base64,AAAA"},
+                },
+            ]
+        ),
+    ]
+
+    with pytest.raises(CapturedRequest):
+        llm.invoke(messages)
+
+    live_request = dict(completions.kwargs)
+    live_request.pop("stream", None)
+    assert chat_completion_body(llm, messages) == live_request
+
+
+class FakeFiles:
+
+    def __init__(self):
+
+        self.contents = {}
+
+    def create(self, file, purpose):
+
+        file_id = "file-{}".format(len(self.contents))
+        self.contents[file_id] = file.read().decode("utf-8")
+        return SimpleNamespace(id=file_id)
+
+    def content(self, file_id):
+
+        return SimpleNamespace(text=self.contents[file_id])
+
+
+class FakeBatches:
+    """Batches finish with the status given for them, completed by default"""
+
+    def __init__(self, files, statuses=None):
+
+        self.files = files
+        self.statuses = statuses or {}
+        self.created = {}
+
+    def create(self, input_file_id, endpoint, completion_window):
+
+        batch_id = "batch-{}".format(len(self.created))
+        self.created[batch_id] = input_file_id
+        return SimpleNamespace(id=batch_id)
+
+    def retrieve(self, batch_id):
+
+        if batch_id not in self.created:
+            request = httpx.Request("GET", "https://api.openai.com/v1/batches")
+            raise openai.NotFoundError(
+                "No batch " + batch_id,
+                response=httpx.Response(404, request=request),
+                body=None,
+            )
+        status = self.statuses.get(batch_id, "completed")
+        if status != "completed":
+            return SimpleNamespace(
+                status=status, errors=None, output_file_id=None, error_file_id=None
+            )
+        lines = [
+            json.loads(line)
+            for line in self.files.contents[self.created[batch_id]].splitlines()
+        ]
+        output = "\n".join(
+            json.dumps(
+                {
+                    "custom_id": line["custom_id"],
+                    "response": {"status_code": 200, "body": {"echo": line["body"]}},
+                    "error": None,
+                }
+            )
+            for line in lines
+        )
+        output_file_id = "output-" + batch_id
+        self.files.contents[output_file_id] = output
+        return SimpleNamespace(
+            status=status,
+            errors=None,
+            output_file_id=output_file_id,
+            error_file_id=None,
+        )
+
+
+@pytest.fixture
+def fake_client():
+
+    files = FakeFiles()
+    return SimpleNamespace(files=files, batches=FakeBatches(files))
+
+
+@pytest.fixture
+def batch_client(fake_client, tmp_path):
+
+    return OpenAIBatchClient(
+        client=fake_client, poll_interval=0, requests_dir=str(tmp_path / "requests")
+    )
+
+
+def requests(*file_ids):
+
+    return [(file_id, {"file": file_id}) for file_id in file_ids]
+
+
+def test_run_returns_a_result_per_request(batch_client):
+
+    results = batch_client.run(requests("a", "b"), name="run-1")
+
+    assert set(results) == {"a", "b"}
+    assert OpenAIBatchClient.response_body(results["a"]) == {"echo": {"file": "a"}}
+
+
+def test_requests_are_split_across_files(batch_client, monkeypatch):
+
+    monkeypatch.setattr(OpenAIBatchClient, "MAX_REQUESTS_PER_FILE", 2)
+    submitted = []
+
+    results = batch_client.run(
+        requests("a", "b", "c"),
+        name="run-1",
+        on_submit=lambda batch_id, input_file_id: submitted.append(batch_id),
+    )
+
+    assert submitted == ["batch-0", "batch-1"]
+    assert set(results) == {"a", "b", "c"}
+
+
+@pytest.mark.parametrize("status", ["failed", "expired", "cancelled"])
+def test_unsuccessful_batch_raises(batch_client, fake_client, status):
+
+    fake_client.batches.statuses["batch-0"] = status
+
+    with pytest.raises(RuntimeError, match=status):
+        batch_client.run(requests("a"), name="run-1")
+
+
+@pytest.mark.parametrize("status", ["failed", "expired", "cancelled"])
+def test_collect_skips_unsuccessful_batches(batch_client, fake_client, status):
+
+    [path_a] = batch_client.write_requests(requests("a"), "run-1")
+    [path_b] = batch_client.write_requests(requests("b"), "run-2")
+    batch_ids = [batch_client.submit(path_a), batch_client.submit(path_b)]
+    fake_client.batches.statuses["batch-0"] = status
+
+    assert set(batch_client.collect(batch_ids, raise_on_failure=False)) == {"b"}
+
+
+def test_collect_skips_batches_that_cannot_be_retrieved(batch_client):
+
+    [path] = batch_client.write_requests(requests("a"), "run-1")
+    batch_ids = ["batch-unknown", batch_client.submit(path)]
+
+    with pytest.raises(openai.NotFoundError):
+        batch_client.collect(batch_ids)
+    assert set(batch_client.collect(batch_ids, raise_on_failure=False)) == {"a"}
+
+
+def test_failed_request_raises_on_its_body():
+
+    result = {
+        "custom_id": "a",
+        "response": {"status_code": 400, "body": {"error": "bad request"}},
+        "error": None,
+    }
+
+    with pytest.raises(RuntimeError, match="Batch request a failed"):
+        OpenAIBatchClient.response_body(result)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_interrupted_run_is_resumed_without_resubmitting(
+    batch_client, fake_client, tmp_path
+):
+
+    journal = RunJournal(str(tmp_path / "run_journal.db"))
+    journal.record_batch_requests(
+        "run-1", "gpt-3.5-turbo", {x: {"cache_key": x} for x in ["a", "b"]}
+    )
+
+    def stop_after_submitting(batch_id, input_file_id):
+        journal.record_batch("run-1", batch_id, input_file_id)
+        raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        batch_client.run(
+            requests("a", "b"), name="run-1", on_submit=stop_after_submitting
+        )
+
+    # the next run collects the batch from the journal
+    resumed = RunJournal(journal.journal_path)
+    [run] = resumed.pending_batch_runs("gpt-3.5-turbo")
+    results = batch_client.collect(run["batch_ids"], raise_on_failure=False)
+
+    assert set(results) == set(run["requests"]) == {"a", "b"}
+    assert list(fake_client.batches.created) == ["batch-0"]
+    resumed.clear_batch_runs([run["run_id"]])
+    assert resumed.pending_batch_runs("gpt-3.5-turbo") == []
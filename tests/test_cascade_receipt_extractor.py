@@ -0,0 +1,131 @@
+import pytest
+from langchain.callbacks.openai_info import OpenAICallbackHandler
+
+from receiptchat.openai.CascadeReceiptExtractor import CascadeReceiptExtractor
+
+
+def receipt(**fields):
+
+    data = {
+        "vendor": "Corner Shop",
+        "datetime": "2023-04-01 10:15",
+        "items_purchased": [
+            {"item_name": "bread", "item_cost": "$2.50"},
+            {"item_name": "milk", "item_cost": "$1.50"},
+        ],
+        "subtotal": "$4.00",
+        "tax_rate": "10%",
+        "total_after_tax": "$4.40",
+    }
+    data.update(fields)
+    return data
+
+
+def callback(total_tokens: int, total_cost: float) -> OpenAICallbackHandler:
+
+    cb = OpenAICallbackHandler()
+    cb.total_tokens = total_tokens
+    cb.total_cost = total_cost
+    cb.successful_requests = 1
+    return cb
+
+
+class FakeExtractor:
+    """Returns a fixed result per filename and records what it was asked to parse"""
+
+    def __init__(self, results: dict, total_tokens: int, total_cost: float):
+
+        self.results = results
+        self.total_tokens = total_tokens
+        self.total_cost = total_cost
+        self.metrics = None
+        self.prepared = []
+        self.parsed = []
+
+    def prepare_data_for_llm(self, file_data: dict, extract_raw_text: bool = True):
+
+        self.prepared.append((file_data["filename"], extract_raw_text))
+        return {"extracted_text": "text of " + file_data["filename"]}
+
+    def parse_prepared(self, file_data: dict, image_data: dict) -> tuple:
+
+        self.parsed.append((file_data["filename"], image_data["extracted_text"]))
+        return (
+            self.results[file_data["filename"]],
+            callback(self.total_tokens, self.total_cost),
+        )
+
+
+def file_data(filename: str) -> dict:
+
+    return {"filename": filename, "extension": ".pdf", "file": b""}
+
+
+@pytest.fixture
+def cascade():
+
+    text = FakeExtractor(
+        {
+            "good": receipt(),
+            "bad_total": receipt(total_after_tax="$9.99"),
+            "no_items": receipt(items_purchased=[]),
+        },
+        total_tokens=100,
+        total_cost=0.001,
+    )
+    vision = FakeExtractor(
+        {"bad_total": receipt(vendor="Vision"), "no_items": receipt(vendor="Vision")},
+        total_tokens=1000,
+        total_cost=0.01,
+    )
+    return CascadeReceiptExtractor(text, vision)
+
+
+def parse(cascade, filename):
+
+    data = file_data(filename)
+    return cascade.parse_prepared(data, cascade.prepare_data_for_llm(data))
+
+
+def test_valid_receipt_is_not_escalated(cascade):
+
+    result, cb = parse(cascade, "good")
+
+    assert result["vendor"] == "Corner Shop"
+    assert cb.total_tokens == 100
+    assert cascade.vision_extractor.prepared == []
+    assert cascade.vision_extractor.parsed == []
+
+
+def test_failing_receipt_is_escalated_to_vision(cascade):
+
+    result, cb = parse(cascade, "bad_total")
+
+    # the vision result is kept, and the usage of both models is reported
+    assert result["vendor"] == "Vision"
+    assert cb.total_tokens == 1100
+    assert cb.total_cost == pytest.approx(0.011)
+    assert cb.successful_requests == 2
+    # only images are rendered for vision, the OCR text is reused
+    assert cascade.vision_extractor.prepared == [("bad_total", False)]
+    assert cascade.vision_extractor.parsed == [("bad_total", "text of bad_total")]
+
+
+def test_escalation_stats(cascade):
+
+    for filename in ["good", "bad_total", "no_items", "good"]:
+        parse(cascade, filename)
+
+    stats = cascade.stats()
+    assert stats["receipts"] == 4
+    assert stats["escalated"] == 2
+    assert stats["escalation_rate"] == 0.5
+    assert stats["failed_tax_total"] == 1
+    assert stats["failed_items"] == 1
+    assert stats["failed_items_sum"] == 0
+    assert stats["failed_date"] == 0
+
+
+def test_stats_before_any_receipt(cascade):
+
+    assert cascade.stats()["escalation_rate"] == 0.0
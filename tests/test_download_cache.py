@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from receiptchat.gdrive.DownloadCache import DownloadCache
+from receiptchat.gdrive.GoogleDriveLoader import GoogleDriveLoader
+
+
+@pytest.fixture
+def cache(tmp_path):
+
+    return DownloadCache(str(tmp_path), max_bytes=30)
+
+
+def set_last_used(cache, file_id, version, timestamp):
+
+    path = cache._blob_path(cache.make_key(file_id, version))
+    os.utime(path, (timestamp, timestamp))
+
+
+def test_put_and_get(cache):
+
+    cache.put("a", "v1", b"first")
+
+    assert cache.get("a", "v1") == b"first"
+    assert cache.get("a", "v2") is None
+    assert cache.get("b", "v1") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_a_new_version_is_a_miss(cache):
+
+    cache.put("a", "v1", b"first")
+    cache.put("a", "v2", b"second")
+
+    assert cache.get("a", "v1") == b"first"
+    assert cache.get("a", "v2") == b"second"
+
+
+def test_files_without_a_version_are_not_cached(cache):
+
+    cache.put("a", None, b"data")
+
+    assert cache.get("a", None) is None
+    assert cache.stats()["size_bytes"] == 0
+
+
+def test_least_recently_used_blobs_are_evicted(cache):
+
+    for i, file_id in enumerate(["a", "b", "c"]):
+        cache.put(file_id, "v", b"x" * 10)
+        set_last_used(cache, file_id, "v", 1000 + i)
+    # reading a makes b the least recently used
+    assert cache.get("a", "v") is not None
+
+    cache.put("d", "v", b"x" * 10)
+
+    assert cache.get("b", "v") is None
+    assert cache.get("a", "v") is not None
+    assert cache.get("c", "v") is not None
+    assert cache.get("d", "v") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size_bytes"] == 30
+
+
+def test_blobs_larger_than_the_cache_are_not_stored(cache):
+
+    cache.put("a", "v", b"x" * 31)
+
+    assert cache.get("a", "v") is None
+    assert cache.stats()["size_bytes"] == 0
+
+
+def test_replacing_a_blob_does_not_count_it_twice(cache):
+
+    cache.put("a", "v", b"x" * 10)
+    cache.put("a", "v", b"x" * 12)
+
+    assert cache.stats()["size_bytes"] == 12
+
+
+def test_size_is_restored_when_reopened(tmp_path):
+
+    DownloadCache(str(tmp_path), max_bytes=30).put("a", "v", b"x" * 10)
+    # partially written blobs are ignored
+    (tmp_path / ".partial").write_bytes(b"x" * 5)
+
+    reopened = DownloadCache(str(tmp_path), max_bytes=30)
+
+    assert reopened.stats()["size_bytes"] == 10
+    assert reopened.get("a", "v") == b"x" * 10
+
+
+class CountingLoader(GoogleDriveLoader):
+    """A loader whose Drive reports metadata and returns a new body on every download"""
+
+    def __init__(self, cache, metadata):
+
+        super().__init__(None, cache=cache)
+        self.metadata = metadata
+        self.downloads = 0
+
+    def _file_metadata(self, real_file_id):
+
+        return self.metadata
+
+    def _download_file(self, real_file_id, size=None):
+
+        self.downloads += 1
+        return "body {}".format(self.downloads).encode()
+
+
+def test_loader_serves_cached_versions(cache):
+
+    loader = CountingLoader(cache, {"md5Checksum": "abc"})
+
+    assert loader.download_file("a") == b"body 1"
+    assert loader.download_file("a") == b"body 1"
+    assert loader.downloads == 1
+
+
+def test_loader_downloads_files_without_a_version_every_time(cache):
+
+    loader = CountingLoader(cache, {})
+
+    assert loader.download_file("a") == b"body 1"
+    assert loader.download_file("a") == b"body 2"
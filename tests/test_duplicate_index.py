@@ -0,0 +1,199 @@
+import pytest
+from PIL import Image, ImageDraw
+
+from receiptchat.DuplicateIndex import DuplicateIndex
+
+RECEIPT_TEXT = """TRADER JOE'S
+123 Main St
+BANANAS 0.99
+MILK 3.49
+EGGS 4.29
+SUBTOTAL 8.77
+TOTAL 8.77
+03/04/2024 10:15"""
+OTHER_RECEIPT_TEXT = """SAFEWAY
+88 Market Rd
+APPLES 2.99
+BREAD 4.49
+COFFEE 9.99
+SUBTOTAL 17.47
+TOTAL 18.91
+05/06/2024 18:02"""
+
+
+@pytest.fixture
+def index(tmp_path):
+
+    return DuplicateIndex(str(tmp_path / "duplicate_index.db"))
+
+
+def flip_bits(value, n_bits, offset=0):
+
+    return value ^ sum(1 << (offset + i) for i in range(n_bits))
+
+
+def fingerprint(receipt_id, md5=None, phash=None, simhash=None):
+
+    return {"receipt_id": receipt_id, "md5": md5, "phash": phash, "simhash": simhash}
+
+
+def render(text):
+
+    image = Image.new("L", (300, 300), 255)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(text.splitlines()):
+        draw.text((20, 20 + 30 * i), line, fill=0)
+    return image
+
+
+def test_find_by_md5(index):
+
+    index.add([fingerprint("a", md5="abc")])
+
+    assert index.find_by_md5("abc") == "a"
+    assert index.find_by_md5("def") is None
+    assert index.find_by_md5(None) is None
+
+
+@pytest.mark.parametrize("n_bits, expected", [(0, "a"), (8, "a"), (9, None)])
+def test_simhash_threshold(index, n_bits, expected):
+
+    simhash = 0x0123456789ABCDEF
+    index.add([fingerprint("a", simhash=simhash)])
+
+    match = index.find_near_duplicate(
+        fingerprint("new", simhash=flip_bits(simhash, n_bits))
+    )
+
+    assert match == ((expected, "simhash") if expected else None)
+
+
+@pytest.mark.parametrize("n_bits, expected", [(0, "a"), (3, "a"), (4, None)])
+def test_phash_threshold(index, n_bits, expected):
+
+    phash = 0xFEDCBA9876543210
+    index.add([fingerprint("a", phash=phash)])
+
+    match = index.find_near_duplicate(
+        fingerprint("new", phash=flip_bits(phash, n_bits))
+    )
+
+    assert match == ((expected, "phash") if expected else None)
+
+
+def test_closest_match_wins(index):
+
+    simhash = 0x0123456789ABCDEF
+    index.add(
+        [
+            fingerprint("far", simhash=flip_bits(simhash, 6)),
+            fingerprint("near", simhash=flip_bits(simhash, 2, offset=20)),
+        ]
+    )
+
+    assert index.find_near_duplicate(fingerprint("new", simhash=simhash)) == (
+        "near",
+        "simhash",
+    )
+
+
+def test_image_hash_only_decides_between_receipts_without_text(index):
+
+    phash, simhash = 0xFEDCBA9876543210, 0x0123456789ABCDEF
+    index.add([fingerprint("a", phash=phash, simhash=simhash)])
+
+    # same image but different text: the text decides
+    assert (
+        index.find_near_duplicate(
+            fingerprint("new", phash=phash, simhash=flip_bits(simhash, 20))
+        )
+        is None
+    )
+    # no text to compare: the image decides
+    assert index.find_near_duplicate(fingerprint("new", phash=phash)) == (
+        "a",
+        "phash",
+    )
+
+
+def test_a_receipt_does_not_match_itself(index):
+
+    index.add([fingerprint("a", phash=1, simhash=1)])
+
+    assert index.find_near_duplicate(fingerprint("a", phash=1, simhash=1)) is None
+
+
+def test_hashes_with_the_top_bit_set_survive_storage(tmp_path):
+
+    path = str(tmp_path / "duplicate_index.db")
+    simhash = (1 << 63) | 0xABC
+    DuplicateIndex(path).add([fingerprint("a", simhash=simhash)])
+
+    reopened = DuplicateIndex(path)
+
+    assert reopened.find_near_duplicate(fingerprint("new", simhash=simhash)) == (
+        "a",
+        "simhash",
+    )
+
+
+def test_fingerprints_of_real_receipts(index):
+
+    index.add(
+        [
+            index.fingerprint(
+                "a", "md5-a", {"extracted_text": RECEIPT_TEXT, "image": None}
+            )
+        ]
+    )
+
+    # the same receipt read again with different whitespace and case
+    reread = RECEIPT_TEXT.lower().replace("\n", "  \n ")
+    assert index.find_near_duplicate(
+        index.fingerprint("b", None, {"extracted_text": reread})
+    ) == ("a", "simhash")
+    assert (
+        index.find_near_duplicate(
+            index.fingerprint("c", None, {"extracted_text": OTHER_RECEIPT_TEXT})
+        )
+        is None
+    )
+
+
+def test_short_text_is_not_fingerprinted(index):
+
+    fingerprint = index.fingerprint("a", None, {"extracted_text": "TOTAL 1.00"})
+
+    assert fingerprint["simhash"] is None
+
+
+def test_resized_image_matches_without_text(index):
+
+    image = render(RECEIPT_TEXT)
+    index.add([index.fingerprint("a", None, {"image": image})])
+
+    resized = image.resize((320, 320))
+    assert index.find_near_duplicate(
+        index.fingerprint("b", None, {"image": resized})
+    ) == (
+        "a",
+        "phash",
+    )
+    other = render(OTHER_RECEIPT_TEXT)
+    assert (
+        index.find_near_duplicate(index.fingerprint("c", None, {"image": other}))
+        is None
+    )
+
+
+def test_links_are_persisted(tmp_path):
+
+    path = str(tmp_path / "duplicate_index.db")
+    index = DuplicateIndex(path)
+    index.link("b", "a", "md5")
+
+    reopened = DuplicateIndex(path)
+
+    assert reopened.linked_ids() == {"b"}
+    assert reopened.duplicates() == {"b": "a"}
+    assert index.stats()["linked"] == 1
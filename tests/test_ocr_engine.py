@@ -0,0 +1,33 @@
+import pytest
+from PIL import Image
+
+from receiptchat.data_transformations import OCREngine as ocr_engine_module
+from receiptchat.data_transformations.OCREngine import OCREngine
+
+tesserocr = pytest.importorskip("tesserocr")
+if "eng" not in tesserocr.get_languages()[1]:
+    pytest.skip("tesseract has no eng language data", allow_module_level=True)
+
+
+def test_tesserocr_worker_uses_page_segmentation_mode():
+
+    ocr_engine_module._init_worker("eng", 6, {}, True)
+    try:
+        assert ocr_engine_module._worker_api is not None
+        assert (
+            ocr_engine_module._worker_api.GetPageSegMode() == tesserocr.PSM.SINGLE_BLOCK
+        )
+    finally:
+        ocr_engine_module._worker_api.End()
+        ocr_engine_module._worker_api = None
+
+
+def test_tesserocr_engine_recognizes_with_page_segmentation_mode():
+
+    engine = OCREngine(psm=6, n_workers=1)
+    try:
+        text = engine.image_to_text(Image.new("RGB", (200, 50), "white"))
+    finally:
+        engine.shutdown()
+    assert isinstance(text, str)
+    assert len(engine.timings) == 1
@@ -0,0 +1,101 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from receiptchat.benchmarks.ConversionBenchmark import (
+    make_results,
+    reference_convert_json_to_pandas,
+)
+from receiptchat.data_transformations.ReceiptDatabaseHandler import (
+    ReceiptDataBaseHandler,
+)
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(
+        ReceiptDataBaseHandler, "DATABASE_PATH", str(tmp_path / "receipts.csv")
+    )
+    return ReceiptDataBaseHandler(load_database_on_init=False)
+
+
+def receipt(file_id, items, **fields):
+
+    result = {
+        "vendor_name": "Corner Shop",
+        "vendor_address": "1 Main St",
+        "datetime": "03/04/24 10:15",
+        "items_purchased": items,
+        "subtotal": "10.00",
+        "tax_rate": "8.25%",
+        "total_after_tax": "$10.83",
+        "file_details": {
+            "file_name": "receipt-" + file_id,
+            "file_type": ".pdf",
+            "file_id": file_id,
+        },
+    }
+    result.update(fields)
+    return result
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_convert_json_to_pandas_matches_row_by_row_conversion(handler, seed):
+
+    results = make_results(2000, seed=seed)
+    converted = handler.convert_json_to_pandas(results)
+    expected = reference_convert_json_to_pandas(copy.deepcopy(results))
+    pd.testing.assert_frame_equal(converted, expected)
+
+
+def test_convert_json_to_pandas_matches_on_unusual_values(handler):
+
+    results = [
+        receipt(
+            "a",
+            [
+                {"item_name": "  milk ", "item_cost": "€2,50"},
+                {"item_name": "N/A", "item_cost": "１２.５"},
+                {"item_name": "eggs", "item_cost": "N/A"},
+            ],
+            vendor_name="N/A",
+            datetime="not a date",
+        ),
+        receipt("b", [], tax_rate="N/A"),
+    ]
+    converted = handler.convert_json_to_pandas(results)
+    expected = reference_convert_json_to_pandas(copy.deepcopy(results))
+    pd.testing.assert_frame_equal(converted, expected)
+
+
+def test_convert_json_to_pandas_appends_receipt_totals_as_items(handler):
+
+    converted = handler.convert_json_to_pandas(
+        [receipt("a", [{"item_name": "milk", "item_cost": "$2.50"}])]
+    )
+
+    assert converted["item_name"].tolist() == ["milk", "tax_rate", "total", "subtotal"]
+    assert converted["item_cost"].tolist() == [2.5, 8.25, 10.0, 10.83]
+    assert set(converted["receipt_id"]) == {"a"}
+    assert converted["date"].iloc[0] == pd.Timestamp("2024-03-04 10:15")
+
+
+def test_convert_json_to_pandas_repeats_receipt_fields_per_item(handler):
+
+    converted = handler.convert_json_to_pandas(
+        [
+            receipt("a", [{"item_name": "milk", "item_cost": "1"}] * 2),
+            receipt("b", [], vendor_name=" Other Shop "),
+        ]
+    )
+
+    assert converted["receipt_id"].tolist() == ["a"] * 5 + ["b"] * 3
+    assert converted["vendor"].tolist() == ["Corner Shop"] * 5 + ["Other Shop"] * 3
+    assert np.isnan(
+        handler.convert_json_to_pandas(
+            [receipt("c", [{"item_name": "x", "item_cost": "free"}])]
+        )["item_cost"].iloc[0]
+    )
@@ -0,0 +1,143 @@
+import pytest
+
+from receiptchat.data_transformations.ReceiptValidator import (
+    ReceiptValidator,
+    parse_amount,
+)
+
+
+def receipt(**fields):
+
+    data = {
+        "vendor": "Corner Shop",
+        "datetime": "2023-04-01 10:15",
+        "items_purchased": [
+            {"item_name": "bread", "item_cost": "$2.50"},
+            {"item_name": "milk", "item_cost": "$1.50"},
+        ],
+        "subtotal": "$4.00",
+        "tax_rate": "10%",
+        "total_after_tax": "$4.40",
+    }
+    data.update(fields)
+    return data
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("$1,234.50", 1234.5),
+        ("-2.00", -2.0),
+        ("(2.00)", -2.0),
+        ("2.00-", -2.0),
+        (".99", 0.99),
+        (3, 3.0),
+        ("free", None),
+        (None, None),
+        (float("nan"), None),
+    ],
+)
+def test_parse_amount(value, expected):
+
+    assert parse_amount(value) == expected
+
+
+def test_valid_receipt_passes():
+
+    assert ReceiptValidator().failed_checks(receipt()) == []
+
+
+def test_receipt_without_items_only_fails_items():
+
+    validator = ReceiptValidator()
+
+    assert validator.failed_checks(receipt(items_purchased=[])) == ["items"]
+    assert validator.failed_checks(receipt(items_purchased=None, datetime="")) == [
+        "items"
+    ]
+
+
+def test_items_not_adding_up_to_subtotal():
+
+    assert ReceiptValidator().failed_checks(receipt(subtotal="$5.00")) == [
+        "items_sum",
+        "tax_total",
+    ]
+
+
+def test_discounts_count_against_the_subtotal():
+
+    items = receipt()["items_purchased"] + [
+        {"item_name": "coupon", "item_cost": "(1.00)"}
+    ]
+
+    assert (
+        ReceiptValidator().failed_checks(
+            receipt(items_purchased=items, subtotal="3.00", total_after_tax="3.30")
+        )
+        == []
+    )
+
+
+def test_unreadable_item_cost_fails_items_sum():
+
+    items = [{"item_name": "bread", "item_cost": "see above"}]
+
+    assert "items_sum" in ReceiptValidator().failed_checks(
+        receipt(items_purchased=items)
+    )
+
+
+@pytest.mark.parametrize(
+    "tax_rate, total",
+    [
+        ("10%", "4.40"),
+        ("10", "4.40"),
+        (0.1, "4.40"),
+        ("$0.40", "4.40"),
+        (None, "4.00"),
+        ("", "4.00"),
+    ],
+)
+def test_tax_as_a_rate_or_an_amount(tax_rate, total):
+
+    assert ReceiptValidator().check_tax_total(
+        receipt(tax_rate=tax_rate, total_after_tax=total)
+    )
+
+
+def test_total_not_matching_subtotal_with_tax():
+
+    validator = ReceiptValidator()
+
+    assert not validator.check_tax_total(receipt(total_after_tax="4.80"))
+    assert not validator.check_tax_total(receipt(tax_rate=None, total_after_tax="4.40"))
+    assert not validator.check_tax_total(receipt(total_after_tax=None))
+
+
+def test_tolerances():
+
+    validator = ReceiptValidator(relative_tolerance=0.01, absolute_tolerance=0.05)
+
+    # small amounts may be off by the absolute tolerance
+    assert validator.close(4.04, 4.00)
+    assert not validator.close(4.06, 4.00)
+    # large amounts by the relative tolerance
+    assert validator.close(1009.0, 1000.0)
+    assert not validator.close(1011.0, 1000.0)
+
+
+@pytest.mark.parametrize(
+    "value, valid",
+    [
+        ("2023-04-01 10:15", True),
+        ("04/01/2023", True),
+        ("April 1, 2023", True),
+        ("not a date", False),
+        ("", False),
+        (None, False),
+    ],
+)
+def test_check_date(value, valid):
+
+    assert ReceiptValidator.check_date(receipt(datetime=value)) is valid
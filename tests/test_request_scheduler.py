@@ -0,0 +1,309 @@
+import random
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+from langchain.callbacks.openai_info import OpenAICallbackHandler
+
+from receiptchat.openai.RequestScheduler import RequestScheduler, TokenBucket
+from receiptchat.RunMetrics import RunMetrics
+
+
+class Clock:
+    """Stands in for time.monotonic, with time.sleep advancing it instead of waiting"""
+
+    def __init__(self, now=1000.0):
+
+        self.now = now
+        self.sleeps = []
+
+    def monotonic(self):
+
+        return self.now
+
+    def sleep(self, seconds):
+
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(time, "sleep", clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+
+    # the backoff is then only what Retry-After asks for
+    monkeypatch.setattr(random, "uniform", lambda a, b: a)
+
+
+def api_error(error_class, status_code, headers=None, body=None):
+
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers or {}, request=request)
+    return error_class("error", response=response, body=body)
+
+
+def rate_limit_error(**headers):
+
+    return api_error(openai.RateLimitError, 429, headers)
+
+
+class FlakyRequest:
+    """Raises the given errors in turn, then returns "done" """
+
+    def __init__(self, *errors):
+
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+
+def test_bucket_starts_full(clock):
+
+    bucket = TokenBucket.per_minute(60)
+
+    for _ in range(60):
+        assert bucket.acquire() == 0.0
+    assert clock.sleeps == []
+
+
+def test_bucket_waits_for_refill(clock):
+
+    bucket = TokenBucket.per_minute(60)
+    bucket.acquire(60)
+
+    assert bucket.acquire(3) == pytest.approx(3.0)
+    assert clock.now == pytest.approx(1003.0)
+
+
+def test_bucket_never_refills_past_capacity(clock):
+
+    bucket = TokenBucket(capacity=10, refill_per_second=1)
+    clock.now += 100
+    bucket.acquire(10)
+
+    assert bucket.acquire(1) == pytest.approx(1.0)
+
+
+def test_request_larger_than_bucket_takes_whole_bucket(clock):
+
+    bucket = TokenBucket(capacity=10, refill_per_second=1)
+
+    assert bucket.acquire(50) == 0.0
+    assert bucket.level == 0
+
+
+def test_adjust_delays_the_next_request(clock):
+
+    bucket = TokenBucket(capacity=100, refill_per_second=10)
+    bucket.acquire(50)
+    # the request used 80 more tokens than estimated
+    bucket.adjust(80)
+
+    assert bucket.level == pytest.approx(-30)
+    assert bucket.acquire(10) == pytest.approx(4.0)
+
+
+def test_adjust_gives_back_overestimates_up_to_capacity(clock):
+
+    bucket = TokenBucket(capacity=100, refill_per_second=10)
+    bucket.acquire(20)
+    bucket.adjust(-50)
+
+    assert bucket.level == 100
+
+
+def test_pause_blocks_until_over(clock):
+
+    bucket = TokenBucket(capacity=100, refill_per_second=10)
+    bucket.pause(5)
+    # a shorter pause does not cut the longer one short
+    bucket.pause(2)
+
+    assert bucket.acquire(1) == pytest.approx(5.0)
+
+
+def test_bucket_is_shared_between_threads():
+
+    bucket = TokenBucket(capacity=100, refill_per_second=0.001)
+    taken = []
+
+    def take():
+        for _ in range(20):
+            bucket.acquire(1)
+            taken.append(1)
+
+    threads = [threading.Thread(target=take) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(taken) == 100
+    assert bucket.level < 1
+
+
+def test_no_limits_by_default(clock):
+
+    scheduler = RequestScheduler()
+
+    for _ in range(10_000):
+        scheduler.call(lambda: None, "gpt-3.5-turbo", estimated_tokens=1000)
+
+    assert scheduler.get_buckets("gpt-3.5-turbo") == {}
+    assert clock.sleeps == []
+    assert scheduler.stats()["throttled_seconds"] == 0.0
+
+
+def test_limits_throttle_each_model_separately(clock):
+
+    scheduler = RequestScheduler(
+        limits={"gpt-3.5-turbo": {"rpm": 60, "tpm": 6000}, "other": {"rpm": 1}}
+    )
+
+    for _ in range(3):
+        scheduler.call(lambda: None, "gpt-3.5-turbo", estimated_tokens=3000)
+    scheduler.call(lambda: None, "other")
+    scheduler.call(lambda: None, "unlimited")
+
+    # the third request waited for 3000 tokens to refill at 100 a second
+    assert scheduler.stats()["throttled_seconds"] == pytest.approx(30.0)
+    assert set(scheduler.get_buckets("gpt-3.5-turbo")) == {"rpm", "tpm"}
+    assert set(scheduler.get_buckets("other")) == {"rpm"}
+    assert scheduler.get_buckets("unlimited") == {}
+
+
+def test_estimate_is_corrected_with_real_usage(clock):
+
+    scheduler = RequestScheduler(limits={"gpt-3.5-turbo": {"tpm": 6000}})
+    cb = OpenAICallbackHandler()
+
+    def request():
+        cb.total_tokens += 1000
+        return "done"
+
+    scheduler.call(request, "gpt-3.5-turbo", estimated_tokens=4000, cb=cb)
+
+    assert scheduler.get_buckets("gpt-3.5-turbo")["tpm"].level == pytest.approx(5000)
+
+
+def test_completion_tokens():
+
+    class LLM:
+        max_tokens = 300
+
+    assert RequestScheduler.completion_tokens(LLM()) == 300
+    assert RequestScheduler.completion_tokens(object()) == 500
+
+
+@pytest.mark.parametrize(
+    "headers, seconds",
+    [
+        ({"retry-after": "7"}, 7.0),
+        ({"retry-after-ms": "1500"}, 1.5),
+        ({"retry-after-ms": "250", "retry-after": "1"}, 0.25),
+        ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0.0),
+        ({}, 0.0),
+    ],
+)
+def test_retry_after(headers, seconds):
+
+    error = rate_limit_error(**headers)
+
+    assert RequestScheduler.retry_after(error) == seconds
+
+
+def test_retry_after_without_response():
+
+    assert RequestScheduler.retry_after(ValueError("no response")) == 0.0
+
+
+def test_retries_wait_for_retry_after(clock, no_jitter):
+
+    metrics = RunMetrics()
+    scheduler = RequestScheduler(metrics=metrics)
+    request = FlakyRequest(
+        rate_limit_error(**{"retry-after": "4"}),
+        api_error(openai.InternalServerError, 500),
+    )
+
+    assert scheduler.call(request, "gpt-3.5-turbo", file_id="a") == "done"
+    assert request.calls == 3
+    assert clock.sleeps == [4.0, 0]
+    assert scheduler.stats()["retries"] == 2
+    assert scheduler.stats()["requests"] == 3
+    assert metrics.files["a"]["retries"] == 2
+
+
+def test_backoff_is_capped_jitter(monkeypatch):
+
+    monkeypatch.setattr(random, "uniform", lambda a, b: b)
+    scheduler = RequestScheduler(base_delay=1.0, max_delay=10.0)
+    error = api_error(openai.InternalServerError, 500)
+
+    assert [scheduler.backoff(attempt, error) for attempt in range(6)] == [
+        1.0,
+        2.0,
+        4.0,
+        8.0,
+        10.0,
+        10.0,
+    ]
+    # Retry-After wins over a shorter backoff
+    assert scheduler.backoff(0, rate_limit_error(**{"retry-after": "30"})) == 30.0
+
+
+def test_rate_limit_pauses_the_model_for_every_thread(clock, no_jitter):
+
+    scheduler = RequestScheduler(limits={"gpt-3.5-turbo": {"rpm": 600, "tpm": 6000}})
+    request = FlakyRequest(rate_limit_error(**{"retry-after": "20"}))
+    scheduler.call(request, "gpt-3.5-turbo", estimated_tokens=100)
+
+    # both buckets hold back requests from other threads until the pause is over
+    buckets = scheduler.get_buckets("gpt-3.5-turbo")
+    assert buckets["rpm"].paused_until == pytest.approx(1020.0)
+    assert buckets["tpm"].paused_until == pytest.approx(1020.0)
+    assert clock.sleeps == [20.0]
+
+
+def test_gives_up_after_max_retries(clock, no_jitter):
+
+    scheduler = RequestScheduler(max_retries=2)
+    request = FlakyRequest(*[rate_limit_error() for _ in range(5)])
+
+    with pytest.raises(openai.RateLimitError):
+        scheduler.call(request, "gpt-3.5-turbo")
+    assert request.calls == 3
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        api_error(openai.BadRequestError, 400),
+        api_error(openai.RateLimitError, 429, body={"code": "insufficient_quota"}),
+        ValueError("not an API error"),
+    ],
+)
+def test_permanent_errors_are_not_retried(clock, error):
+
+    request = FlakyRequest(error)
+
+    with pytest.raises(type(error)):
+        RequestScheduler().call(request, "gpt-3.5-turbo")
+    assert request.calls == 1
+    assert clock.sleeps == []
@@ -0,0 +1,136 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from receiptchat.openai.ResponseCache import ResponseCache, SQLiteResponseCacheBackend
+
+
+class Clock:
+
+    def __init__(self, now=1_000_000.0):
+
+        self.now = now
+
+    def __call__(self):
+
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def backend(tmp_path):
+
+    return SQLiteResponseCacheBackend(str(tmp_path / "responses.db"))
+
+
+def count_entries(backend):
+
+    return backend.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+def test_put_and_get(backend):
+
+    cache = ResponseCache(backend)
+    cache.put("key", {"vendor_name": "Shop", "items": [1, 2]})
+
+    assert cache.get("key") == {"vendor_name": "Shop", "items": [1, 2]}
+    assert cache.get("other") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_entries_older_than_the_ttl_are_misses(backend, clock):
+
+    cache = ResponseCache(backend, ttl_seconds=60)
+    cache.put("key", "value")
+
+    clock.now += 60
+    assert cache.get("key") == "value"
+    clock.now += 1
+    assert cache.get("key") is None
+
+
+def test_eviction_drops_expired_entries(backend, clock):
+
+    cache = ResponseCache(backend, ttl_seconds=60)
+    cache.put("old", "value")
+    clock.now += 30
+    cache.put("new", "value")
+
+    clock.now += 31
+    cache.evict()
+
+    assert count_entries(backend) == 1
+    assert cache.get("new") == "value"
+
+
+def test_eviction_keeps_the_newest_max_entries(backend, clock):
+
+    cache = ResponseCache(backend, max_entries=3, evict_every=1000)
+    for i in range(5):
+        clock.now += 1
+        cache.put("key{}".format(i), i)
+
+    cache.evict()
+
+    assert count_entries(backend) == 3
+    assert [cache.get("key{}".format(i)) for i in range(5)] == [None, None, 2, 3, 4]
+
+
+def test_eviction_runs_every_evict_every_writes(backend, clock):
+
+    cache = ResponseCache(backend, max_entries=2, evict_every=4)
+    for i in range(3):
+        clock.now += 1
+        cache.put("key{}".format(i), i)
+    assert count_entries(backend) == 3
+
+    clock.now += 1
+    cache.put("key3", 3)
+    assert count_entries(backend) == 2
+
+
+def test_entries_are_evicted_when_the_cache_is_opened(backend, clock):
+
+    cache = ResponseCache(backend)
+    for i in range(4):
+        clock.now += 1
+        cache.put("key{}".format(i), i)
+
+    ResponseCache(backend, max_entries=1)
+
+    assert count_entries(backend) == 1
+
+
+def test_make_key_covers_every_part():
+
+    key = ResponseCache.make_key(
+        model="gpt-3.5-turbo", examples={"a": 1, "b": 2}, image=b"\x00\x01"
+    )
+
+    assert key == ResponseCache.make_key(
+        image=b"\x00\x01", examples={"b": 2, "a": 1}, model="gpt-3.5-turbo"
+    )
+    assert key != ResponseCache.make_key(
+        model="gpt-4", examples={"a": 1, "b": 2}, image=b"\x00\x01"
+    )
+    assert key != ResponseCache.make_key(
+        model="gpt-3.5-turbo", examples={"a": 1, "b": 2}, image=b"\x00\x02"
+    )
+
+
+@pytest.mark.parametrize(
+    "temperature, cacheable", [(0, True), (None, True), (0.0, True), (0.7, False)]
+)
+def test_only_deterministic_calls_are_cacheable(temperature, cacheable):
+
+    assert ResponseCache.is_cacheable(SimpleNamespace(temperature=temperature)) is (
+        cacheable
+    )
@@ -0,0 +1,193 @@
+import time
+
+import pytest
+
+from receiptchat.RunJournal import RunJournal
+
+
+class Clock:
+
+    def __init__(self, now=1_000_000.0):
+
+        self.now = now
+
+    def __call__(self):
+
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def journal(tmp_path):
+
+    return RunJournal(str(tmp_path / "journal" / "run_journal.db"), max_attempts=3)
+
+
+def details(file_id):
+
+    return {"id": file_id, "name": file_id + ".pdf", "version": "1"}
+
+
+def test_journal_is_created_on_first_use(tmp_path):
+
+    path = tmp_path / "journal" / "run_journal.db"
+    journal = RunJournal(str(path))
+
+    assert not path.parent.exists()
+    assert journal.failures() == []
+    assert path.exists()
+
+
+def test_failures_are_recorded_with_their_error(journal):
+
+    attempts = journal.record_failure(details("a"), ValueError("bad receipt"))
+
+    assert attempts == 1
+    [failure] = journal.failures()
+    assert failure["file_id"] == "a"
+    assert failure["file_details"] == details("a")
+    assert failure["error"] == "ValueError: bad receipt"
+    assert failure["attempts"] == 1
+
+
+def test_repeated_failures_count_attempts(journal, clock):
+
+    journal.record_failure(details("a"), ValueError("first"))
+    clock.now += 60
+    updated = dict(details("a"), version="2")
+    attempts = journal.record_failure(updated, KeyError("second"))
+
+    assert attempts == 2
+    [failure] = journal.failures()
+    # the latest error and details are kept
+    assert failure["error"] == "KeyError: 'second'"
+    assert failure["file_details"] == updated
+    assert failure["last_attempt"] == clock.now
+
+
+def test_failures_are_ordered_by_last_attempt(journal, clock):
+
+    for file_id in ["a", "b", "c"]:
+        journal.record_failure(details(file_id), ValueError())
+        clock.now += 1
+    journal.record_failure(details("a"), ValueError())
+
+    assert [x["file_id"] for x in journal.failures()] == ["b", "c", "a"]
+
+
+def test_retryable_until_max_attempts(journal):
+
+    for _ in range(2):
+        journal.record_failure(details("a"), ValueError())
+    for _ in range(3):
+        journal.record_failure(details("b"), ValueError())
+
+    assert journal.retryable_files() == [details("a")]
+    assert journal.exhausted_ids() == {"b"}
+
+    journal.record_failure(details("a"), ValueError())
+
+    assert journal.retryable_files() == []
+    assert journal.exhausted_ids() == {"a", "b"}
+
+
+def test_successes_leave_the_dead_letter(journal):
+
+    for file_id in ["a", "b", "c"]:
+        journal.record_failure(details(file_id), ValueError())
+    journal.record_successes(["a", "c", "not failed"])
+
+    assert [x["file_id"] for x in journal.failures()] == ["b"]
+
+    # a later failure starts counting again
+    assert journal.record_failure(details("a"), ValueError()) == 1
+
+
+def test_journal_persists_between_runs(journal):
+
+    journal.record_failure(details("a"), ValueError())
+    reopened = RunJournal(journal.journal_path, max_attempts=1)
+
+    assert reopened.retryable_files() == []
+    assert reopened.exhausted_ids() == {"a"}
+
+
+def batch_request(file_id):
+
+    return {"file": {"id": file_id}, "file_details": {}, "cache_key": "key-" + file_id}
+
+
+def test_pending_batch_runs(journal, clock):
+
+    journal.record_batch_requests(
+        "run-1", "gpt-3.5-turbo", {x: batch_request(x) for x in ["a", "b"]}
+    )
+    journal.record_batch("run-1", "batch-1", "input-1")
+    clock.now += 1
+    journal.record_batch("run-1", "batch-2", "input-2")
+
+    assert journal.pending_batch_runs("gpt-3.5-turbo") == [
+        {
+            "run_id": "run-1",
+            "batch_ids": ["batch-1", "batch-2"],
+            "requests": {"a": batch_request("a"), "b": batch_request("b")},
+        }
+    ]
+    assert journal.pending_batch_runs("gpt-4-vision-preview") == []
+
+
+def test_pending_batch_runs_are_oldest_first(journal):
+
+    for run_id in ["20240102T000000-bbbbbb", "20240101T000000-aaaaaa"]:
+        journal.record_batch_requests(
+            run_id, "gpt-3.5-turbo", {"a": batch_request("a")}
+        )
+        journal.record_batch(run_id, "batch-" + run_id, "input-" + run_id)
+
+    assert [x["run_id"] for x in journal.pending_batch_runs("gpt-3.5-turbo")] == [
+        "20240101T000000-aaaaaa",
+        "20240102T000000-bbbbbb",
+    ]
+
+
+def test_run_stopped_before_submitting_has_no_batches(journal):
+
+    journal.record_batch_requests("run-1", "gpt-3.5-turbo", {"a": batch_request("a")})
+
+    [run] = journal.pending_batch_runs("gpt-3.5-turbo")
+    assert run["batch_ids"] == []
+
+
+def test_clear_batch_runs(journal):
+
+    for run_id in ["run-1", "run-2"]:
+        journal.record_batch_requests(
+            run_id, "gpt-3.5-turbo", {"a": batch_request("a")}
+        )
+        journal.record_batch(run_id, "batch-" + run_id, "input-" + run_id)
+    journal.clear_batch_runs(["run-1"])
+
+    assert [x["run_id"] for x in journal.pending_batch_runs("gpt-3.5-turbo")] == [
+        "run-2"
+    ]
+    assert journal.connection.execute("SELECT batch_id FROM batches").fetchall() == [
+        ("batch-run-2",)
+    ]
+
+
+def test_batch_runs_survive_a_restart(journal):
+
+    journal.record_batch_requests("run-1", "gpt-3.5-turbo", {"a": batch_request("a")})
+    journal.record_batch("run-1", "batch-1", "input-1")
+    reopened = RunJournal(journal.journal_path)
+
+    assert reopened.pending_batch_runs("gpt-3.5-turbo") == journal.pending_batch_runs(
+        "gpt-3.5-turbo"
+    )
@@ -0,0 +1,142 @@
+import random
+
+import pandas as pd
+import pytest
+
+from receiptchat.SpendAggregates import SpendAggregates
+
+
+@pytest.fixture
+def aggregates(tmp_path):
+
+    return SpendAggregates(str(tmp_path / "spend_aggregates.db"))
+
+
+def line_items(receipt_id, vendor, date, items, before_tax=None, after_tax=None):
+    """The rows of one receipt, with its totals stored as items as the database does"""
+
+    rows = [(name, cost) for name, cost in items]
+    # the subtotal is stored as "total" and the total after tax as "subtotal"
+    rows += [("tax_rate", float("nan"))]
+    rows += [("total", float("nan") if before_tax is None else before_tax)]
+    rows += [("subtotal", float("nan") if after_tax is None else after_tax)]
+    return pd.DataFrame(
+        {
+            "vendor": vendor,
+            "date": pd.to_datetime(date, errors="coerce"),
+            "item_name": [name for name, _ in rows],
+            "item_cost": [cost for _, cost in rows],
+            "receipt_id": receipt_id,
+        }
+    )
+
+
+def table(*receipts):
+
+    return pd.concat(receipts, ignore_index=True)
+
+
+def test_totals_by_vendor_and_month(aggregates):
+
+    aggregates.add(
+        table(
+            line_items("a", "Shop", "2024-01-05", [("milk", 2.0)], 10.0, 10.8),
+            line_items("b", "Shop", "2024-02-01", [("eggs", 3.0)], 20.0, 21.0),
+            line_items("c", "Cafe", "2024-01-20", [("tea", 4.0)], 4.0, 4.0),
+        )
+    )
+
+    assert aggregates.totals()["spend"] == pytest.approx(35.8)
+    assert aggregates.totals()["receipts"] == 3
+    assert aggregates.vendor_spend("Shop") == pytest.approx(31.8)
+    assert aggregates.monthly_spend("2024-01") == pytest.approx(14.8)
+    assert aggregates.vendor_spend("Shop", month="2024-02") == pytest.approx(21.0)
+    assert aggregates.tax_paid() == pytest.approx(1.8)
+    assert aggregates.tax_paid(vendor="Cafe") == pytest.approx(0.0)
+    assert [x["vendor"] for x in aggregates.top_vendors()] == ["Shop", "Cafe"]
+    assert [x["month"] for x in aggregates.monthly_totals()] == ["2024-01", "2024-02"]
+
+
+def test_adding_the_same_receipts_again_changes_nothing(aggregates):
+
+    receipts = table(
+        line_items("a", "Shop", "2024-01-05", [("milk", 2.0)], 10.0, 10.8),
+        line_items("b", "Cafe", "2024-01-20", [("tea", 4.0)], 4.0, 4.0),
+    )
+    aggregates.add(receipts)
+    before = (
+        aggregates.totals(),
+        aggregates.top_vendors(),
+        aggregates.monthly_totals(),
+    )
+
+    aggregates.add(receipts)
+    aggregates.add(receipts.iloc[:4])
+
+    after = (aggregates.totals(), aggregates.top_vendors(), aggregates.monthly_totals())
+    assert after == before
+
+
+def test_a_receipt_parsed_again_replaces_its_contribution(aggregates):
+
+    aggregates.add(line_items("a", "Shop", "2024-01-05", [], 10.0, 10.8))
+    aggregates.add(line_items("a", "Other Shop", "2024-03-01", [], 5.0, 5.5))
+
+    assert aggregates.totals() == {
+        "spend": 5.5,
+        "tax": pytest.approx(0.5),
+        "receipts": 1,
+    }
+    assert aggregates.vendor_spend("Shop") == 0.0
+    assert aggregates.monthly_spend("2024-01") == 0.0
+    assert [x["vendor"] for x in aggregates.top_vendors()] == ["Other Shop"]
+    assert [x["month"] for x in aggregates.monthly_totals()] == ["2024-03"]
+
+
+def test_spend_falls_back_to_the_subtotal_and_then_the_items(aggregates):
+
+    aggregates.add(
+        table(
+            line_items("a", "Shop", "2024-01-05", [("milk", 2.0)], before_tax=7.0),
+            line_items("b", "Shop", "2024-01-05", [("milk", 2.0), ("eggs", 3.5)]),
+        )
+    )
+
+    assert aggregates.totals()["spend"] == pytest.approx(12.5)
+    assert aggregates.tax_paid() == 0.0
+
+
+def test_unknown_vendors_and_dates_are_grouped(aggregates):
+
+    aggregates.add(line_items("a", "nan", "not a date", [], 3.0, 3.0))
+
+    assert aggregates.vendor_spend(SpendAggregates.UNKNOWN) == 3.0
+    assert aggregates.monthly_spend(SpendAggregates.UNKNOWN) == 3.0
+
+
+def test_incremental_totals_match_a_full_recount(aggregates):
+
+    rng = random.Random(0)
+    receipts = {}
+    for _ in range(8):
+        batch = []
+        # ids repeat across batches, so receipts are often replaced
+        for receipt_id in rng.sample(["r{}".format(i) for i in range(40)], 15):
+            receipts[receipt_id] = line_items(
+                receipt_id,
+                rng.choice(["Shop", "Cafe", "Market"]),
+                "2024-{:02d}-10".format(rng.randint(1, 4)),
+                [("item", round(rng.uniform(1, 20), 2))],
+                round(rng.uniform(1, 50), 2),
+                round(rng.uniform(50, 60), 2),
+            )
+            batch.append(receipts[receipt_id])
+        aggregates.add(table(*batch))
+
+    expected = SpendAggregates.receipt_spend(table(*receipts.values()))
+    assert aggregates.totals()["receipts"] == len(receipts)
+    assert aggregates.totals()["spend"] == pytest.approx(expected["spend"].sum())
+    for vendor, spend in expected.groupby("vendor")["spend"].sum().items():
+        assert aggregates.vendor_spend(vendor) == pytest.approx(spend)
+    for month, spend in expected.groupby("month")["spend"].sum().items():
+        assert aggregates.monthly_spend(month) == pytest.approx(spend)
@@ -0,0 +1,154 @@
+import pytest
+
+from receiptchat.data_transformations.TextCompactor import TextCompactor
+
+
+class WordCounter:
+    """Counts words as tokens, so that tests need no tokenizer"""
+
+    def __init__(self):
+
+        self.calls = 0
+
+    def count(self, text: str) -> int:
+
+        self.calls += 1
+        return len((text or "").split())
+
+
+RECEIPT = """CORNER SHOP
+www.cornershop.com
+12 High Street
+════════════════════
+Bread ........ $ 2 . 50
+Milk           1,50
+|||||||||||||||||
+SUBTOTAL       $4.00
+TAX 10%        $0.40
+TOTAL          $4.40
+0123456789012345
+* * * * *
+Thank you for shopping!
+Tell us how we did: survey.cornershop.com
+"""
+
+
+@pytest.fixture
+def compactor():
+
+    return TextCompactor(token_counter=WordCounter())
+
+
+def test_compact_receipt(compactor):
+
+    assert compactor.compact(RECEIPT).splitlines() == [
+        "CORNER SHOP",
+        "www.cornershop.com",
+        "12 High Street",
+        "Bread $2.50",
+        "Milk 1.50",
+        "SUBTOTAL $4.00",
+        "TAX 10% $0.40",
+        "TOTAL $4.40",
+    ]
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        ("$ 4.50", "$4.50"),
+        ("€ 12.00", "€12.00"),
+        ("4 . 50", "4.50"),
+        ("4. 50", "4.50"),
+        ("4 .50", "4.50"),
+        ("4,50", "4.50"),
+        ("1,234", "1,234"),
+        ("1,234.50", "1,234.50"),
+        ("2 x 3.00", "2 x 3.00"),
+    ],
+)
+def test_normalize_price_formats(line, expected):
+
+    assert TextCompactor.normalize_price_formats(line) == expected
+
+
+def test_prices_can_be_left_alone():
+
+    compactor = TextCompactor(normalize_prices=False, measure_tokens=False)
+
+    assert compactor.compact("Milk   $ 1,50") == "Milk $ 1,50"
+
+
+@pytest.mark.parametrize(
+    "line, low_information",
+    [
+        ("", True),
+        ("a", True),
+        ("- 1 -", True),
+        ("ok", False),
+        ("0123456789", True),
+        ("0123 4567 8901", True),
+        ("012345678", False),
+        ("Item 0123456789", False),
+    ],
+)
+def test_is_low_information(compactor, line, low_information):
+
+    assert compactor.is_low_information(line) is low_information
+
+
+def test_footer_is_kept_in_the_header():
+
+    compactor = TextCompactor(header_lines=1, measure_tokens=False)
+
+    assert compactor.compact("www.shop.com\nBread 2.50\nwww.shop.com") == (
+        "www.shop.com\nBread 2.50"
+    )
+
+
+def test_custom_footer_patterns():
+
+    text = "SHOP\nBread 2.50\nThank you\nPOINTS BALANCE 120"
+    compactor = TextCompactor(
+        header_lines=1, footer_patterns=[r"points"], measure_tokens=False
+    )
+
+    assert compactor.compact(text) == "SHOP\nBread 2.50\nThank you"
+    assert TextCompactor(footer_patterns=[], measure_tokens=False).compact(text) == (
+        text
+    )
+
+
+def test_empty_text(compactor):
+
+    assert compactor.compact("") == ""
+    assert compactor.compact(None) == ""
+
+
+def test_tokens_are_counted_by_source():
+
+    compactor = TextCompactor(header_lines=1, token_counter=WordCounter())
+    compactor.compact("Bread   2.50\n=====\nThank you for shopping", source="input")
+    compactor.compact("Milk 1.50", source="examples")
+    compactor.compact("Eggs 3.00", source="examples")
+
+    assert compactor.stats() == {
+        "examples_texts": 2,
+        "examples_tokens_before": 4,
+        "examples_tokens_after": 4,
+        "examples_savings_fraction": 0.0,
+        "input_texts": 1,
+        "input_tokens_before": 7,
+        "input_tokens_after": 2,
+        "input_savings_fraction": pytest.approx(5 / 7),
+    }
+
+
+def test_without_measuring_no_tokens_are_counted():
+
+    counter = WordCounter()
+    compactor = TextCompactor(measure_tokens=False, token_counter=counter)
+    compactor.compact(RECEIPT)
+
+    assert counter.calls == 0
+    assert compactor.stats() == {"input_texts": 1}